@@ -0,0 +1,218 @@
+'''
+Execute Athena DDL statements over JDBC, concurrently and on reused connections.
+
+Statements without a table name (eg CREATE DATABASE) run on their own, in order, after the statements before them.
+Between them, each table's statements run in order, and different tables run concurrently.
+
+Methods:
+
+- get(cls, athena_s3_staging_dir, **kwargs):
+    Returns the process wide executor for the constructor arguments.
+
+- constructor (__init__)
+    Parameters:
+    - athena_s3_staging_dir (str) - an s3 path uri to a bucket/prefix used by Athena for query results
+    - maxConcurrent (int) - Maximum number of statements running at the same time (and of pooled connections)
+    - region (str) - AWS region of the Athena endpoint - default AWS_DEFAULT_REGION
+    - url, driver, jar (str) - JDBC url, driver class and jar - default the Athena JDBC driver installed on EMR, or
+        any other JDBC driver (eg H2 for testing)
+    - properties (dict) - Extra JDBC connection properties, eg {"log_path": ..., "log_level": "DEBUG"} for driver logging
+    - queryTimeout (int) - Seconds to wait for a single statement
+    - maxRetries (int) - Retries for statements rejected by Athena with a throttling error
+
+- execute(self, ddlList):
+    Runs the statements, and returns a list of (statement, seconds) for the statements that ran, in completion order.
+    Raises ValueError listing the failed statements if any failed - statements for other tables still complete, but
+    later statements for the same table, and everything from the next statement without a table on, are not run.
+    Parameters:
+    - ddlList (list of str) - A string, or list of strings (or lists of strings) containing valid Athena DDL statements
+
+- close(self):
+    Closes the pooled connections.
+'''
+
+from __future__ import print_function
+import os
+import re
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import jaydebeapi
+try:
+    import jpype
+except ImportError:
+    jpype = None
+from .pooling import pooled
+
+
+_TABLE_RE = re.compile(r'\bTABLE\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([`"\w.]+)', re.IGNORECASE)
+_THROTTLED_RE = re.compile(r'ThrottlingException|TooManyRequests|Rate exceeded', re.IGNORECASE)
+
+
+def _statementTable(ddl):
+    # normalized schema.table named by a statement, or None for database level or other statements
+    m = _TABLE_RE.search(ddl)
+    return m.group(1).replace("`", "").replace('"', "").lower() if m else None
+
+
+class athenaExecutor(object):
+
+    @classmethod
+    def get(cls, athena_s3_staging_dir, **kwargs):
+        return pooled(cls, None, athena_s3_staging_dir, **kwargs)
+
+    def __init__(self, athena_s3_staging_dir, maxConcurrent=4, region=None, url=None,
+                 driver='com.amazonaws.athena.jdbc.AthenaDriver', jar='/usr/lib/athena/AthenaJDBC41-1.1.0.jar',
+                 properties=None, queryTimeout=600, maxRetries=5):
+        region = region or os.environ.get('AWS_DEFAULT_REGION')
+        self.url = url or "jdbc:awsathena://athena.{0}.amazonaws.com:443".format(region)
+        self.driver = driver
+        self.jar = jar
+        self.properties = {
+            "aws_credentials_provider_class": "com.amazonaws.auth.InstanceProfileCredentialsProvider",
+            "s3_staging_dir": athena_s3_staging_dir
+        }
+        self.properties.update(properties or {})
+        self.maxConcurrent = maxConcurrent
+        self.queryTimeout = queryTimeout
+        self.maxRetries = maxRetries
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # reuse an idle connection, or open a new one while fewer than maxConcurrent are open
+        try:
+            conn = self.idle.get_nowait()
+            if not conn.jconn.isClosed():
+                return conn
+            with self.lock:
+                self.opened -= 1
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.opened < self.maxConcurrent
+            if create:
+                self.opened += 1
+        if not create:
+            return self.idle.get()
+        try:
+            return jaydebeapi.connect(self.driver, self.url, self.properties, self.jar)
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def _release(self, conn, broken=False):
+        if broken:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            with self.lock:
+                self.opened -= 1
+        else:
+            self.idle.put(conn)
+
+    def _run(self, ddl):
+        attempt = 0
+        while True:
+            conn = self._connect()
+            start = time.time()
+            try:
+                stmt = conn.jconn.createStatement()
+                try:
+                    try:
+                        stmt.setQueryTimeout(self.queryTimeout)
+                    except Exception:
+                        pass  # not supported by all drivers
+                    stmt.execute(ddl)
+                finally:
+                    stmt.close()
+            except Exception as e:
+                broken = conn.jconn.isClosed()
+                self._release(conn, broken)
+                if _THROTTLED_RE.search(str(e)) and attempt < self.maxRetries:
+                    attempt += 1
+                    time.sleep(min(30, 2 ** attempt))
+                    continue
+                raise
+            self._release(conn)
+            return time.time() - start
+
+    def _runGroup(self, group, results, failures):
+        # statements for one table, in order - stop at the first failure
+        if jpype is not None and hasattr(jpype, "attachThreadToJVM") and not jpype.isThreadAttachedToJVM():
+            jpype.attachThreadToJVM()
+        for ddl in group:
+            print("Executing Athena DDL: {0}".format(ddl))
+            try:
+                seconds = self._run(ddl)
+                results.append((ddl, seconds))
+            except Exception as e:
+                failures.append((ddl, str(e)))
+                print("Athena DDL failed: {0}\n{1}".format(ddl, e))
+                return
+
+    def _runSegment(self, groups, results, failures):
+        pending = queue.Queue()
+        for group in groups:
+            pending.put(group)
+
+        def worker():
+            while True:
+                try:
+                    group = pending.get_nowait()
+                except queue.Empty:
+                    return
+                self._runGroup(group, results, failures)
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.maxConcurrent, len(groups)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def execute(self, ddlList):
+        if type(ddlList) is not list:
+            ddlList = [ddlList]
+        # flatten nested lists, eg from athenaPartitionDDL()
+        ddlList = [ddl for item in ddlList for ddl in (item if type(item) is list else [item])]
+        results, failures = [], []
+        start = time.time()
+        groups = []
+        for ddl in ddlList + [None]:
+            table = _statementTable(ddl) if ddl else None
+            if table:
+                match = [g for g in groups if g[0] == table]
+                if match:
+                    match[0][1].append(ddl)
+                else:
+                    groups.append((table, [ddl]))
+                continue
+            # statements without a table (and the end of the list) are barriers: run the segment so far, then the statement
+            if groups:
+                self._runSegment([g[1] for g in groups], results, failures)
+                groups = []
+            if failures:
+                break
+            if ddl:
+                self._runGroup([ddl], results, failures)
+                if failures:
+                    break
+        print("Executed {0} Athena DDL statements in {1:.1f}s".format(len(results), time.time() - start))
+        if failures:
+            raise ValueError("{0} Athena DDL statements failed: {1}".format(
+                len(failures), "; ".join("{0} ({1})".format(ddl, error) for ddl, error in failures)))
+        return results
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._release(conn, broken=True)
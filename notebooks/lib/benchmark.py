@@ -0,0 +1,358 @@
+'''
+Benchmarks for the harmonization pipeline, using synthetic city-like crime incident datasets.
+
+Runs on local-mode Spark with no network access: datasets are generated on local disk, parquet tables are written to a
+local warehouse directory, and elasticsearch loads go to a local mock _bulk endpoint. Each stage is timed separately
+and results are appended as json lines to a results file, so runs can be compared across releases.
+
+Run as a module from the notebooks directory, with pyspark on the python path, eg:
+    python -m lib.benchmark --master local[4] --rows 1000000 --city LosAngeles --results bench.jsonl
+
+Methods:
+
+- generateIncidents(path, city="Baltimore", rows=100000, extraCols=0, locationCardinality=20000, dirtyRate=0.02, seed=42):
+    Writes a synthetic incident CSV file (with header row) shaped like the raw dataset of a city, and returns its path.
+    Parameters:
+    - path (str) - Local path of the CSV file to create
+    - city (str) - Baltimore | Detroit | LosAngeles - column names, date/time formats and value sets of the city's source
+    - rows (int) - Number of incidents
+    - extraCols (int) - Number of additional low cardinality string columns, to widen the dataset
+    - locationCardinality (int) - Number of distinct addresses
+    - dirtyRate (float) - Fraction of rows with missing or corrupted coordinates
+
+- constructor (__init__)
+    Parameters:
+    - hiveContext - Hive context on a local mode SparkContext
+    - workDir (str) - Local directory for generated datasets and parquet tables
+    - resultsPath (str) - Optional json lines file results are appended to
+
+- run(self, city="Baltimore", rows=100000, extraCols=0, locationCardinality=20000, dirtyRate=0.02, stages=None):
+    Generates a dataset and times each stage of the pipeline on it. Returns the list of result records, each a dict
+    with benchmark, stage, city, rows, cols, seconds and rowsPerSec keys (and stage specific stats).
+    Stages (all by default): load, mapVar, deferTransforms, mapValues, buildDataDict, saveAsParquetTable, saveToEs
+    The mapValues, buildDataDict and saveAsParquetTable stages also record a variant (broadcast lookup mapping,
+    exact distinct counts, sorted output with target file size).
+    Parameters:
+    - city, rows, extraCols, locationCardinality, dirtyRate - as for generateIncidents()
+    - stages (list of str) - Optional subset of stages to run
+'''
+
+from __future__ import print_function
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import threading
+import time
+import uuid
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+from pyspark.sql.functions import concat_ws, lit, regexp_replace
+from .esindex import esindex
+from .harmonizeCrimeIncidents import harmonizeCrimeIncidents, _sqlIdent
+
+
+_STAGES = ["load", "mapVar", "deferTransforms", "mapValues", "buildDataDict", "saveAsParquetTable", "saveToEs"]
+
+# value sets and layouts of the raw city datasets, as seen in the city notebooks
+_CITY_SHAPES = {
+    "Baltimore": {
+        "columns": ["CrimeDate", "CrimeTime", "CrimeCode", "Location", "Description", "Inside/Outside", "Weapon",
+                    "Post", "District", "Neighborhood", "Location 1", "Premise", "Total Incidents"],
+        "descriptions": ["ROBBERY - COMMERCIAL", "AGG. ASSAULT", "ROBBERY - RESIDENCE", "ARSON", "SHOOTING",
+                         "ROBBERY - STREET", "LARCENY FROM AUTO", "AUTO THEFT", "LARCENY", "HOMICIDE",
+                         "COMMON ASSAULT", "ROBBERY - CARJACKING", "RAPE", "BURGLARY", "ASSAULT BY THREAT"],
+        "varMappings": [["Description", "description_orig", True], ["Location 1", "geolocation"],
+                        ["Neighborhood", "neighbourhood"]],
+        "center": (39.29, -76.61)
+    },
+    "Detroit": {
+        "columns": ["Crime ID", "Report #", "Incident Address", "Offense Description", "Offense Category",
+                    "State Offense Code", "Incident Date & Time", "Incident Time (24h)", "Day of Week (Sunday is 1)",
+                    "Hour of Day", "Year", "Scout Car Area", "Precinct Number", "Census Block GEOID", "Neighborhood",
+                    "Council District", "Zip Code", "Longitude", "Latitude", "IBR Report Date"],
+        "descriptions": ["FRAUD", "OUIL", "WEAPONS OFFENSES", "LIQUOR", "STOLEN VEHICLE", "SOLICITATION", "ARSON",
+                         "DAMAGE TO PROPERTY", "OBSTRUCTING THE POLICE", "AGGRAVATED ASSAULT", "GAMBLING",
+                         "MISCELLANEOUS", "ASSAULT", "DANGEROUS DRUGS", "EXTORTION", "FORGERY", "SEX OFFENSES",
+                         "ROBBERY", "LARCENY", "BURGLARY", "HOMICIDE", "KIDNAPING", "ESCAPE", "BRIBERY"],
+        "varMappings": [["Incident Address", "location"], ["Offense Category", "description", True],
+                        ["Neighborhood", "neighbourhood"]],
+        "center": (42.38, -83.10)
+    },
+    "LosAngeles": {
+        "columns": ["CRIME_DATE", "CRIME_YEAR", "CRIME_CATEGORY_NUMBER", "CRIME_CATEGORY_DESCRIPTION",
+                    "STATISTICAL_CODE", "STATISTICAL_CODE_DESCRIPTION", "VICTIM_COUNT", "STREET", "CITY", "STATE",
+                    "ZIP", "LATITUDE", "LONGITUDE", "GANG_RELATED", "REPORTING_DISTRICT", "STATION_IDENTIFIER",
+                    "STATION_NAME", "CRIME_IDENTIFIER"],
+        "descriptions": ["VEHICLE / BOATING LAWS", "LIQUOR LAWS", "CRIMINAL HOMICIDE", "FRAUD AND NSF CHECKS",
+                         "OFFENSES AGAINST FAMILY", "FELONIES MISCELLANEOUS", "WARRANTS", "FEDERAL OFFENSES WITH MONEY",
+                         "ARSON", "AGGRAVATED ASSAULT", "GAMBLING", "LARCENY THEFT", "DRUNK DRIVING VEHICLE / BOAT",
+                         "SEX OFFENSES FELONIES", "SEX OFFENSES MISDEMEANORS", "DRUNK / ALCOHOL / DRUGS", "FORGERY",
+                         "WEAPON LAWS", "MISDEMEANORS MISCELLANEOUS", "BURGLARY", "ROBBERY", "VAGRANCY"],
+        "varMappings": [["STREET", "location"], ["STATION_NAME", "neighbourhood", True],
+                        ["CRIME_CATEGORY_DESCRIPTION", "description", True]],
+        "center": (34.05, -118.25)
+    }
+}
+
+_STREETS = ["MAIN ST", "BROADWAY", "PARK AVE", "CHARLES ST", "GRIFFIS AVE", "W 8 MILE RD", "LONG VALLEY RD",
+            "LAFAYETTE AV", "HARBOR BLVD", "SUNSET BLVD", "GRATIOT AVE", "MICHIGAN AVE"]
+_NEIGHBOURHOODS = ["Charles North", "Morrell Park", "Downtown", "Midtown", "Corktown", "Malibu/Lost Hills",
+                   "Century", "Lakewood", "East Side", "West End", "Harbor", "Riverside"]
+
+
+def _coordinates(rnd, center, dirtyRate):
+    # (lat, lon) strings - a dirtyRate fraction are missing, zero, swapped or unparseable, as in the real feeds
+    lat = "%.10f" % (center[0] + rnd.uniform(-0.15, 0.15))
+    lon = "%.10f" % (center[1] + rnd.uniform(-0.15, 0.15))
+    if rnd.random() < dirtyRate:
+        return rnd.choice([("", ""), ("0", "0"), (lon, lat), ("N/A", lon)])
+    return lat, lon
+
+
+def _incidentRow(rnd, city, shape, locations, dirtyRate):
+    t = time.gmtime(rnd.randint(1420070400, 1483228799))  # 2015-2016
+    hour12 = t.tm_hour % 12 or 12
+    ampm = "AM" if t.tm_hour < 12 else "PM"
+    date12 = "%02d/%02d/%04d %02d:%02d:%02d %s" % (t.tm_mon, t.tm_mday, t.tm_year, hour12, t.tm_min, t.tm_sec, ampm)
+    lat, lon = _coordinates(rnd, shape["center"], dirtyRate)
+    descr = rnd.choice(shape["descriptions"])
+    location = rnd.choice(locations)
+    neighbourhood = rnd.choice(_NEIGHBOURHOODS)
+    if city == "Baltimore":
+        # CrimeTime is either 18:51:00 or 1851
+        crimetime = "%02d:%02d:00" % (t.tm_hour, t.tm_min) if rnd.random() < 0.8 else "%02d%02d" % (t.tm_hour, t.tm_min)
+        return ["%02d/%02d/%04d" % (t.tm_mon, t.tm_mday, t.tm_year), crimetime, "%d%s" % (rnd.randint(1, 9), rnd.choice("ABCDEF")),
+                location, descr, rnd.choice(["I", "O", "Inside", "Outside", ""]), rnd.choice(["FIREARM", "KNIFE", "HANDS", "OTHER", ""]),
+                str(rnd.randint(100, 999)), rnd.choice(["CENTRAL", "SOUTHWESTERN", "NORTHERN", "EASTERN", "WESTERN"]),
+                neighbourhood, "(%s, %s)" % (lat, lon) if lat else "", rnd.choice(["STREET", "ROW/TOWNHO", "PARKING LOT"]), "1"]
+    if city == "Detroit":
+        return [str(rnd.randint(3000000, 3999999)), str(rnd.randint(1700000000, 1799999999)), location,
+                descr + " - " + rnd.choice(["SIMPLE", "AGGRAVATED", "OTHER"]), descr, str(rnd.randint(1000, 9999)),
+                date12, "%02d%02d" % (t.tm_hour, t.tm_min), str((t.tm_wday + 1) % 7 + 1), str(t.tm_hour), str(t.tm_year),
+                "%04d" % rnd.randint(100, 1299), "%02d" % rnd.randint(1, 12), str(rnd.randint(261630000000000, 261639999999999)),
+                neighbourhood if rnd.random() > 0.3 else "", str(rnd.randint(1, 7)), str(rnd.randint(48201, 48243)),
+                lon, lat, date12]
+    return [date12, str(t.tm_year), str(rnd.randint(1, 30)), descr, str(rnd.randint(100, 999)), descr + ": Misdemeanor",
+            str(rnd.randint(1, 3)), location if rnd.random() > 0.1 else "", "LOS ANGELES", "CA", str(rnd.randint(90001, 90899)),
+            lat, lon, rnd.choice(["N", "Y"]), str(rnd.randint(1000, 9999)), "CA019%04d" % rnd.randint(0, 9999),
+            neighbourhood.upper(), str(rnd.randint(17000000, 17999999))]
+
+
+def generateIncidents(path, city="Baltimore", rows=100000, extraCols=0, locationCardinality=20000, dirtyRate=0.02, seed=42):
+    if city not in _CITY_SHAPES:
+        raise ValueError("Unknown city shape {0} - use one of {1}".format(city, ", ".join(sorted(_CITY_SHAPES))))
+    shape = _CITY_SHAPES[city]
+    rnd = random.Random(seed)
+    locations = ["%d block of %s" % (rnd.randint(1, 300) * 100, rnd.choice(_STREETS)) for i in range(locationCardinality)]
+    with open(path, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(shape["columns"] + ["Extra %d" % i for i in range(extraCols)])
+        for i in range(rows):
+            row = _incidentRow(rnd, city, shape, locations, dirtyRate)
+            writer.writerow(row + ["V%d" % rnd.randint(0, 9) for j in range(extraCols)])
+    return path
+
+
+# Minimal elasticsearch stand-in - acknowledges every request, and reports every document in a _bulk request as created
+class _mockBulkHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.path.split("?")[0].endswith("/_bulk"):
+            items = []
+            lines = [l for l in body.decode("utf-8").split("\n") if l]
+            i = 0
+            while i < len(lines):
+                op = list(json.loads(lines[i]).keys())[0]
+                items.append({op: {"status": 200 if op in ("update", "delete") else 201}})
+                i += 1 if op == "delete" else 2
+            self.server.docs += len(items)
+            self.server.bytes += length
+            self._reply(200, {"took": 1, "errors": False, "items": items})
+        else:
+            self._reply(200, {"acknowledged": True})
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class _mockBulkServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class benchmark(object):
+
+    def __init__(self, hiveContext, workDir, resultsPath=None):
+        self.hc = hiveContext
+        self.workDir = os.path.abspath(workDir)
+        self.resultsPath = resultsPath
+        self.runId = uuid.uuid4().hex[:12]
+        if not os.path.isdir(self.workDir):
+            os.makedirs(self.workDir)
+
+    def run(self, city="Baltimore", rows=100000, extraCols=0, locationCardinality=20000, dirtyRate=0.02, stages=None):
+        stages = stages or _STAGES
+        shape = _CITY_SHAPES[city]
+        srcpath = os.path.join(self.workDir, "{0}-{1}-{2}.csv".format(city, rows, extraCols))
+        if not os.path.exists(srcpath):
+            start = time.time()
+            generateIncidents(srcpath, city, rows, extraCols, locationCardinality, dirtyRate)
+            print("Generated {0} rows for {1} in {2:.1f}s".format(rows, city, time.time() - start))
+        self.results = []
+        self.context = {"city": city, "rows": rows, "extraCols": extraCols, "locationCardinality": locationCardinality, "dirtyRate": dirtyRate}
+        hz = harmonizeCrimeIncidents(self.hc)
+
+        df_raw = self.hc.read.load("file://" + srcpath, format="com.databricks.spark.csv", header="true", inferSchema="false", delimiter=",")
+        df_raw = df_raw.persist()
+        if "load" in stages:
+            self._time("load", df_raw, lambda: df_raw)
+        else:
+            df_raw.count()
+
+        # renames applied one dataframe transformation at a time, as in the notebooks
+        def mapVars():
+            df = df_raw
+            for mapping in shape["varMappings"]:
+                df = hz.mapVar(df, *mapping)
+            return hz.makeValidVariableNames(df)
+        df = self._time("mapVar", None, mapVars) if "mapVar" in stages else mapVars()
+
+        # the same renames recorded and applied as a single projection
+        def deferred():
+            plan = hz.deferTransforms(df_raw)
+            for mapping in shape["varMappings"]:
+                plan.mapVar(*mapping)
+            return plan.makeValidVariableNames().finalize()
+        if "deferTransforms" in stages:
+            self._time("deferTransforms", None, deferred)
+
+        descrMappings = dict((d, d.split(" ")[0].title()) for d in shape["descriptions"])
+        if "mapValues" in stages:
+            df = self._time("mapValues", None, lambda: hz.mapValues(df, "description", descrMappings), mappings=len(descrMappings))
+            largeMappings = dict(("%d block of %s" % (n * 100, s), s.title()) for n in range(1, 301) for s in _STREETS)
+            self._time("mapValuesBroadcast", None, lambda: hz.mapValues(df, "location", largeMappings), mappings=len(largeMappings))
+        else:
+            df = hz.mapValues(df, "description", descrMappings)
+        if "geolocation" in df.columns:
+            df = df.withColumn("geolocation", regexp_replace(df["geolocation"], r'[\(\)\s]', ''))
+        else:
+            df = df.withColumn("geolocation", concat_ws(",", df["latitude"], df["longitude"]))
+        df = df.withColumn("city", lit(city))
+        df = hz.setColDataTypes(df, reportFailures=False).persist()
+        df.count()
+
+        if "buildDataDict" in stages:
+            self._time("buildDataDict", None, lambda: hz.buildDataDict(df))
+            self._time("buildDataDictExact", None, lambda: hz.buildDataDict(df, approxDistinct=False))
+
+        if "saveAsParquetTable" in stages:
+            self.hc.sql("CREATE SCHEMA IF NOT EXISTS benchmark")
+            tablepath = "file://" + os.path.join(self.workDir, "parquet")
+            self._timeAction("saveAsParquetTable", lambda: hz.saveAsParquetTable(df, "benchmark", city.lower(), tablepath))
+            self._timeAction("saveAsParquetTableSorted", lambda: hz.saveAsParquetTable(df, "benchmark", city.lower(), tablepath,
+                                                                                    sortBy=["description"], targetFileSizeMB=64))
+
+        if "saveToEs" in stages:
+            self._benchmarkEs(df, city)
+        df.unpersist()
+        df_raw.unpersist()
+        return self.results
+
+    def _benchmarkEs(self, df, city):
+        server = _mockBulkServer(("127.0.0.1", 0), _mockBulkHandler)
+        server.docs = 0
+        server.bytes = 0
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        try:
+            es = esindex("127.0.0.1", server.server_address[1], backend="http")
+            df_es = df.withColumn("datetime", df["datetime"].cast("string")) if "datetime" in df.columns else df
+            self._timeAction("saveToEs", lambda: es.saveToEs(df_es, index="{0}_harmonized".format(city.lower()), doctype="incidents"),
+                             esStats=lambda: es.lastLoadStats)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def _force(self, df):
+        # evaluates every column of every row on the executors, without moving rows to the driver
+        return df.selectExpr("COUNT(1)", "SUM(hash(%s))" % ", ".join(_sqlIdent(c) for c in df.columns)).collect()[0][0]
+
+    def _time(self, stage, df, build, **stats):
+        # times building the dataframe (driver side planning) and evaluating it, as separate measures
+        start = time.time()
+        df = build() if df is None else df
+        planned = time.time()
+        rows = self._force(df)
+        self._record(stage, time.time() - start, rows, df.columns, planSeconds=planned - start, **stats)
+        return df
+
+    def _timeAction(self, stage, action, esStats=None):
+        start = time.time()
+        action()
+        elapsed = time.time() - start
+        extra = {"esStats": esStats()} if esStats else {}
+        self._record(stage, elapsed, self.context["rows"], None, **extra)
+
+    def _record(self, stage, seconds, rows, columns, **stats):
+        record = dict(self.context)
+        record.update(stats)
+        record.update({
+            "benchmark": "harmonize",
+            "stage": stage,
+            "run": self.runId,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "sparkVersion": self.hc._sc.version,
+            "python": platform.python_version(),
+            "outputRows": rows,
+            "cols": len(columns) if columns else None,
+            "seconds": round(seconds, 3),
+            "rowsPerSec": round(rows / seconds, 1) if seconds > 0 else None
+        })
+        self.results.append(record)
+        print("{0:<26} {1:>10.3f}s {2:>14} rows/s".format(stage, seconds, record["rowsPerSec"]))
+        if self.resultsPath:
+            with open(self.resultsPath, "a") as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the harmonization pipeline on synthetic incident data")
+    parser.add_argument("--city", default="Baltimore", choices=sorted(_CITY_SHAPES))
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--extra-cols", type=int, default=0)
+    parser.add_argument("--location-cardinality", type=int, default=20000)
+    parser.add_argument("--dirty-rate", type=float, default=0.02)
+    parser.add_argument("--stages", default=",".join(_STAGES))
+    parser.add_argument("--work-dir", default="/tmp/harmonize-benchmark")
+    parser.add_argument("--results", default=None, help="json lines file results are appended to")
+    parser.add_argument("--master", default="local[*]")
+    args = parser.parse_args()
+
+    from pyspark import SparkConf, SparkContext
+    from pyspark.sql import HiveContext
+    sc = SparkContext.getOrCreate(SparkConf().setMaster(args.master).setAppName("harmonize-benchmark")
+                                  .set("spark.sql.warehouse.dir", os.path.join(args.work_dir, "warehouse")))
+    bench = benchmark(HiveContext(sc), args.work_dir, args.results)
+    bench.run(args.city, args.rows, args.extra_cols, args.location_cardinality, args.dirty_rate, args.stages.split(","))
@@ -3,26 +3,55 @@ Created on Sept 10, 2016
 @author: Bob Strahan, AWS Professional Services
 
 Wrapper to elasticsearch for indexing dataframes
+Calls to the methods below are timed and recorded by lib.instrumentation, including bulk load stats.
 
 Methods:
 
 - constructor (__init__)
-    Initialize elasticsearch interface
+    Initialize elasticsearch interface. Index management requests use pooled keep-alive HTTP connections.
     Parameters:
     - esnodes (str) - hostname and port for elasticsearch or es-proxy endpoint
     - esport (int) - port number for elasticsearch or es-proxy endpoint
+    - backend (str) - Indexing backend used by saveToEs: 
+        'hadoop' (es-hadoop EsOutputFormat, requires the es-hadoop jar) | 'http' (in-process _bulk requests from each partition)
+    - bulkBytes (int) - http backend: maximum size in bytes of a single _bulk request
+    - bulkDocs (int) - http backend: initial number of documents in a single _bulk request
+    - maxInFlight (int) - http backend: maximum concurrent _bulk requests per executor process, shared by all the
+        partition writers running in the process
+    - minBulkDocs, maxBulkDocs (int) - http backend: bounds for the adaptive _bulk batch size
+    - targetLatency (float) - http backend: _bulk latency in seconds above which batch size and concurrency are reduced
+    - maxRetries (int) - http backend: maximum retries for documents rejected with a retryable status (429, 5xx)
+    - retryWait, maxRetryWait (float) - http backend: base and maximum jittered exponential backoff in seconds
 
 - deleteIndex(self,index="*"):
     Deletes an existing index and all data in the index
     Parameters:
     - index (str) - Name of elasticsearch index to be deleted
 
-- createOrReplaceIndex(self, index, mapping=None):
+- createOrReplaceIndex(self, index, mapping=None, versioned=False):
     Creates a new index. If index already exists it will be deleted and replaced.
     The default mapping will create two copies of each string variable - one not_analysed, and one analysed to support UI text search.
+    In versioned mode the existing index is left serving searches, and a new index version is created with
+    indexing optimized settings (refresh disabled, no replicas, async translog). addTypeMapping and saveToEs calls for
+    <index> write to the new version until publishIndex() is called. Version indices are named hzv<N>_<hex of index>,
+    so index wildcards (eg the webapp's *harmonized* and *dictionary*) match only the published alias <index>, never
+    a version being built or an old version.
+    Returns the name of the created index.
     Parameters:
     - index (str) - Name of elasticsearch index to be created
     - mapping (str) - Optional JSON mapping to create fields in the index - overrides default
+    - versioned (bool) - Build a new version of the index behind the alias <index>, for zero downtime rebuilds
+
+- publishIndex(self, index, replicas=1, refreshInterval="1s", forceMerge=True, keepVersions=1):
+    Completes a versioned build started by createOrReplaceIndex(index, versioned=True). Restores search settings on the
+    new version, force merges it, atomically switches the alias <index> to it (replacing an unversioned index named
+    <index> in the same request), and deletes old versions.
+    Parameters:
+    - index (str) - Name of elasticsearch index (alias)
+    - replicas (int) - Number of replicas for the published index
+    - refreshInterval (str) - Refresh interval for the published index
+    - forceMerge (bool) - Force merge the new version to a single segment before publishing
+    - keepVersions (int) - Number of most recent versions to keep, including the published one
 
 - addTypeMapping(self, index, doctype, mapping):
     Adds an optional mapping for a doc type in an existing index. 
@@ -32,39 +61,481 @@ Methods:
     - doctype (str) - Name of elasticsearch doctype
     - mapping (str) - JSON mapping for the doctype  
     
-- saveToEs(self,dflist,index,doctype):
+- saveToEs(self,dflist,index,doctype,deadLetterPath=None,idCol=None,idExpr=None,mode="index",versionCol=None):
     Saves a spark data frame to a target elasticsearch index/doctype
+    With the http backend, batch size and concurrency adapt to cluster backpressure, only the documents that failed
+    inside a bulk response are retried, and load throughput and retry counts are reported when the load finishes.
+    With a document id (idCol or idExpr) re-running or retrying a load replaces documents instead of duplicating them.
     Parameters:
     - dflist (dataframe, or list of dataframes) - spark dataframe(s) to index
     - index (str) - Name of elasticsearch index
     - doctype (str) - Name of elasticsearch doctype
+    - deadLetterPath (str) - http backend: path (eg S3 prefix) where documents that still fail after retries are saved
+        as json lines, instead of failing the job
+    - idCol (str) - Optional column holding a stable document id, eg hz_docid
+    - idExpr (str or column) - Optional SQL expression (or column) computing the document id instead of idCol,
+        eg "sha2(concat_ws('|', city, datetime, location, description), 256)" - the id is not added to the document
+    - mode (str) - index (create or replace) | create (skip existing documents) | update (merge into existing documents)
+        | upsert (update, or create if missing) | delete. update, upsert and delete require an id.
+    - versionCol (str) - Optional numeric, timestamp or date column used as an external document version, so a write
+        older than the indexed document (eg an out of order retry) is skipped instead of overwriting newer data.
+        Not supported by elasticsearch for update and upsert.
+
+- indexRollups(self, rollups, prefix, versioned=True):
+    Indexes the rollup dataframes returned by harmonizeCrimeIncidents.buildRollups() into dedicated indices named
+    <prefix>_rollup_<name> (doctype "rollup"), with rollup_id document ids and geo_point / date mappings.
+    Dashboards and the search UI aggregate these with a sum of the incidents field, instead of counting raw incidents.
+    Parameters:
+    - rollups (dict) - Map of rollup name to dataframe, from buildRollups()
+    - prefix (str) - Index name prefix, eg the city name
+    - versioned (bool) - Build new versions of the indices and publish them when complete, see createOrReplaceIndex()
+
+- indexMergedDataDict(self, merged, index="fieldcatalog"):
+    Saves a merged cross-city dictionary from harmonizeCrimeIncidents.mergeDataDicts() as the single document
+    <index>/catalog/current, so the search UI can load all fields and vargroups with one GET instead of a search across
+    the *_dictionary indices, and check the etag to reuse a cached copy. The index name must not match *dictionary*.
+    Parameters:
+    - merged (dict) - Merged dictionary from mergeDataDicts()
+    - index (str) - Name of elasticsearch index
+
+- deleteFromEs(self, df, index, doctype, idCol=None, deadLetterPath=None, idExpr=None, versionCol=None):
+    Deletes documents from a target elasticsearch index/doctype by document id, using the in-process bulk writer.
+    Deletes of missing documents are not errors, so deletes can be safely retried.
+    Parameters:
+    - df (dataframe) - spark dataframe containing the ids of the documents to delete
+    - index (str) - Name of elasticsearch index
+    - doctype (str) - Name of elasticsearch doctype
+    - idCol (str) - Column holding the document id
+    - deadLetterPath (str) - Optional path where deletes that still fail after retries are saved as json lines
+    - idExpr (str or column) - Optional SQL expression (or column) computing the document id instead of idCol
+    - versionCol (str) - Optional external version column - documents with a newer version are not deleted
     
 '''
-import subprocess
+import os
+import re
 import json
+import socket
+import tempfile
+import threading
+import zipfile
+import binascii
+import datetime
+import decimal
+import errno
+import random
+import time
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from pyspark.accumulators import AccumulatorParam
+from .instrumentation import instrumented, metrics
+from .pooling import pooled
+
+
+# type mapping for rollup indices - all other fields use the default mapping
+_ROLLUP_MAPPING = """
+{
+    "properties": {
+        "geolocation": {"type": "geo_point"},
+        "datetime": {"type": "date", "format": "yyyy-MM-dd HH:mm:ss"},
+        "incidents": {"type": "long"}
+    }
+}
+"""
+
+# mapping for the merged dictionary document - stored for retrieval, fields and vargroups are not indexed
+_CATALOG_MAPPING = """
+{
+    "mappings": {
+        "catalog": {
+            "properties": {
+                "etag": {"type": "string", "index": "not_analyzed"},
+                "cities": {"type": "string", "index": "not_analyzed"},
+                "fields": {"type": "object", "enabled": false},
+                "vargroups": {"type": "object", "enabled": false}
+            }
+        }
+    }
+}
+"""
+
+
+def _jsonDefault(value):
+    # serialize spark row values that json does not handle natively
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if hasattr(value, "asDict"):
+        return value.asDict(recursive=True)
+    raise TypeError("Value %r is not JSON serializable" % (value,))
+
+
+def _resendable(e):
+    # a kept-alive connection the server closed before reading the request: no response bytes, or reset / broken pipe
+    # on send. Anything else (eg a read timeout) may come after the request was processed - resending a _bulk request
+    # would index documents without ids twice.
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, getattr(httplib, "RemoteDisconnected", ())):
+        return True
+    if isinstance(e, httplib.BadStatusLine):
+        return e.line in ("", "''")
+    return isinstance(e, socket.error) and getattr(e, "errno", None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+# Keep-alive HTTP connections to one elasticsearch endpoint - get() returns the process wide pool for an endpoint
+class esconnection(object):
+
+    @classmethod
+    def get(cls, host, port):
+        return pooled(cls, (host, int(port)), host, port)
+
+    def __init__(self, host, port, maxIdle=16, timeout=300):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxIdle)
+
+    def request(self, method, path, body=None, contentType="application/json"):
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        headers = {"Content-Type": contentType, "Connection": "keep-alive"}
+        # a pooled connection may have been closed by the server - resend once on a fresh connection, but only if
+        # the request can't have been received (see _resendable), other errors are raised to the caller
+        for attempt in range(2):
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                reused = False
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if attempt or not reused or not _resendable(e):
+                    raise
+                continue
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+            data = data.decode("utf-8")
+            try:
+                return response.status, json.loads(data)
+            except ValueError:
+                return response.status, data
+
+
+# Adaptive bulk batch size and concurrency for the bulkwriters of a process - get() returns the process wide
+# controller for an endpoint and settings, so later partitions continue from what earlier ones learned. AIMD policy:
+# both grow additively while bulk requests complete within targetLatency without rejections, and are halved when
+# elasticsearch pushes back (429 / queue full) or latency exceeds the target.
+class writecontroller(object):
+
+    @classmethod
+    def get(cls, host, port, bulkDocs=1000, minBulkDocs=100, maxBulkDocs=5000, maxInFlight=2, targetLatency=2.0):
+        settings = (bulkDocs, minBulkDocs, maxBulkDocs, maxInFlight, targetLatency)
+        return pooled(cls, (host, int(port)) + settings, *settings)
+
+    def __init__(self, bulkDocs=1000, minBulkDocs=100, maxBulkDocs=5000, maxInFlight=2, targetLatency=2.0):
+        self.bulkDocs = bulkDocs
+        self.minBulkDocs = minBulkDocs
+        self.maxBulkDocs = maxBulkDocs
+        self.concurrency = maxInFlight
+        self.maxInFlight = maxInFlight
+        self.targetLatency = targetLatency
+        self.inFlight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        # block until the number of outstanding bulk requests is below the current concurrency limit
+        with self.cond:
+            while self.inFlight >= self.concurrency:
+                self.cond.wait()
+            self.inFlight += 1
+
+    def release(self):
+        with self.cond:
+            self.inFlight -= 1
+            self.cond.notify_all()
+
+    def record(self, latency, rejected):
+        with self.cond:
+            if rejected or latency > self.targetLatency:
+                self.bulkDocs = max(self.minBulkDocs, self.bulkDocs // 2)
+                self.concurrency = max(1, self.concurrency // 2)
+            else:
+                self.bulkDocs = min(self.maxBulkDocs, self.bulkDocs + self.minBulkDocs)
+                self.concurrency = min(self.maxInFlight, self.concurrency + 1)
+            self.cond.notify_all()
+
+
+# Worker threads sending the _bulk requests of all bulkwriters in a process, so at most maxInFlight requests are
+# outstanding whatever the number of tasks - get() returns the process wide pool for an endpoint
+class senderpool(object):
+
+    @classmethod
+    def get(cls, host, port, maxInFlight):
+        return pooled(cls, (host, int(port), maxInFlight), maxInFlight)
+
+    def __init__(self, maxInFlight):
+        self.tasks = queue.Queue()
+        self.workers = []
+        for i in range(maxInFlight):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, fn, *args):
+        self.tasks.put((fn, args))
+
+    def _work(self):
+        while True:
+            fn, args = self.tasks.get()
+            try:
+                fn(*args)
+            except Exception:
+                pass  # tasks report their own errors
+
+
+# Bulk load counters kept by each bulkwriter, and summed over all partitions on the driver
+_BULK_STATS = ("docs", "bytes", "requests", "retries", "rejected", "failed", "skipped")
+
+
+# Buffers documents as UTF-8 encoded _bulk NDJSON (bulkBytes bounds the encoded request body), and sends batches
+# through the senderpool, keeping at most the controller's current concurrency of bulk requests outstanding.
+# Documents rejected with a retryable status are resent individually with jittered exponential backoff;
+# documents that still fail after maxRetries (or fail with a non-retryable error) are collected in deadLetters.
+# With skipConflicts, version conflicts (409) are counted as skipped rather than failed - a create of an existing
+# document, or an externally versioned write older than the indexed document, has already been applied.
+class bulkwriter(object):
+
+    RETRYABLE = (429, 500, 502, 503, 504)
+
+    def __init__(self, host, port, index, doctype, bulkBytes=5*1024*1024, controller=None,
+                 maxRetries=8, retryWait=0.5, maxRetryWait=30.0, skipConflicts=False):
+        self.conn = esconnection.get(host, port)
+        self.index = index
+        self.doctype = doctype
+        self.bulkBytes = bulkBytes
+        self.controller = controller or writecontroller.get(host, port)
+        self.maxRetries = maxRetries
+        self.retryWait = retryWait
+        self.maxRetryWait = maxRetryWait
+        self.skipConflicts = skipConflicts
+        self.sender = senderpool.get(host, port, self.controller.maxInFlight)
+        self.pending = 0
+        self.pendingCond = threading.Condition()
+        self.stats = dict((k, 0) for k in _BULK_STATS)
+        self.errors = []
+        self.deadLetters = []
+        self.buf = []
+        self.bufBytes = 0
+
+    def add(self, doc, docid=None, op="index", version=None):
+        # op is the write mode - index | create | update | upsert | delete. Without a docid elasticsearch assigns a
+        # random id (index and create only). A version is sent as an external version.
+        meta = {"_index": self.index, "_type": self.doctype}
+        if docid is not None:
+            meta["_id"] = docid
+        if version is not None:
+            meta["_version"] = version
+            meta["_version_type"] = "external"
+        if op == "upsert":
+            action = json.dumps({"update": meta})
+            source = json.dumps({"doc": doc, "doc_as_upsert": True}, default=_jsonDefault)
+        elif op == "update":
+            action = json.dumps({"update": meta})
+            source = json.dumps({"doc": doc}, default=_jsonDefault)
+        elif op == "delete":
+            action = json.dumps({"delete": meta})
+            source = None
+        else:
+            action = json.dumps({op: meta})
+            source = json.dumps(doc, default=_jsonDefault)
+        line = (action.encode("utf-8"), source.encode("utf-8") if source is not None else None)
+        nbytes = len(line[0]) + len(line[1] or b"") + 2
+        # send the buffer first if this document would take the request body over bulkBytes
+        if self.buf and self.bufBytes + nbytes > self.bulkBytes:
+            self.flush()
+        self.buf.append(line)
+        self.bufBytes += nbytes
+        if len(self.buf) >= self.controller.bulkDocs or self.bufBytes >= self.bulkBytes:
+            self.flush()
+
+    def count(self, key, n=1):
+        with self.pendingCond:
+            self.stats[key] += n
+
+    def flush(self):
+        if not self.buf:
+            return
+        lines = self.buf
+        self.buf = []
+        self.bufBytes = 0
+        self.controller.acquire()
+        with self.pendingCond:
+            self.pending += 1
+        self.sender.submit(self._send, lines)
+
+    def _backoff(self, attempt):
+        # "full jitter" exponential backoff
+        time.sleep(random.uniform(0, min(self.maxRetryWait, self.retryWait * (2 ** attempt))))
+
+    def _post(self, lines):
+        # returns list of (line, status, error) for documents that were not indexed
+        body = b"".join(line[0] + b"\n" + line[1] + b"\n" if line[1] is not None else line[0] + b"\n" for line in lines)
+        start = time.time()
+        try:
+            status, response = self.conn.request("POST", "/_bulk", body, "application/x-ndjson")
+        except Exception as e:
+            status, response = 503, str(e)
+        latency = time.time() - start
+        if status >= 300:
+            failed = [(line, status, response) for line in lines]
+        elif response.get("errors"):
+            failed = []
+            for line, item in zip(lines, response["items"]):
+                result = list(item.values())[0]
+                if "error" in result:
+                    failed.append((line, result.get("status", 500), result["error"]))
+        else:
+            failed = []
+        rejected = len([f for f in failed if f[1] == 429])
+        self.controller.record(latency, rejected)
+        self.count("requests")
+        self.count("bytes", len(body))
+        self.count("rejected", rejected)
+        return failed
+
+    def _send(self, lines):
+        try:
+            attempt = 0
+            while lines:
+                failed = self._post(lines)
+                if self.skipConflicts:
+                    skipped = len([f for f in failed if f[1] == 409])
+                    failed = [f for f in failed if f[1] != 409]
+                    self.count("skipped", skipped)
+                else:
+                    skipped = 0
+                self.count("docs", len(lines) - len(failed) - skipped)
+                lines = [f[0] for f in failed if f[1] in self.RETRYABLE]
+                dead = [f for f in failed if f[1] not in self.RETRYABLE]
+                if lines and attempt >= self.maxRetries:
+                    dead += [f for f in failed if f[1] in self.RETRYABLE]
+                    lines = []
+                if dead:
+                    self.count("failed", len(dead))
+                    self.deadLetters += [json.dumps({"action": json.loads(f[0][0].decode("utf-8")),
+                                                     "doc": json.loads((f[0][1] or b"null").decode("utf-8")),
+                                                     "status": f[1], "error": f[2]}) for f in dead]
+                if lines:
+                    attempt += 1
+                    self.count("retries", len(lines))
+                    self._backoff(attempt)
+        except Exception as e:
+            self.errors.append(str(e))
+        finally:
+            self.controller.release()
+            with self.pendingCond:
+                self.pending -= 1
+                self.pendingCond.notify_all()
+
+    def close(self):
+        self.flush()
+        # wait for this writer's batches - other writers may still be using the sender pool
+        with self.pendingCond:
+            while self.pending:
+                self.pendingCond.wait()
+        if self.errors:
+            raise ValueError("Failed bulk indexing to elasticsearch: %s" % self.errors[0])
+        return self.deadLetters
+
+
+# Accumulates the bulkwriter stats dicts from all partitions back to the driver
+class _statsAccumulatorParam(AccumulatorParam):
+
+    def zero(self, value):
+        return dict((k, 0) for k in value)
+
+    def addInPlace(self, v1, v2):
+        for k in v2:
+            v1[k] = v1.get(k, 0) + v2[k]
+        return v1
+
+
+def _bulkIndexPartition(rows, host, port, index, doctype, settings, stats, idCol=None, op="index", versionCol=None, dropCols=()):
+    controller = writecontroller.get(host, port, settings["bulkDocs"], settings["minBulkDocs"], settings["maxBulkDocs"],
+                                     settings["maxInFlight"], settings["targetLatency"])
+    writer = bulkwriter(host, port, index, doctype, settings["bulkBytes"], controller,
+                        settings["maxRetries"], settings["retryWait"], settings["maxRetryWait"],
+                        skipConflicts=(op == "create" or versionCol is not None))
+    for row in rows:
+        doc = row.asDict(recursive=True)
+        docid = doc[idCol] if idCol else None
+        version = doc[versionCol] if versionCol else None
+        for c in dropCols:
+            del doc[c]
+        writer.add(doc, docid, op, version)
+    deadLetters = writer.close()
+    stats.add(writer.stats)
+    return deadLetters
 
 
 class esindex(object):
 
-    def __init__(self,esnodes='localhost',esport=9200):
+    def __init__(self,esnodes='localhost',esport=9200,backend='hadoop',bulkBytes=5*1024*1024,bulkDocs=1000,maxInFlight=2,
+                 minBulkDocs=100,maxBulkDocs=5000,targetLatency=2.0,maxRetries=8,retryWait=0.5,maxRetryWait=30.0):
         self.esnodes = esnodes
         self.esport = str(esport)
+        self.backend = backend
+        self.bulkSettings = {
+            "bulkBytes": bulkBytes,
+            "bulkDocs": bulkDocs,
+            "minBulkDocs": minBulkDocs,
+            "maxBulkDocs": maxBulkDocs,
+            "maxInFlight": maxInFlight,
+            "targetLatency": targetLatency,
+            "maxRetries": maxRetries,
+            "retryWait": retryWait,
+            "maxRetryWait": maxRetryWait
+        }
+        self.lastLoadStats = None
+        self.pendingIndex = {}
+        # versioned builds may be started and published from several threads (eg harmonizeCities)
+        self.pendingLock = threading.Lock()
+        self.conn = esconnection.get(esnodes, esport)
 
+    @instrumented
     def deleteIndex(self,index="*"):
         index=index.lower()
-        es_url='http://%s:%s/%s' % (self.esnodes, self.esport, index)
-        cmd = 'curl -XDELETE \'%s\'' % es_url
-        response = subprocess.check_output(cmd, shell=True)
-        if "index_not_found_exception" in response:
+        status, response = self.conn.request("DELETE", "/%s" % index)
+        if status == 404 and "index_not_found_exception" in json.dumps(response):
             print("No existing elasticsearch index (%s)" % index)
-        elif '{"acknowledged":true}' not in response:
+        elif not (isinstance(response, dict) and response.get("acknowledged") == True):
             raise ValueError('Failed setting ElasticSearch Default Mapping Template') 
         else:
             print ('Deleted existing elasticsearch documents (%s)' % index)
 
-    def createOrReplaceIndex(self, index, mapping=None):
-        self.deleteIndex(index)
+    @instrumented
+    def createOrReplaceIndex(self, index, mapping=None, versioned=False):
         index=index.lower()
+        if not versioned:
+            # an unpublished versioned build (eg aborted by an error) must not keep receiving writes for <index>
+            with self.pendingLock:
+                self.pendingIndex.pop(index, None)
+            self.deleteIndex(index)
         # strings preserved as not_analyzed, plus additional "split" index using the
         # standard string analyzer to support case insensitive text substring queries 
         default_mapping =  """
@@ -97,43 +568,228 @@ class esindex(object):
         """
         if not mapping:
             mapping=default_mapping
-        cmd = 'curl -XPUT \'http://{0}:{1}/{2}\' -d \'{3}\''.format(self.esnodes, self.esport, index, mapping)
-        response_json = subprocess.check_output(cmd, shell=True)
-        print ('Create index <{0}> response: {1}'.format(index, response_json))
-        response = json.loads(response_json)
-        if not ('acknowledged' in response and response['acknowledged'] == True):
+        if versioned:
+            # build into a new version with indexing optimized settings - the alias <index> keeps
+            # pointing at the previous version until publishIndex() is called
+            versions = self._indexVersions(index)
+            target = self._versionName(index, (max(versions) if versions else 0) + 1)
+            body = json.loads(mapping)
+            body.setdefault("settings", {}).setdefault("index", {}).update({
+                "refresh_interval": "-1",
+                "number_of_replicas": 0,
+                "translog": {"durability": "async"}
+            })
+            mapping = json.dumps(body)
+            with self.pendingLock:
+                self.pendingIndex[index] = target
+        else:
+            target = index
+        status, response = self.conn.request("PUT", "/%s" % target, mapping)
+        print ('Create index <{0}> response: {1}'.format(target, json.dumps(response)))
+        if not (isinstance(response, dict) and 'acknowledged' in response and response['acknowledged'] == True):
             raise ValueError('Failed setting ElasticSearch Default Mapping Template')
+        return target
 
-    def addTypeMapping(self, index, doctype, mapping):
+    @instrumented
+    def publishIndex(self, index, replicas=1, refreshInterval="1s", forceMerge=True, keepVersions=1):
         index=index.lower()
-        cmd = 'curl -XPUT \'http://{0}:{1}/{2}/_mapping/{3}\' -d \'{4}\''.format(self.esnodes, self.esport, index, doctype, mapping)
-        response_json = subprocess.check_output(cmd, shell=True)
-        print ('Add type mapping for <{0}.{1}> response: {2}'.format(index, doctype, response_json))
-        response = json.loads(response_json)
-        if not ('acknowledged' in response and response['acknowledged'] == True):
+        with self.pendingLock:
+            target = self.pendingIndex.get(index)
+        if target is None:
+            raise ValueError('No versioned build of index <%s> to publish' % index)
+        # restore search settings, and merge segments while the new version is not yet serving queries
+        settings = {"index": {"refresh_interval": refreshInterval, "number_of_replicas": replicas, "translog.durability": "request"}}
+        status, response = self.conn.request("PUT", "/%s/_settings" % target, json.dumps(settings))
+        if status >= 300:
+            raise ValueError('Failed restoring settings for index <%s>: %s' % (target, json.dumps(response)))
+        if forceMerge:
+            print("Force merging index <%s>" % target)
+            status, response = self.conn.request("POST", "/%s/_forcemerge?max_num_segments=1" % target)
+            if status >= 300:
+                raise ValueError('Failed force merging index <%s>: %s' % (target, json.dumps(response)))
+        self.conn.request("POST", "/%s/_refresh" % target)
+        # atomically move the alias from previous versions to the new version - an unversioned index with the alias
+        # name (from a non-versioned build) is removed in the same request, so searches never see a missing index
+        status, response = self.conn.request("GET", "/_alias/%s" % index)
+        if status == 404 and self.conn.request("HEAD", "/%s" % index)[0] == 200:
+            actions = [{"remove_index": {"index": index}}]
+        else:
+            actions = [{"remove": {"index": name, "alias": index}} for name in (response if status == 200 else {})]
+        actions.append({"add": {"index": target, "alias": index}})
+        status, response = self.conn.request("POST", "/_aliases", json.dumps({"actions": actions}))
+        if not (isinstance(response, dict) and response.get('acknowledged') == True):
+            raise ValueError('Failed switching alias <%s> to index <%s>: %s' % (index, target, json.dumps(response)))
+        print("Alias <%s> now points to index <%s>" % (index, target))
+        with self.pendingLock:
+            del self.pendingIndex[index]
+        # garbage collect old versions, keeping the most recent keepVersions (including the new one)
+        versions = sorted(self._indexVersions(index), reverse=True)
+        for v in versions[max(keepVersions, 1):]:
+            self.deleteIndex(self._versionName(index, v))
+
+    def _versionName(self, index, version):
+        # hex encoding the index name keeps its words (eg harmonized) out of the version name
+        return "hzv%d_%s" % (version, binascii.hexlify(index.encode("utf-8")).decode("ascii"))
+
+    def _indexVersions(self, index):
+        suffix = self._versionName(index, 0)[len("hzv0"):]
+        status, response = self.conn.request("GET", "/hzv*%s/_settings" % suffix)
+        versions = []
+        if status == 200:
+            for name in response:
+                m = re.match(r'^hzv(\d+)%s$' % re.escape(suffix), name)
+                if m:
+                    versions.append(int(m.group(1)))
+        return versions
+
+    def _resolveIndex(self, index):
+        # name of the index to write to - the pending version if a versioned build is in progress
+        index=index.lower()
+        with self.pendingLock:
+            return self.pendingIndex.get(index, index)
+
+    @instrumented
+    def addTypeMapping(self, index, doctype, mapping):
+        index=self._resolveIndex(index)
+        status, response = self.conn.request("PUT", "/%s/_mapping/%s" % (index, doctype), mapping)
+        print ('Add type mapping for <{0}.{1}> response: {2}'.format(index, doctype, json.dumps(response)))
+        if not (isinstance(response, dict) and 'acknowledged' in response and response['acknowledged'] == True):
             raise ValueError('Failed setting ElasticSearch mapping')
                   
-    def saveToEs(self,dflist,index,doctype):
-        index=index.lower()
+    @instrumented
+    def saveToEs(self,dflist,index,doctype,deadLetterPath=None,idCol=None,idExpr=None,mode="index",versionCol=None):
+        index=self._resolveIndex(index)
         c=0
         if type(dflist) is not list:
             dflist = [dflist]
         for df in dflist:
-            rdd = df.rdd.map(lambda row: ('key', row.asDict()))
-            es_conf = {
-                "es.nodes" : self.esnodes,
-                "es.port" : self.esport,
-                "es.nodes.wan.only" : "true",
-                "es.resource" : "%s/%s" % (index, doctype),
-                "es.batch.write.retry.count" : "50",
-                "es.batch.write.retry.wait" : "20"
-                }
-            rdd.saveAsNewAPIHadoopFile(
-                path='-',
-                outputFormatClass="org.elasticsearch.hadoop.mr.EsOutputFormat",
-                keyClass="org.apache.hadoop.io.NullWritable",
-                valueClass="org.elasticsearch.hadoop.mr.LinkedMapWritable",
-                conf=es_conf
-                )
+            self._writeToEs(df, index, doctype, deadLetterPath, idCol, idExpr, mode, versionCol)
             c=c+1
             print("Dataset %d saved to elasticsearch <%s/%s>" % (c, index, doctype))
+
+    @instrumented
+    def indexRollups(self, rollups, prefix, versioned=True):
+        for name in sorted(rollups):
+            index = "{0}_rollup_{1}".format(prefix.lower(), name)
+            self.createOrReplaceIndex(index, versioned=versioned)
+            self.addTypeMapping(index, "rollup", _ROLLUP_MAPPING)
+            self.saveToEs(rollups[name], index=index, doctype="rollup", idCol="rollup_id")
+            if versioned:
+                self.publishIndex(index)
+
+    @instrumented
+    def indexMergedDataDict(self, merged, index="fieldcatalog"):
+        index=index.lower()
+        if self.conn.request("HEAD", "/%s" % index)[0] != 200:
+            status, response = self.conn.request("PUT", "/%s" % index, _CATALOG_MAPPING)
+            if not (isinstance(response, dict) and response.get('acknowledged') == True):
+                raise ValueError('Failed creating index <%s>: %s' % (index, json.dumps(response)))
+        status, response = self.conn.request("PUT", "/%s/catalog/current?refresh=true" % index, json.dumps(merged, default=str))
+        if status >= 300:
+            raise ValueError('Failed indexing merged dictionary to <%s>: %s' % (index, json.dumps(response)))
+        print("Merged dictionary (etag %s) saved to elasticsearch <%s/catalog/current>" % (merged["etag"], index))
+
+    @instrumented
+    def deleteFromEs(self, df, index, doctype, idCol=None, deadLetterPath=None, idExpr=None, versionCol=None):
+        index=self._resolveIndex(index)
+        self._writeToEs(df, index, doctype, deadLetterPath, idCol, idExpr, "delete", versionCol)
+        print("Deleted documents from elasticsearch <%s/%s>" % (index, doctype))
+
+    def _writeToEs(self, df, index, doctype, deadLetterPath=None, idCol=None, idExpr=None, mode="index", versionCol=None):
+        if mode not in ("index", "create", "update", "upsert", "delete"):
+            raise ValueError("Unknown elasticsearch write mode: %s" % mode)
+        if mode in ("update", "upsert", "delete") and not (idCol or idExpr):
+            raise ValueError("Write mode %s needs an idCol or idExpr" % mode)
+        if versionCol and mode in ("update", "upsert"):
+            raise ValueError("External versioning is not supported by elasticsearch for write mode %s" % mode)
+        # generated id and version values are written to hidden columns, which are not indexed
+        hidden = []
+        if idExpr is not None:
+            df = df.withColumn("hz_esid", idExpr) if hasattr(idExpr, "alias") else df.selectExpr("*", "(%s) AS hz_esid" % idExpr)
+            idCol = "hz_esid"
+            hidden.append(idCol)
+        if versionCol:
+            # external versions are longs - timestamps and dates are converted to epoch milliseconds
+            coltype = dict(df.dtypes)[versionCol]
+            if coltype in ("timestamp", "date"):
+                versionExpr = "CAST(CAST(CAST(`%s` AS TIMESTAMP) AS DOUBLE) * 1000 AS BIGINT)" % versionCol
+            else:
+                versionExpr = "CAST(`%s` AS BIGINT)" % versionCol
+            df = df.selectExpr("*", "%s AS hz_esversion" % versionExpr)
+            versionCol = "hz_esversion"
+            hidden.append(versionCol)
+        if mode == "delete":
+            # deletes always use the in-process bulk writer - es-hadoop does not support delete operations
+            df = df.select(*[c for c in (idCol, versionCol) if c])
+            self._saveToEsHttp(df, index, doctype, deadLetterPath, idCol, "delete", versionCol, hidden)
+        elif self.backend == 'http':
+            self._saveToEsHttp(df, index, doctype, deadLetterPath, idCol, mode, versionCol, hidden)
+        else:
+            self._saveToEsHadoop(df, index, doctype, idCol, mode, versionCol, hidden)
+
+    def _saveToEsHadoop(self, df, index, doctype, idCol=None, mode="index", versionCol=None, hidden=()):
+        # nested rows (eg a geolocation struct) are converted to dicts too, as the writable converter can't map Rows
+        rdd = df.rdd.map(lambda row: ('key', row.asDict(recursive=True)))
+        es_conf = {
+            "es.nodes" : self.esnodes,
+            "es.port" : self.esport,
+            "es.nodes.wan.only" : "true",
+            "es.resource" : "%s/%s" % (index, doctype),
+            "es.batch.write.retry.count" : "50",
+            "es.batch.write.retry.wait" : "20",
+            "es.write.operation" : mode
+            }
+        if idCol:
+            es_conf["es.mapping.id"] = idCol
+        if versionCol:
+            es_conf["es.mapping.version"] = versionCol
+            es_conf["es.mapping.version.type"] = "external"
+        if hidden:
+            es_conf["es.mapping.exclude"] = ",".join(hidden)
+        rdd.saveAsNewAPIHadoopFile(
+            path='-',
+            outputFormatClass="org.elasticsearch.hadoop.mr.EsOutputFormat",
+            keyClass="org.apache.hadoop.io.NullWritable",
+            valueClass="org.elasticsearch.hadoop.mr.LinkedMapWritable",
+            conf=es_conf
+            )
+
+    def _saveToEsHttp(self, df, index, doctype, deadLetterPath=None, idCol=None, op="index", versionCol=None, hidden=()):
+        sc = df.rdd.context
+        self._shipToExecutors(sc)
+        host, port, settings = self.esnodes, self.esport, self.bulkSettings
+        stats = sc.accumulator(dict((k, 0) for k in _BULK_STATS), _statsAccumulatorParam())
+        start = time.time()
+        writer = lambda rows: _bulkIndexPartition(rows, host, port, index, doctype, settings, stats, idCol, op, versionCol, hidden)
+        if deadLetterPath:
+            # documents that could not be indexed are saved as json lines instead of failing the job
+            deadLetterPath = "%s/%s/%s" % (deadLetterPath, index, time.strftime("%Y%m%d-%H%M%S"))
+            df.rdd.mapPartitions(writer).saveAsTextFile(deadLetterPath)
+        else:
+            df.rdd.foreachPartition(writer)
+        elapsed = max(time.time() - start, 0.001)
+        totals = dict(stats.value, elapsed=elapsed)
+        print("Indexed %d docs in %.1fs (%.0f docs/s, %.2f MB/s) - %d bulk requests, %d rejected, %d retried, %d skipped, %d failed" % (
+            totals["docs"], elapsed, totals["docs"] / elapsed, totals["bytes"] / elapsed / (1024*1024),
+            totals["requests"], totals["rejected"], totals["retries"], totals["skipped"], totals["failed"]))
+        self.lastLoadStats = totals
+        metrics.add(rows=totals["docs"], bytesWritten=totals["bytes"], docs=totals["docs"], requests=totals["requests"],
+                    rejected=totals["rejected"], retries=totals["retries"], skipped=totals["skipped"], failed=totals["failed"])
+        if totals["failed"]:
+            if deadLetterPath:
+                print("%d failed documents saved to %s" % (totals["failed"], deadLetterPath))
+            else:
+                raise ValueError("%d documents could not be saved to elasticsearch <%s/%s>" % (totals["failed"], index, doctype))
+
+    def _shipToExecutors(self, sc):
+        # executors unpickle the partition writer by reference to this package, so make sure they can import it
+        if getattr(sc, "_esindexShipped", False):
+            return
+        libdir = os.path.dirname(os.path.abspath(__file__))
+        zippath = os.path.join(tempfile.mkdtemp(), os.path.basename(libdir) + ".zip")
+        with zipfile.ZipFile(zippath, "w") as z:
+            for f in os.listdir(libdir):
+                if f.endswith(".py"):
+                    z.write(os.path.join(libdir, f), os.path.join(os.path.basename(libdir), f))
+        sc.addPyFile(zippath)
+        sc._esindexShipped = True
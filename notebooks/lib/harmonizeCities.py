@@ -0,0 +1,243 @@
+'''
+Run the harmonization pipeline for several cities concurrently in one Spark application.
+
+Each city is described by a spec (dict), and runs in its own thread and fair scheduler pool, so that dictionary
+builds, parquet writes and elasticsearch loads for different cities overlap. Start the SparkContext with
+spark.scheduler.mode=FAIR to share executors fairly between cities (pools are created on demand).
+Per city pools (and per stage metrics job groups) need py4j pinned thread mode - PYSPARK_PIN_THREAD=true, the default
+from Spark 3.2 - so that each city thread submits its jobs from its own JVM thread. Without it the constructor prints
+a warning, and cities still run concurrently, sharing the default pool.
+
+City spec keys:
+    - city (str) - City name, used for table, index and pool names
+    - source (str) - S3 path to the raw dataset
+    - readOptions (dict) - Optional options for hc.read.load() - defaults to CSV with header, all variables as strings
+    - varMappings (list) - List of [oldvar, newvar] or [oldvar, newvar, keepOrig] passed to hz.mapVar()
+    - valueMappings (dict) - Map of variable name to value mappings passed to hz.mapValues()
+    - filters (list of str) - SQL conditions - rows not matching all conditions are removed
+    - datetime (dict) - Optional keyword arguments for hz.harmonizeDateTime(), eg {"dateCol": "crimedate", "timeCol": "crimetime"}
+    - geolocation (dict) - Optional keyword arguments for hz.harmonizeGeolocation(), eg {"geoCol": "geolocation",
+        "bounds": (39.19, -76.72, 39.38, -76.52)}
+    - derived (list) - List of [variable, sql expression, transformDescr] used to add derived variables
+    - harmonize (function) - Optional function harmonize(hz, df) returning a dataframe, for city specific steps
+    - varMetadata (list of dict) - Optional keyword arguments for hz.addVarMetadata()
+    - dataMapping (str) - Optional JSON type mapping for the data index - its properties extend, or override, the default
+        mapping: geolocation as geo_point, and datetime as date (format yyyy-MM-dd HH:mm:ss), as in the notebooks
+    - rollups (bool) - Build, save and index the dashboard rollups from hz.buildRollups() - default True
+    - dedup (dict) - Optional keyword arguments for hz.dedupIncidents(), eg {"keyCols": ["datetime", "location",
+        "description"]} ({} for the defaults). Each run overwrites the city's tables and indices, so incidents are
+        deduplicated within the run only - keyIndexPath (a key index kept between runs) is not supported.
+
+Methods:
+
+- constructor (__init__)
+    Parameters:
+    - hiveContext - Shared hive context used for all cities
+    - es (esindex) - Elasticsearch interface used to index data and dictionaries
+    - outputRoot (str) - S3 bucket and prefix for harmonized output - each city is saved under <outputRoot>/<city>
+    - schema (str) - Spark SQL / Athena schema name for the data and dictionary tables
+    - maxConcurrent (int) - Maximum number of cities harmonized at the same time
+    - checkpointPath (str) - Optional S3 or local path used to materialize harmonized dataframes - by default they
+        are persisted in executor memory and disk
+
+- run(self, specs, athena_s3_staging_dir=None, grantRead=None):
+    Harmonizes, saves and indexes all cities, and returns a dict of city name to harmonizeCrimeIncidents object.
+    Athena DDL for all tables is collected in self.ddlList, and executed if athena_s3_staging_dir is given.
+    Once all cities are done, their dictionaries are merged (see hz.mergeDataDicts()), saved to
+    <outputRoot>/dictionary.json, and indexed as the fieldcatalog/catalog/current elasticsearch document.
+    Raises ValueError listing the failed cities if any city fails - other cities still complete.
+    Parameters:
+    - specs (list of dict) - City specs, as described above
+    - athena_s3_staging_dir (str) - Optional S3 path uri used by Athena - if set the Athena DDL is executed
+    - grantRead (str) - Optional grantee given read access to dictionary.json, eg
+        'uri="http://acs.amazonaws.com/groups/global/AllUsers"' for public web access - by default it is private
+'''
+
+from __future__ import print_function
+import json
+import threading
+import time
+import traceback
+try:
+    # propagates, and cleans up, the JVM thread local properties of each city thread in pinned thread mode
+    from pyspark import InheritableThread as _cityThread
+except ImportError:
+    _cityThread = threading.Thread
+from pyspark.sql.functions import expr, lit
+from .harmonizeCrimeIncidents import harmonizeCrimeIncidents
+from .instrumentation import instrumented, metrics, pinnedThreads
+
+
+# default type mapping of the data index - the webapp's map and date queries need these types
+_DATA_MAPPING = {
+    "properties": {
+        "geolocation": {"type": "geo_point"},
+        "datetime": {"type": "date", "format": "yyyy-MM-dd HH:mm:ss"}
+    }
+}
+
+
+class harmonizeCities(object):
+
+    def __init__(self, hiveContext, es, outputRoot, schema="incidents", maxConcurrent=4, checkpointPath=None):
+        self.hc = hiveContext
+        self.es = es
+        self.outputRoot = outputRoot
+        self.schema = schema
+        self.checkpointPath = checkpointPath
+        self.slots = threading.BoundedSemaphore(maxConcurrent)
+        self.ddlList = []
+        self.ddlLock = threading.Lock()
+        self.dictionaries = {}
+        # scheduler pools are JVM thread local properties - only set per city when python threads are pinned
+        self.pools = pinnedThreads(hiveContext._sc)
+        if not self.pools:
+            print("WARNING: py4j pinned thread mode is off (set PYSPARK_PIN_THREAD=true) - cities will share the default scheduler pool")
+
+    @instrumented
+    def run(self, specs, athena_s3_staging_dir=None, grantRead=None):
+        # schema is shared by all cities - create it once, instead of dropping it per city
+        self.hc.sql("CREATE SCHEMA IF NOT EXISTS {0} COMMENT 'Crime incident data'".format(self.schema))
+        self.ddlList = ["CREATE DATABASE IF NOT EXISTS `{0}`;".format(self.schema)]
+        self.dictionaries = {}
+        results = {}
+        errors = {}
+        threads = []
+        for spec in specs:
+            t = _cityThread(target=self._runCity, args=(spec, results, errors), name=spec["city"])
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if not errors:
+            hz = harmonizeCrimeIncidents(self.hc)
+            if athena_s3_staging_dir:
+                hz.executeAthenaDDL(athena_s3_staging_dir, self.ddlList)
+            # cross-city dictionary for the search UI, from the dictionaries of all cities in this run
+            merged = hz.mergeDataDicts(self.dictionaries)
+            hz.saveMergedDataDict(merged, "{0}/dictionary.json".format(self.outputRoot), grantRead=grantRead)
+            self.es.indexMergedDataDict(merged)
+        if errors:
+            raise ValueError("Harmonization failed for cities: {0}".format(", ".join(sorted(errors))))
+        return results
+
+    def _runCity(self, spec, results, errors):
+        city = spec["city"]
+        with self.slots:
+            start = time.time()
+            try:
+                # jobs submitted from this thread run in the city's fair scheduler pool
+                if self.pools:
+                    self.hc._sc.setLocalProperty("spark.scheduler.pool", city.lower())
+                with metrics.stage("harmonizeCity", component="harmonizeCities", city=city):
+                    results[city] = self._harmonizeCity(spec)
+                print("City {0} done in {1:.0f}s".format(city, time.time() - start))
+            except Exception:
+                errors[city] = traceback.format_exc()
+                print("City {0} failed:\n{1}".format(city, errors[city]))
+
+    def _harmonizeCity(self, spec):
+        city = spec["city"]
+        outputroot = "{0}/{1}".format(self.outputRoot, city)
+        hz = harmonizeCrimeIncidents(self.hc, checkpointPath=self.checkpointPath)
+        readOptions = spec.get("readOptions") or {
+            "format": "com.databricks.spark.csv",
+            "header": "true",
+            "inferSchema": "false",
+            "delimiter": ","
+        }
+        df = self.hc.read.load(spec["source"], **readOptions)
+
+        # renames and value mappings are applied as a single projection
+        plan = hz.deferTransforms(df)
+        for mapping in spec.get("varMappings", []):
+            plan.mapVar(*mapping)
+        plan.makeValidVariableNames()
+        for col, valueMappings in spec.get("valueMappings", {}).items():
+            plan.mapValues(col, valueMappings)
+        df = plan.finalize()
+
+        for cond in spec.get("filters", []):
+            df = df.where(cond)
+        if spec.get("datetime"):
+            df = hz.harmonizeDateTime(df, **spec["datetime"])
+        if spec.get("geolocation"):
+            df = hz.harmonizeGeolocation(df, **spec["geolocation"])
+        df = df.withColumn("city", lit(city))
+        hz.addTransformDescr("city", '"city" assigned by harmonization code')
+        for var, sqlexpr, transformDescr in spec.get("derived", []):
+            df = df.withColumn(var, expr(sqlexpr))
+            hz.addTransformDescr(var, transformDescr)
+        if spec.get("harmonize"):
+            df = spec["harmonize"](hz, df)
+        df = df.withColumn("rawdatapath", lit(spec["source"]))
+        hz.addTransformDescr("rawdatapath", "Assigned by harmonization code")
+        df = df.withColumn("harmonizeddatapath", lit(outputroot))
+        hz.addTransformDescr("harmonizeddatapath", "Assigned by harmonization code")
+
+        hz.addVarGroup("{0} (Unharmonized)".format(city), order=90, default=True)
+        for metadata in spec.get("varMetadata", []):
+            hz.addVarMetadata(**metadata)
+        df = hz.setColDataTypes(df)
+        if spec.get("dedup") is not None:
+            # tables and indices are overwritten - a cross run key index would drop incidents kept only by the
+            # overwritten output
+            if spec["dedup"].get("keyIndexPath"):
+                raise ValueError("dedup keyIndexPath requires appended output - harmonizeCities overwrites each city's tables")
+            df = hz.dedupIncidents(df, **spec["dedup"])
+        # computed once, and reused by the dictionary, parquet output and indexing steps
+        df = hz.materialize(df, name=city.lower())
+        try:
+            self._saveCity(hz, city, outputroot, df, spec)
+        finally:
+            hz.release()
+        return hz
+
+    def _saveCity(self, hz, city, outputroot, df, spec):
+        # the dictionary is small, but is saved twice - keep it rather than aggregating df again
+        df_dict = hz.materialize(hz.buildDataDict(df), name=city.lower() + "_dict")
+
+        # parquet tables
+        data_table = city.lower()
+        dict_table = data_table + "_dict"
+        data_table_ddl = hz.saveAsParquetTable(df, self.schema, data_table, "{0}/data".format(outputroot))
+        dict_table_ddl = hz.saveAsParquetTable(df_dict.coalesce(1), self.schema, dict_table, "{0}/dictionary".format(outputroot))
+        ddlList = [
+            "DROP TABLE IF EXISTS `{0}`.`{1}`;".format(self.schema, data_table),
+            "DROP TABLE IF EXISTS `{0}`.`{1}`;".format(self.schema, dict_table),
+            data_table_ddl,
+            dict_table_ddl
+        ]
+        # pre-aggregated counts for dashboards - small, so written as a few compact files
+        rollups = hz.buildRollups(df) if spec.get("rollups", True) else {}
+        for name in sorted(rollups):
+            rollups[name] = hz.materialize(rollups[name], name="{0}_rollup_{1}".format(data_table, name))
+            rollup_table = "{0}_rollup_{1}".format(data_table, name)
+            ddlList += [
+                "DROP TABLE IF EXISTS `{0}`.`{1}`;".format(self.schema, rollup_table),
+                hz.saveAsParquetTable(rollups[name], self.schema, rollup_table, "{0}/rollups/{1}".format(outputroot, name), targetFileSizeMB=64)
+            ]
+        with self.ddlLock:
+            self.ddlList += ddlList
+
+        # elasticsearch - versioned builds, so searches see the previous data until the new index is complete
+        es_dataindex = "{0}_harmonized".format(city.lower())
+        es_dictindex = "{0}_dictionary".format(city.lower())
+        self.es.createOrReplaceIndex(es_dataindex, versioned=True)
+        mapping = json.loads(json.dumps(_DATA_MAPPING))
+        if spec.get("dataMapping"):
+            extra = json.loads(spec["dataMapping"])
+            mapping["properties"].update(extra.pop("properties", {}))
+            mapping.update(extra)
+        self.es.addTypeMapping(es_dataindex, "incidents", json.dumps(mapping))
+        self.es.createOrReplaceIndex(es_dictindex, versioned=True)
+        if "datetime" in df.columns:
+            df = df.withColumn("datetime", df["datetime"].cast("string"))  # elasticsearch needs datetimes in a string type
+        # stable document ids, when the source was fingerprinted, so a retried load replaces rather than duplicates
+        self.es.saveToEs(df, index=es_dataindex, doctype="incidents", idCol="hz_docid" if "hz_docid" in df.columns else None)
+        self.es.saveToEs(df_dict, index=es_dictindex, doctype="dictionary", idCol="dict_field")
+        self.dictionaries[city] = [r.asDict() for r in df_dict.collect()]
+        self.es.publishIndex(es_dataindex)
+        self.es.publishIndex(es_dictindex)
+        if rollups:
+            self.es.indexRollups(rollups, city)
@@ -3,6 +3,7 @@ Created on Sept 10, 2016
 @author: Bob Strahan, AWS Professional Services
 
 Encapsulate prototype variable definitions and methods for harmonization notebooks.
+Calls to the methods below are timed and recorded by lib.instrumentation - use metrics.report() for a run summary.
 
 Methods:
 
@@ -11,6 +12,9 @@ Methods:
         (A vargroup is used categorise related attributes, and is used to create accordian folders in the UI.)
     Parameters:
     - hiveContext (stored in the object and used by other methods when needed to run hive sql queries)
+    - storageLevel (str) - Spark storage level used by materialize(), eg MEMORY_AND_DISK, MEMORY_ONLY_SER, DISK_ONLY
+    - checkpointPath (str) - Optional S3 or local path - when set, materialize() writes dataframes to parquet files
+        under this path and reads them back, instead of caching them in executor memory/disk
 
     
 - addVarGroup(self,varGroup,order,default=False)
@@ -40,12 +44,25 @@ Methods:
     - keepOrig (boolean) - By default this method replaces teh original variable. 
         Set to True to preserve the original variable in the dataframe 
 
-- mapValues(self, df, col, valueMappings):
+- mapValues(self, df, col, valueMappings, matchType="exact", broadcastThreshold=100):
     Changes the values of a variable, mapping from old value to new value
+    Exact mappings with more than broadcastThreshold values are applied as a broadcast hash join against a lookup table,
+    so the per row cost does not depend on the size of the mapping.
     Parameters:
     - df (dataframe) - Dataframe containing variables and values
     - col (str) - name of variable/column
     - valueMappings (dict) - Map of original values to new, harmonized values
+    - matchType (str) - How original values are matched:
+        exact | prefix (longest matching prefix wins) | regex (first matching pattern wins, use an OrderedDict)
+    - broadcastThreshold (int) - Number of exact mappings above which a broadcast lookup table is used
+
+- loadValueMappings(self, path, keyCol, valueCol, format="csv"):
+    Loads a value mapping for mapValues() from a csv (with header row) or parquet file, preserving file order.
+    Parameters:
+    - path (str) - S3 or local path of the mapping file(s)
+    - keyCol (str) - Column containing original values
+    - valueCol (str) - Column containing new, harmonized values
+    - format (str) - csv | parquet
 
 - addTransformDescr(self, col, transformDescr):
     Add a description of transformation, used to describe the algorithm that transformed raw data to its harmonized state.
@@ -55,32 +72,184 @@ Methods:
     - col (str) - Name of variable/column
     - transformDescr (str) - Description of transformation algorithm
 
-- setColDataTypes(self,df):
+- setColDataTypes(self, df, df_dict=None, geoPoint=True, reportFailures=False):
     Set the data types for columns - if dataframe column type doesn't match expected column type for harmonized variable, 
     cast it to enforce datatype consistency for all harmonised variables.
+    Types are derived from the variable's UI type: boolean -> int, datetime -> timestamp, integer range or enum -> the
+    narrowest integer type holding all values (eg tinyint for month), other ranges -> double. Non numeric enums,
+    numeric looking enums whose values aren't plain numbers (eg district code 007), and text variables stay strings.
+    Ranges inferred by the data dictionary (UI widget bounds, not observed values) are cast to double.
+    With reportFailures, casts that turn non empty values into nulls, or change them (eg truncated fractions,
+    overflow, dropped leading zeros), are reported, and saved in self.castFailures.
     Parameters:
     - df (dataframe) - Dataframe containing variables and values
+    - df_dict (dataframe) - Optional dictionary from buildDataDict() - its inferred types are used for variables
+        without metadata
+    - geoPoint (bool) - Convert the "latitude,longitude" geolocation string to a struct<lat:double,lon:double>,
+        which is indexed by elasticsearch as a geo_point
+    - reportFailures (bool) - Count values that fail to cast exactly - runs an extra pass over the data
 
 - makeValidVariableNames(self, df):
     Rename any variabes that have spaces or other characters not supported by parquet format. 
     Invalid chars for parquet format are: " ,;{}()\\n\\t=".
     Ensure all names are lowercase to accomodate Athena- see: http://docs.aws.amazon.com/athena/latest/ug/known-limitations.html
     Parameters:
-    - df (dataframe) - Dataframe containing variables and values        
+    - df (dataframe) - Dataframe containing variables and values
+
+- harmonizeDateTime(self, df, dateCol, timeCol=None, formats=None, vectorized=False, dropSource=True):
+    Creates the datetime, year, month, day, hour, minute and dayofweek variables from raw date and time variables.
+    Each raw value is parsed once into the datetime timestamp, and the other variables are extracted from it.
+    Unparseable values give null variables. Midnight recorded as hour 24 (eg 24:00:00 or 2400) is read as hour 00 of the following day.
+    Parameters:
+    - df (dataframe) - Dataframe containing variables and values
+    - dateCol (str) - Variable containing the date, or date and time, eg CrimeDate or crime_date
+    - timeCol (str) - Optional variable containing the time, eg CrimeTime - appended to the date, separated by a space
+    - formats (list of str) - Date patterns (Java SimpleDateFormat, eg "MM/dd/yyyy hh:mm:ss a") tried in order for
+        "<date> <time>" - the first pattern that matches a value is used. Default MM/dd/yyyy with 12 or 24 hour times
+        (hh:mm:ss a, HH:mm:ss, HH:mm or HHmm), or without a time.
+    - vectorized (bool) - Parse with a vectorized pandas UDF (Arrow batches, requires Spark 2.3+ and pyarrow) instead
+        of a native Spark expression
+    - dropSource (bool) - Drop dateCol and timeCol once parsed
+
+- harmonizeGeolocation(self, df, geoCol=None, latCol=None, lonCol=None, bounds=None, dropInvalid=True, geoPoint=True, dropSource=True):
+    Creates the geolocation variable from a raw "(latitude, longitude)" variable, or from latitude and longitude
+    variables, and validates the coordinates: missing, out of range, 0,0 and (if bounds are set) out of bounds
+    coordinates are invalid. All checks are applied in a single filter.
+    Parameters:
+    - df (dataframe) - Dataframe containing variables and values
+    - geoCol (str) - Variable containing "latitude,longitude" coordinates, with optional parentheses and spaces
+    - latCol, lonCol (str) - Latitude and longitude variables, used when geoCol is not set
+    - bounds (tuple) - Optional (minLatitude, minLongitude, maxLatitude, maxLongitude) bounding box, eg the city limits
+    - dropInvalid (bool) - Remove rows with invalid coordinates - if False, their geolocation is set to null
+    - geoPoint (bool) - Create geolocation as a struct<lat:double,lon:double> (indexed by elasticsearch as a
+        geo_point), or if False as a "latitude,longitude" string
+    - dropSource (bool) - Drop geoCol, or latCol and lonCol
+
+- deferTransforms(self, df):
+    Returns a transformBuilder that records mapVar, mapValues, makeValidVariableNames, setColDataTypes, cast, drop
+    and withColumn steps without modifying the dataframe, and applies them all as a single select() when finalize() is
+    called. This keeps the spark query plan shallow when many harmonization steps are chained.
+    Variable mappings and transform descriptions are recorded exactly as for the corresponding methods above.
+    Use builder.col(name) to reference the current expression for a variable when deriving new variables.
+    builder.setColDataTypes(df_dict=None, geoPoint=True, reportFailures=False) takes the setColDataTypes parameters.
+    Parameters:
+    - df (dataframe) - Dataframe containing variables and values
 
-- get_unique_values(self, df, col):
-    Return only the unique values of a variable - can be used to construct enum type values
+- materialize(self, df, name=None):
+    Computes a dataframe once and keeps the result, so later steps (dictionary, parquet output, indexing, counts)
+    reuse it instead of re-reading the source and replaying all transformations. Prints the row count, which is
+    computed as part of materializing. Returns the materialized dataframe - use it in place of df.
+    Parameters:
+    - df (dataframe) - Dataframe to materialize, typically the fully harmonized dataframe
+    - name (str) - Optional name for the checkpoint files (when checkpointPath is set)
+
+- release(self):
+    Unpersists all dataframes materialized by this object, and deletes their checkpoint files.
+
+- get_unique_values(self, df, col, maxValues=1000):
+    Return only the unique values of a variable, sorted by the variable's type - can be used to construct enum type values
+    At most maxValues + 1 values reach the driver, so high cardinality variables can't exhaust driver memory.
+    Raises ValueError if the variable has more than maxValues unique values.
     Parameters:
     - df (dataframe) - Dataframe containing variables and values         
     - col (str) - Variable for which to gather unique values
+    - maxValues (int) - Maximum number of values returned
+
+- profileColumns(self, df, cols=None, topK=20, sampleFraction=None, maxResults=1000):
+    Returns a dict of variable name to profile {"topK": [(value, count), ...], "distinct": n, "sampled": bool} for
+    the most frequent non null values of each variable, most frequent first. Values are compared as strings.
+    All variables are profiled in one scan - counts are partially aggregated on the executors, and each variable's
+    values are reduced to a bounded top K as they are combined (never sorted in full), so only topK values per
+    variable are returned to the driver, whatever the variable's cardinality.
+    With sampling, counts are scaled up to estimates for the whole dataframe, and distinct counts are a lower bound.
+    Parameters:
+    - df (dataframe) - Dataframe containing variables and values
+    - cols (list of str) - Variables to profile - default all variables
+    - topK (int) - Number of most frequent values returned per variable
+    - sampleFraction (float) - Optional fraction of rows sampled, eg 0.1
+    - maxResults (int) - Hard cap on the number of values returned per variable, whatever topK is
+
+- countValues(self, df, col, topK=30, otherLabel="Other"):
+    Returns plot-ready counts of the values of a variable, as a pandas Series of value to count, most frequent first,
+    eg hz.countValues(df, 'OFFENSE CATEGORY').plot(kind='bar'). Counts are computed on the executors, and only the
+    topK most frequent values are returned to the driver - less frequent values are summed as otherLabel.
+    Null values are not counted.
+    Parameters:
+    - df (dataframe) - Dataframe containing variables and values
+    - col (str) - Variable to count values of
+    - topK (int) - Number of most frequent values returned
+    - otherLabel (str) - Label for the sum of the counts of the other values, or None to leave them out
+
+- iterPandasBatches(self, df, batchRows=10000, partitionRows=None):
+    Streams the rows of a dataframe to the driver as pandas dataframes of at most batchRows rows. Partitions are
+    fetched one at a time (toLocalIterator), so driver memory holds one partition and one batch, whatever the size of
+    the dataframe - set partitionRows to bound the partition size as well.
+    Parameters:
+    - df (dataframe) - Dataframe to stream, eg a query result
+    - batchRows (int) - Maximum number of rows per pandas dataframe
+    - partitionRows (int) - Optional - repartition df into partitions of about this many rows before streaming
+        (counts df, unless it was materialized)
 
-- buildDataDict(self,df):
+- toPandasBounded(self, df, maxBytes=256*1024*1024, batchRows=10000):
+    Like df.toPandas(), but streams the rows in batches, and raises ValueError as soon as the result uses more than
+    maxBytes of driver memory, instead of the notebook kernel being killed. At most the number of rows estimated to
+    fit in maxBytes (from a sample), plus one, are fetched from the executors. Use for previews and dictionary queries,
+    and aggregate (eg countValues()) or limit larger results on the executors.
+    Parameters:
+    - df (dataframe) - Dataframe to return, eg a query result
+    - maxBytes (int) - Memory ceiling for the pandas result, in bytes
+    - batchRows (int) - Number of rows converted to pandas at a time
+
+- buildDataDict(self, df, approxDistinct=True, rsd=0.05, enumMaxValues=0):
     Builds and returns a new datframe containing a data dictionary with one row per variable from the input dataframe.
     The dictionary contains summary stats and descriptions for each variable, and metadata used by the search UI
+    Stats for all variables are computed in a single aggregation pass over the dataframe. dict_min and dict_max are
+    doubles, set for numeric variables only.
+    Use df_dict.coalesce(1) when saving the dictionary if a single output file is needed.
     Parameters:
     - df (dataframe) - Dataframe containing variables and values          
+    - approxDistinct (bool) - Use HyperLogLog++ approximate distinct counts - if False, exact distinct counts are
+        computed with one extra distinct() job per variable
+    - rsd (float) - Maximum relative standard deviation allowed for approximate distinct counts
+    - enumMaxValues (int) - If set, string variables without metadata and with at most this many distinct values are
+        given an enum,v1,v2,... type (profiled with profileColumns(), one extra scan for all variables)
+
+- mergeDataDicts(self, dicts):
+    Merges the dictionaries of several cities into a single cross-city dictionary, returned as a dict (JSON
+    serializable) with the keys:
+    - "fields" - one entry per variable, with the dict_* attributes of buildDataDict(): counts summed, mean and
+        stddev pooled, min and max across cities, dict_countdistinct the largest city count (a lower bound), and the
+        widget type resolved across cities (ranges widened, enum values combined, text if types conflict).
+        Per city stats are kept in dict_cities.
+    - "vargroups" - the variable groups in UI display order, with display names
+    - "cities" - the merged cities
+    - "etag" - hash of the content, unchanged while the dictionaries are unchanged - use it to cache the dictionary
+    Parameters:
+    - dicts (dict) - Map of city name to dictionary dataframe from buildDataDict() (or a list of its rows as dicts)
+
+- saveMergedDataDict(self, merged, s3path, endpointUrl=None, grantRead=None):
+    Saves a merged dictionary as a single JSON object in S3 (skipped if unchanged), and returns its etag.
+    The S3 object's ETag is the MD5 of its content, so HTTP clients can cache it with If-None-Match.
+    Parameters:
+    - merged (dict) - Merged dictionary from mergeDataDicts()
+    - s3path (str) - Target S3 path, eg s3://bucket/crimedata/harmonized/dictionary.json
+    - endpointUrl (str) - Optional S3 endpoint URL, eg for a local S3 compatible server
+    - grantRead (str) - Optional grantee given read access to the object, eg
+        'uri="http://acs.amazonaws.com/groups/global/AllUsers"' for public web access - by default it is private
 
-- saveAsParquetTable(self,df,schema,table,s3path):
+- buildRollups(self, df, timeDimensions=None, geoDimensions=None, geohashPrecision=7):
+    Returns a dict of small pre-aggregated dataframes for dashboard and search UI aggregations, each with an incidents
+    count and a stable rollup_id key, to be saved with saveAsParquetTable() and indexed with esindex.indexRollups():
+    - "time" - counts by city, description and date/time parts, with datetime truncated to the hour
+    - "geo" - counts by geohash cell, with the cell's incident centroid as geolocation (a lat/lon struct)
+    Only dimensions present in df are used. Geohashes are computed from coordinates rounded to 4 decimals (about 10m).
+    Parameters:
+    - df (dataframe) - Harmonized dataframe
+    - timeDimensions (list of str) - Default city, description, year, month, day, hour, dayofweek
+    - geoDimensions (list of str) - Dimensions kept in the geo rollup besides the geohash - default city, description, year
+    - geohashPrecision (int) - Geohash length of the geo rollup cells, eg 5 (about 5km) to 8 (about 40m)
+
+- saveAsParquetTable(self,df,schema,table,s3path,incremental=False,partitionBy=None,sortBy=None,targetFileSizeMB=None):
     Save dataframe as a SparkSQL table backed by S3 parquet files. 
     Returns a copy of the Athena compatable DDL for the table - used in executeAthenaDDL() to make the data acessible from Amazon Athena.
     Parameters:
@@ -88,38 +257,282 @@ Methods:
     - schema (str) - Schema name
     - table (str) - Table name
     - s3path (str) - Target S3 bucket and prefix for saving the parquet files
+    - incremental (bool) - Append the changes returned by diffFingerprints() as a new hz_batch partition, instead of
+        overwriting the table. Existing partitions holding changed or deleted rows are rewritten without them, and
+        the rewritten hz_batch partitions are dropped from the table. Saving a batch again after a run failed
+        before commitFingerprints() rewrites the partly saved batch, so rows are never stored twice.
+        The table is partitioned by hz_batch - add athenaPartitionDDL() to the Athena DDL list to register partitions.
+    - partitionBy (list of str) - Harmonized variables to partition the table by, eg ["year", "month"]. The Athena DDL
+        declares them in PARTITIONED BY - add athenaPartitionDDL() to the Athena DDL list to register partitions.
+    - sortBy (list of str) - Variables to sort by within each output file, for better parquet min/max pruning
+    - targetFileSizeMB (int) - Approximate target size of output files (estimated from a sample of rows)
 
-- executeAthenaDDL(self,athena_s3_staging_dir,ddlList):
-    Save dataframe as a SparkSQL table backed by S3 parquet files. 
-    Returns a copy of the Athena compatable DDL for the table - may be used by researchers access the data from Amazon Athena.
+- athenaPartitionDDL(self, schema, table, batchSize=100):
+    Returns a list of Athena DDL statements registering the partitions of a partitioned table created by 
+    saveAsParquetTable() - batched ALTER TABLE ADD PARTITION statements, or MSCK REPAIR TABLE for other tables.
+    After an incremental save, hz_batch partitions that were rewritten into the new batch are first dropped with
+    ALTER TABLE DROP PARTITION statements.
+    Parameters:
+    - schema (str) - Schema name
+    - table (str) - Table name
+    - batchSize (int) - Maximum number of partitions added per ALTER TABLE statement
+
+- fingerprintRows(self, df, keyCols=None):
+    Adds hz_fingerprint (hash of all source columns) and hz_docid (stable record id) variables to a raw dataframe.
+    Call immediately after loading the source data, before any harmonization steps.
+    Parameters:
+    - df (dataframe) - Dataframe containing raw source variables and values
+    - keyCols (list of str) - Source variables that uniquely identify a record. By default the fingerprint
+        is used, so a changed record is handled as a delete plus an insert.
+
+- diffFingerprints(self, df, fingerprintPath):
+    Compares a fingerprinted dataframe to the fingerprints saved by the previous run, and returns a tuple
+    (df_changes, df_deletes): the new or changed rows to be harmonized and saved, and the hz_docid of deleted rows.
+    Parameters:
+    - df (dataframe) - Dataframe returned by fingerprintRows()
+    - fingerprintPath (str) - S3 bucket and prefix where fingerprints are stored, eg next to the parquet output
+
+- commitFingerprints(self, keepBatches=2):
+    Saves the fingerprints for the current run, once harmonized changes have been saved and indexed.
+    Parameters:
+    - keepBatches (int) - Number of most recent fingerprint snapshots to keep
+
+- dedupIncidents(self, df, keyCols=None, keyIndexPath=None, exact=True):
+    Removes duplicate incidents, eg from overlapping extracts republished by a city portal. Adds the hz_dedupkey
+    variable (a 60 bit hash of the key variables), and keeps one row per key within the batch. With keyIndexPath,
+    rows whose key was kept by a previous run are also removed: keys are checked against a Bloom filter of all
+    previously kept keys, and only keys the filter reports as possibly seen are verified against the sorted key index
+    (8 bytes per key), so the historical data is never re-read. Call commitDedupKeys() once the batch has been saved.
+    Parameters:
+    - df (dataframe) - Harmonized dataframe
+    - keyCols (list of str) - Variables identifying an incident - default datetime, location, description (those
+        present). String values are compared trimmed and case insensitively.
+    - keyIndexPath (str) - Optional S3 or local path where the key index and Bloom filter are stored between runs.
+        Only for output appended to the previous runs' (eg saveAsParquetTable(incremental=True)) - rows removed
+        because an earlier run kept them are lost if that earlier output is overwritten.
+    - exact (bool) - Verify Bloom filter hits against the key index - if False, rows reported as possibly seen are
+        removed without verification, so about fpp (see commitDedupKeys) of new incidents are wrongly dropped
+
+- commitDedupKeys(self, df=None, keepBatches=2, fpp=0.01):
+    Saves the key index and Bloom filter for the keys kept by dedupIncidents(), once the batch has been saved.
+    Parameters:
+    - df (dataframe) - Optional dataframe whose hz_dedupkey values are committed, eg the materialized dataframe that
+        was saved - by default the keys are recomputed from the dataframe returned by dedupIncidents()
+    - keepBatches (int) - Number of most recent key index snapshots to keep
+    - fpp (float) - Bloom filter false positive probability - about 10 bits per key for 1%
+
+- executeAthenaDDL(self, athena_s3_staging_dir, ddlList, maxConcurrent=4):
+    Executes Athena DDL statements, eg from saveAsParquetTable() and athenaPartitionDDL(), using pooled JDBC connections.
+    Statements for different tables run concurrently, statements for the same table run in order - see athenaExecutor.
+    Returns a list of (statement, seconds), and raises ValueError listing the statements that failed.
     Parameters:
     - athena_s3_staging_dir (str) - an s3 path uri to a bucket/prefix used by Athana
-    - ddlList (list of str) - A string, or list of strings containing valid Athena DDL statements
+    - ddlList (list of str) - A string, or list of strings (or lists of strings) containing valid Athena DDL statements
+    - maxConcurrent (int) - Maximum number of statements running at the same time
     
-- publishNotebookToS3(self, outputdocpath, notebook_urlbase, notebookName):
+- publishNotebookToS3(self, outputdocpath, notebook_urlbase, notebookName, endpointUrl=None, waitSeconds=60, force=False, savedAfter=None):
     Copies the notebook native and html formats from the local disk to S3 target dataset path. 
     The HTML version is made visible from the search & discover UI.
+    The notebook is saved asynchronously by javascript, so the .ipynb file is first waited for until it has been
+    modified after savedAfter, and then converted to html with jupyter nbconvert - the published files never come
+    from an earlier save.
+    Files are uploaded concurrently once they have been written, and skipped if unchanged since last published - see
+    s3Publisher. Returns a dict of S3 path to "uploaded" or "skipped", and raises ValueError if a file failed.
     Parameters:
     - outputdocpath (str) - S3 bucket/prefix for saving the notebook
     - notebook_urlbase (str) - URL for linking the HTML version of the notebook
     - notebookName (str) - Name of the notebook to be saved        
+    - endpointUrl (str) - Optional S3 endpoint URL, eg for a local S3 compatible server
+    - waitSeconds (int) - Maximum time to wait for the notebook files to be saved
+    - force (bool) - Upload the files even if unchanged
+    - savedAfter (float) - Time (time.time()) the notebook save was requested - default the time of this call
 '''
 
 from __future__ import print_function
 import os
+import shutil
 import subprocess
+import tempfile
 import time
 import re
+import hashlib
+import heapq
+import numpy
 import pandas
 import json
-from pyspark import SparkContext
+import math
+from collections import OrderedDict
+try:
+    import __builtin__
+except ImportError:
+    import builtins as __builtin__
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote
+from pyspark import SparkContext, StorageLevel
 from pyspark.sql import HiveContext
 from pyspark.sql.functions import *
-import jaydebeapi
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, LongType, BooleanType, BinaryType
+from .athenaExecutor import athenaExecutor
+from .s3Publisher import s3Publisher
+from .instrumentation import instrumented, metrics
+
+
+# rough ratio of snappy compressed parquet size to json size for harmonized incident records
+_PARQUET_JSON_SIZE_RATIO = 0.25
+
+# rough driver memory per value of a pandas object column (python object header and pointer), beyond its json size
+_PANDAS_VALUE_BYTES = 64
+
+
+def _sqlString(value):
+    # quote a python value as a Spark SQL string literal
+    return "'%s'" % ("%s" % (value,)).replace("\\", "\\\\").replace("'", "\\'")
+
+def _sqlIdent(name):
+    # quote a column name as a Spark SQL identifier
+    return "`%s`" % name.replace("`", "``")
+
+def _validVariableName(name):
+    # remove chars not supported by parquet, and lowercase for Athena
+    return re.sub('[ ,;{}()\n\t=/]', '', name).lower()
+
+_NUMERIC_TYPES = ("tinyint", "smallint", "int", "bigint", "float", "double")
+
+# geolocation "latitude,longitude" strings are converted to this struct, which elasticsearch maps as a geo_point
+_GEOPOINT = "struct<lat:double,lon:double>"
+
+_PLAIN_NUMBER = re.compile(r'^-?(0|[1-9][0-9]*)(\.[0-9]*[1-9])?$')
+
+_INTEGRAL_TYPES = ("tinyint", "smallint", "int", "bigint")
+
+def _uitypeDataType(uitype):
+    # narrowest spark datatype for a search UI type, or None to leave the variable unchanged
+    parts = uitype.split(",")
+    if parts[0] == "boolean":
+        return "int"
+    if parts[0] == "datetime":
+        return "timestamp"
+    if parts[0] not in ("range", "enum") or len(parts) < 2:
+        return None
+    try:
+        values = [float(v) for v in parts[1:]]
+    except ValueError:
+        # enum of non numeric values - stays a string
+        return None
+    if parts[0] == "enum" and not __builtin__.all(_PLAIN_NUMBER.match(v) for v in parts[1:]):
+        # codes such as 007 or 1.50 would lose their text as numbers
+        return None
+    if __builtin__.all(v == int(v) for v in values):
+        vmin, vmax = __builtin__.min(values), __builtin__.max(values)
+        for datatype, bound in (("tinyint", 2**7), ("smallint", 2**15), ("int", 2**31)):
+            if -bound <= vmin and vmax < bound:
+                return datatype
+        return "bigint"
+    return "double"
+
+def _castExpr(column, datatype):
+    if datatype == _GEOPOINT:
+        parts = split(column, ",")
+        lat = trim(parts.getItem(0)).cast("double")
+        lon = trim(parts.getItem(1)).cast("double")
+        return when(lat.isNotNull() & lon.isNotNull(), struct(lat.alias("lat"), lon.alias("lon")))
+    return column.cast(datatype)
+
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+_DEDUP_KEY_COLS = ["datetime", "location", "description"]
+
+def _bloomSize(n, fpp):
+    # (bits, hashes) for a Bloom filter holding n keys with false positive probability fpp
+    bits = int(math.ceil(-n * math.log(fpp) / (math.log(2) ** 2) / 8.0)) * 8
+    return bits, __builtin__.max(1, int(__builtin__.round(float(bits) / n * math.log(2))))
+
+# tried in order - patterns with trailing fields first, as the native parser ignores unparsed trailing text
+_DATETIME_FORMATS = ["MM/dd/yyyy hh:mm:ss a", "MM/dd/yyyy HH:mm:ss", "MM/dd/yyyy HH:mm", "MM/dd/yyyy HHmm", "MM/dd/yyyy"]
+
+_PYTHON_DATE_TOKENS = {"yyyy": "%Y", "yy": "%y", "MM": "%m", "M": "%m", "dd": "%d", "d": "%d", "HH": "%H", "H": "%H",
+                       "hh": "%I", "h": "%I", "mm": "%M", "m": "%M", "ss": "%S", "s": "%S", "a": "%p", "EEEE": "%A",
+                       "EEE": "%a", "%": "%%"}
+
+def _pythonDateFormat(pattern):
+    # SimpleDateFormat pattern to the equivalent strptime format, for the common date and time fields
+    tokens = sorted(_PYTHON_DATE_TOKENS, key=len, reverse=True)
+    return re.sub("|".join(re.escape(t) for t in tokens), lambda m: _PYTHON_DATE_TOKENS[m.group(0)], pattern)
+
+def _pandasDateTimeParser(pyFormats):
+    # vectorized udf parsing a batch of strings with each format in turn, for the values not yet parsed
+    def parse(values):
+        parsed = pandas.Series(pandas.NaT, index=values.index, dtype="datetime64[ns]")
+        for f in pyFormats:
+            missing = parsed.isnull() & values.notnull()
+            if not missing.any():
+                break
+            parsed[missing] = pandas.to_datetime(values[missing], format=f, errors="coerce")
+        return parsed
+    return pandas_udf(parse, "timestamp")
+
+def _valueMappingDescr(valueMappings, matchType="exact"):
+    if matchType == "prefix":
+        return "Map value prefixes {}".format(json.dumps(valueMappings))
+    if matchType == "regex":
+        return "Map values matching patterns {}".format(json.dumps(valueMappings))
+    return "Map values {}".format(json.dumps(valueMappings))
+
+def _valueMappingExpr(column, valueMappings):
+    # CASE column WHEN 'old' THEN 'new' ... ELSE column END
+    mapped = None
+    for oldval in valueMappings.keys():
+        newval = valueMappings[oldval]
+        cond = column == lit("%s" % oldval)
+        mapped = when(cond, lit("%s" % newval)) if mapped is None else mapped.when(cond, lit("%s" % newval))
+    return mapped.otherwise(column) if mapped is not None else column
+
+
+def _vargroupOrder(vargroup):
+    # vargroups are labelled <order>.<name> - sort by order, then name
+    m = re.match(r'^(\d+)\.', vargroup)
+    return (int(m.group(1)) if m else 999, vargroup)
+
+def _isNumber(value):
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def _mergeBound(values, pick):
+    # min or max of values from several dictionaries - numeric order if all values are numbers
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    if __builtin__.all(_isNumber(v) for v in values):
+        return pick(values, key=float)
+    return pick(values)
+
+def _mergeVarTypes(types):
+    # single search UI type covering the types of a variable in several dictionaries
+    types = [t for t in OrderedDict((t, 1) for t in types if t)]
+    if len(types) <= 1:
+        return types[0] if types else "unknown"
+    parts = [t.split(",") for t in types]
+    kinds = set(p[0] for p in parts)
+    if kinds == set(["range"]) and __builtin__.all(len(p) == 4 and _isNumber(p[1]) and _isNumber(p[2]) and _isNumber(p[3]) for p in parts):
+        return "range,{0},{1},{2}".format(_mergeBound([p[1] for p in parts], __builtin__.min),
+                                          _mergeBound([p[2] for p in parts], __builtin__.max),
+                                          _mergeBound([p[3] for p in parts], __builtin__.min))
+    if kinds == set(["enum"]):
+        values = list(OrderedDict((v, 1) for p in parts for v in p[1:]))
+        if __builtin__.all(_isNumber(v) for v in values):
+            values.sort(key=float)
+        return "enum," + ",".join(values)
+    return "text"
+
 
 class harmonizeCrimeIncidents(object):
 
-    def __init__(self, hiveContext):
+    def __init__(self, hiveContext, storageLevel="MEMORY_AND_DISK", checkpointPath=None):
         # List of variable groups used as Search UI accordian labels (displayed in the order specified)
         vargroups={
             "Date and Time"                :"00.Date and Time",
@@ -232,9 +645,34 @@ class harmonizeCrimeIncidents(object):
                 "type": "text",
                 "descr": "Incident geoLocation coordinates",
                 "uifilter": False
+            },
+            ######################
+            # Incremental harmonization variables
+            ######################
+            "hz_docid" : {
+                "group":vargroups["Miscellaneous"],
+                "type": "identifier",
+                "descr": "Stable record identifier, used as the elasticsearch document id.",
+                "uifilter": False
+            },
+            "hz_fingerprint" : {
+                "group":vargroups["Miscellaneous"],
+                "type": "identifier",
+                "descr": "Hash of the source record, used to detect changed records.",
+                "uifilter": False
+            },
+            "hz_dedupkey" : {
+                "group":vargroups["Miscellaneous"],
+                "type": "identifier",
+                "descr": "Hash of the incident key variables, used to remove duplicate incidents.",
+                "uifilter": False
             }
         }
         self.hc=hiveContext
+        self.storageLevel=getattr(StorageLevel, storageLevel)
+        self.checkpointPath=checkpointPath
+        self.materialized=[]
+        self.castFailures={}
         self.vargroups=vargroups
         self.defaultVargroup=None
         self.harmonized_variables=harmonized_variables
@@ -242,6 +680,11 @@ class harmonizeCrimeIncidents(object):
         self.varmap={}
         self.varmapreverse={}
         self.transformDescr={}
+        self.incremental=None
+        self.dedup=None
+        self.lookupCount=0
+        self.tableLayouts={}
+        self.droppedPartitions={}
 
     def addVarGroup(self,varGroup,order=98,default=False):
         self.vargroups[varGroup]="{0}.{1}".format(order,varGroup)
@@ -260,6 +703,7 @@ class harmonizeCrimeIncidents(object):
                 "uifilter": uifilter
             }
 
+    @instrumented
     def mapVar(self, df, oldvar, newvar, keepOrig=False):
         if (newvar == oldvar):
             if not keepOrig:
@@ -282,61 +726,360 @@ class harmonizeCrimeIncidents(object):
             print("Dropped variable <{}>".format(oldvar))
         return df
 
-    def mapValues(self, df, col, valueMappings):
-        col_tmp = col + '_tmp'
-        df = df.withColumnRenamed(col, col_tmp)
-        caseExpr = "CASE {0} ".format(col_tmp)
-        for oldval in valueMappings.keys():
-            newval = valueMappings[oldval]
-            caseExpr = caseExpr + "WHEN '{0}' THEN '{1}' ".format(oldval, newval)
-        caseExpr = caseExpr + "ELSE {0} END AS {1}".format(col_tmp, col)
-        df=df.selectExpr(caseExpr,"*").drop(col_tmp)  
-        self.addTransformDescr(col,"Map values {}".format(json.dumps(valueMappings)))
+    @instrumented
+    def mapValues(self, df, col, valueMappings, matchType="exact", broadcastThreshold=100):
+        mapped, lookup = self._valueMappingPlan(df[col], valueMappings, matchType, broadcastThreshold)
+        others = [df[c] for c in df.columns if c != col]
+        if lookup:
+            df = df.join(broadcast(lookup[0]), lookup[1], "left_outer")
+        # mapped variable is placed first
+        df = df.select(mapped.alias(col), *others)
+        self.addTransformDescr(col, _valueMappingDescr(valueMappings, matchType))
         print("Values for {0} converted per supplied mapping".format(col))
         return df
 
+    def _valueMappingPlan(self, column, valueMappings, matchType="exact", broadcastThreshold=100):
+        # returns (mapped column expression, lookup) - lookup is None, or a (lookup dataframe, join condition) pair
+        # that must be broadcast joined to the dataframe before the mapped expression can be selected
+        if matchType == "prefix":
+            mapped = None
+            for prefix in sorted(valueMappings.keys(), key=lambda k: -len("%s" % k)):
+                cond = column.startswith("%s" % prefix)
+                newval = lit("%s" % valueMappings[prefix])
+                mapped = when(cond, newval) if mapped is None else mapped.when(cond, newval)
+            return (mapped.otherwise(column) if mapped is not None else column), None
+        if matchType == "regex":
+            mapped = None
+            for pattern in valueMappings.keys():
+                cond = column.rlike("%s" % pattern)
+                newval = lit("%s" % valueMappings[pattern])
+                mapped = when(cond, newval) if mapped is None else mapped.when(cond, newval)
+            return (mapped.otherwise(column) if mapped is not None else column), None
+        if matchType != "exact":
+            raise ValueError("Unknown value mapping matchType: {0}".format(matchType))
+        if len(valueMappings) <= broadcastThreshold:
+            return _valueMappingExpr(column, valueMappings), None
+        # large mapping - lookup table with uniquely named columns, so several can be joined to one dataframe
+        self.lookupCount += 1
+        keyCol, valueCol = "hz_mapkey_%d" % self.lookupCount, "hz_mapvalue_%d" % self.lookupCount
+        lookup = self.hc.createDataFrame([("%s" % k, "%s" % v) for k, v in valueMappings.items()], [keyCol, valueCol])
+        return coalesce(lookup[valueCol], column), (lookup, column == lookup[keyCol])
+
+    @instrumented
+    def loadValueMappings(self, path, keyCol, valueCol, format="csv"):
+        df = self.hc.read.load(path, format=format, header="true")
+        return OrderedDict((r[0], r[1]) for r in df.select(keyCol, valueCol).collect())
+
     def addTransformDescr(self, col, transformDescr):
         self.transformDescr[col] = transformDescr
 
 
     # setColDataTypes:
     #   
-    def setColDataTypes(self,df):
-        self.transformDescr[col] = transformDescr
-        for col,col_type in df.dtypes:
+    @instrumented
+    def setColDataTypes(self, df, df_dict=None, geoPoint=True, reportFailures=False):
+        casts = self._colDataTypeCasts(df.dtypes, self._dictVarTypes(df_dict), geoPoint)
+        if not casts:
+            return df
+        exprs = dict((col, _castExpr(df[col], col_type)) for col, col_type in casts)
+        if reportFailures:
+            self._reportCastFailures(df, exprs, dict(casts))
+        return df.select(*[exprs[col].alias(col) if col in exprs else df[col] for col in df.columns])
+
+    def _colDataTypeCasts(self, dtypes, dictVarTypes=None, geoPoint=True):
+        # list of (column, datatype) casts needed to match the expected types of harmonized variables
+        # variables without metadata use the type inferred by the data dictionary, if available
+        casts = []
+        for col,col_type in dtypes:
             if col in self.addl_variables:
-                metadata = self.addl_variables[col]
+                uitype = self.addl_variables[col]["type"]
             elif col in self.harmonized_variables:
-                metadata = self.harmonized_variables[col]  
+                uitype = self.harmonized_variables[col]["type"]
+            elif dictVarTypes and col in dictVarTypes:
+                uitype = dictVarTypes[col]
             else:
                 continue
-            uitype = metadata["type"]
-            # boolean field should be type 'int'
-            if uitype == "boolean" and col_type != "int":
-                # cast column to 'int'
-                print("Casting variable {0} from datatype {1} to 'int'".format(col, col_type))
-                df = df.withColumn(col, df[col].cast("int"))
-        return df
+            if col == "geolocation" and geoPoint:
+                datatype = _GEOPOINT
+            elif uitype.startswith("range,") and col not in self.addl_variables and col not in self.harmonized_variables:
+                # inferred range bounds are rounded UI widget bounds (min 0), not the observed values - integer
+                # narrowing could truncate fractions or wrap negative values
+                datatype = "double"
+            else:
+                datatype = _uitypeDataType(uitype)
+            if datatype and col_type != datatype and not (datatype == _GEOPOINT and col_type.startswith("struct")):
+                print("Casting variable {0} from datatype {1} to '{2}'".format(col, col_type, datatype))
+                casts.append((col, datatype))
+        return casts
+
+    def _dictVarTypes(self, df_dict):
+        if df_dict is None:
+            return None
+        return dict((r["dict_field"], r["dict_vartype"]) for r in df_dict.select("dict_field", "dict_vartype").collect())
+
+    def _reportCastFailures(self, df, exprs, datatypes):
+        # count non empty source values that become null or change when cast - all columns in one pass
+        checks = []
+        srcTypes = dict(df.dtypes)
+        for col in exprs:
+            src = df[col]
+            failed = exprs[col].isNull()
+            if datatypes[col] in _NUMERIC_TYPES:
+                # truncated fractions and overflow wrapped by narrowing casts don't give nulls
+                failed = failed | (exprs[col].cast("double") != trim(src.cast("string")).cast("double"))
+                if datatypes[col] in _INTEGRAL_TYPES and srcTypes[col] == "string":
+                    failed = failed | trim(src).rlike("^[-+]?0[0-9]")
+            failed = src.isNotNull() & (trim(src.cast("string")) != "") & failed
+            checks.append(sum(when(failed, 1).otherwise(0)).alias(col))
+        counts = df.select(*checks).collect()[0].asDict()
+        self.castFailures = dict((col, n) for col, n in counts.items() if n)
+        metrics.add(castFailures=__builtin__.sum(self.castFailures.values()))
+        for col in sorted(self.castFailures):
+            print("WARNING: {0} values of variable {1} could not be cast exactly, and are set to null or changed".format(self.castFailures[col], col))
 
     # makeValidVariableNames:
     #   
+    @instrumented
     def makeValidVariableNames(self, df):
         for col in df.columns:
-            newcol = re.sub('[ ,;{}()\n\t=/]', '', col)
-            newcol = newcol.lower()
+            newcol = _validVariableName(col)
             if newcol != col:
                 df = self.mapVar(df, col, newcol)
-        return df        
-    
+        return df
+
+    @instrumented
+    def harmonizeDateTime(self, df, dateCol, timeCol=None, formats=None, vectorized=False, dropSource=True):
+        formats = formats or _DATETIME_FORMATS
+        if type(formats) is not list:
+            formats = [formats]
+        source = trim(df[dateCol].cast("string"))
+        if timeCol:
+            source = concat_ws(" ", source, trim(df[timeCol].cast("string")))
+        # midnight recorded as hour 24, eg 24:00:00 or 2400 - parsed as hour 00, then moved to the following day
+        hour24 = r" 24(:\d\d|\d\d)"
+        midnight = source.rlike(hour24)
+        source = regexp_replace(source, hour24, " 00$1")
+        if vectorized:
+            parsed = _pandasDateTimeParser([_pythonDateFormat(f) for f in formats])(source)
+        else:
+            parsed = coalesce(*[unix_timestamp(source, f) for f in formats]).cast("timestamp")
+        parsed = when(midnight, parsed + expr("INTERVAL 1 DAY")).otherwise(parsed)
+        # parse once into a column, then extract the date and time parts from the timestamp
+        ts = col("hz_datetime")
+        parts = [("datetime", ts), ("year", year(ts)), ("month", month(ts)), ("day", dayofmonth(ts)),
+                 ("hour", hour(ts)), ("minute", minute(ts)), ("dayofweek", date_format(ts, "EEEE"))]
+        names = [name for name, e in parts]
+        dropped = set(names + ([dateCol] + ([timeCol] if timeCol else []) if dropSource else []))
+        df = df.select(*[df[c] for c in df.columns if c not in dropped] + [parsed.alias("hz_datetime")])
+        df = df.select(*[c for c in df.columns if c != "hz_datetime"] + [e.alias(name) for name, e in parts])
+        src = " and ".join([dateCol] + ([timeCol] if timeCol else []))
+        for name in names:
+            self.varmapreverse[name] = src
+        self.addTransformDescr("datetime", "Full timestamp with date and time, parsed from {0} using formats {1}".format(src, ", ".join(formats)))
+        for name in names[1:-1]:
+            self.addTransformDescr(name, "{0}, extracted from datetime".format(name))
+        self.addTransformDescr("dayofweek", "day of Week, calculated from datetime")
+        print("Harmonized date & time variables from {0}".format(src))
+        return df
+
+    @instrumented
+    def harmonizeGeolocation(self, df, geoCol=None, latCol=None, lonCol=None, bounds=None, dropInvalid=True, geoPoint=True, dropSource=True):
+        if geoCol:
+            # eg "(39.29, -76.61)" - strip parentheses and spaces, and split once
+            parts = split(regexp_replace(df[geoCol].cast("string"), r"[()\s]", ""), ",")
+            lat, lon = parts.getItem(0).cast("double"), parts.getItem(1).cast("double")
+            sources = [geoCol]
+        elif latCol and lonCol:
+            lat, lon = df[latCol].cast("double"), df[lonCol].cast("double")
+            sources = [latCol, lonCol]
+        else:
+            raise ValueError("harmonizeGeolocation requires geoCol, or latCol and lonCol")
+        dropped = set(["geolocation"] + (sources if dropSource else []))
+        df = df.select(*[df[c] for c in df.columns if c not in dropped] + [lat.alias("hz_lat"), lon.alias("hz_lon")])
+        lat, lon = col("hz_lat"), col("hz_lon")
+        valid = lat.isNotNull() & lon.isNotNull() & lat.between(-90, 90) & lon.between(-180, 180) & ~((lat == 0) & (lon == 0))
+        checks = "missing, out of range or 0,0 coordinates"
+        if bounds:
+            minLat, minLon, maxLat, maxLon = bounds
+            valid = valid & lat.between(minLat, maxLat) & lon.between(minLon, maxLon)
+            checks = "missing, 0,0 or coordinates outside latitude {0} to {2}, longitude {1} to {3}".format(minLat, minLon, maxLat, maxLon)
+        if geoPoint:
+            point = struct(lat.alias("lat"), lon.alias("lon"))
+        else:
+            point = concat_ws(",", lat.cast("string"), lon.cast("string"))
+        if dropInvalid:
+            df = df.where(valid)
+            geolocation = point
+        else:
+            geolocation = when(valid, point)
+        df = df.select(*[c for c in df.columns if c not in ("hz_lat", "hz_lon")] + [geolocation.alias("geolocation")])
+        # sources are reported by their original source dataset names, eg when geoCol was renamed by mapVar
+        src = " and ".join(self.varmapreverse.get(c, c) for c in sources)
+        self.varmapreverse["geolocation"] = src
+        if geoPoint:
+            output = "geolocation point {lat, lon} (doubles, indexed as an elasticsearch geo_point)"
+        else:
+            output = 'geolocation "latitude,longitude" string'
+        self.addTransformDescr("geolocation", '{0} created from {1} - {2} for {3}'.format(
+            output, src, "rows removed" if dropInvalid else "geolocation set to null", checks))
+        print("Harmonized geolocation variable from {0}".format(src))
+        return df
+
+    @instrumented
+    def deferTransforms(self, df):
+        return transformBuilder(self, df)
 
-    def get_unique_values(self, df, col):
-        val_list = df.select(col).distinct().filter(df[col] != '').rdd.map(lambda r: r[0]).collect()
+    @instrumented
+    def materialize(self, df, name=None):
+        start = time.time()
+        if self.checkpointPath:
+            # write once and read back - truncates the lineage, so nothing upstream is ever recomputed
+            path = "{0}/{1}".format(self.checkpointPath, name or "df{0}_{1}".format(len(self.materialized), int(start)))
+            df.write.parquet(path, mode="overwrite")
+            df = self.hc.read.parquet(path)
+        else:
+            df = df.persist(self.storageLevel)
+            path = None
+        rows = df.count()
+        # the row count is kept, so later steps (eg output file sizing) don't count the dataframe again
+        self.materialized.append((df, path, rows))
+        metrics.add(rows=rows)
+        print("Materialized {0} rows in {1:.0f}s".format(rows, time.time() - start))
+        return df
+
+    @instrumented
+    def release(self):
+        for df, path, rows in self.materialized:
+            if path:
+                fs, p = self._hadoopPath(path)
+                fs.delete(p, True)
+            else:
+                df.unpersist()
+        self.materialized = []
+
+    @instrumented
+    def get_unique_values(self, df, col, maxValues=1000):
+        values = df.select(col).distinct()
+        values = values.where(values[col].isNotNull())
+        if dict(df.dtypes)[col] == "string":
+            values = values.where(values[col] != '')
+        val_list = values.limit(maxValues + 1).rdd.map(lambda r: r[0]).collect()
+        if len(val_list) > maxValues:
+            raise ValueError("Variable {0} has more than {1} unique values - raise maxValues, or use profileColumns() for "
+                             "the most frequent values".format(col, maxValues))
+        # values keep the variable's type, so numbers sort numerically
         val_list.sort()
         return val_list
 
-    def buildDataDict(self,df):
-        unionList=[]
-        for col,col_type in df.dtypes:
+    @instrumented
+    def profileColumns(self, df, cols=None, topK=20, sampleFraction=None, maxResults=1000):
+        cols = list(cols or df.columns)
+        topK = __builtin__.min(topK, maxResults)
+        if sampleFraction:
+            df = df.sample(False, sampleFraction)
+        # one (field, value) row per variable per input row, so all variables share a single scan and shuffle
+        pairs = df.select(explode(array(*[struct(lit(c).alias("field"), df[c].cast("string").alias("value")) for c in cols])).alias("p"))
+        counts = pairs.select("p.field", "p.value").where(col("value").isNotNull()).groupBy("field", "value").count()
+        # counts are partially aggregated per partition before the shuffle. Each field's values are then reduced to a
+        # bounded top K (plus a count of the values seen) as they are combined, so no task ever holds or sorts all the
+        # values of a high cardinality variable, and only topK values per field reach the driver
+        def rankKey(vc):
+            return (-vc[1], vc[0])
+        def addValue(acc, vc):
+            top, n = acc
+            top = top + [vc]
+            if len(top) > 2 * topK:
+                top = heapq.nsmallest(topK, top, key=rankKey)
+            return (top, n + 1)
+        def mergeTop(a, b):
+            return (heapq.nsmallest(topK, a[0] + b[0], key=rankKey), a[1] + b[1])
+        ranked = counts.rdd.map(lambda r: (r["field"], (r["value"], r["count"]))) \
+                           .aggregateByKey(([], 0), addValue, mergeTop)
+        profiles = dict((c, {"topK": [], "distinct": 0, "sampled": bool(sampleFraction)}) for c in cols)
+        for field, (top, distinct) in ranked.collect():
+            for value, n in heapq.nsmallest(topK, top, key=rankKey):
+                n = int(__builtin__.round(n / float(sampleFraction))) if sampleFraction else n
+                profiles[field]["topK"].append((value, n))
+            profiles[field]["distinct"] = distinct
+        return profiles
+
+    @instrumented
+    def countValues(self, df, col, topK=30, otherLabel="Other"):
+        counts = df.where(df[col].isNotNull()).groupBy(df[col].cast("string").alias("value")).count()
+        # the top values and the total count are reduced as partitions are combined, as in profileColumns - no task
+        # sorts all the values, and only topK values reach the driver
+        def rankKey(vc):
+            return (-vc[1], vc[0])
+        def addValue(acc, vc):
+            top, total = acc
+            top = top + [vc]
+            if len(top) > 2 * topK:
+                top = heapq.nsmallest(topK, top, key=rankKey)
+            return (top, total + vc[1])
+        def mergeTop(a, b):
+            return (heapq.nsmallest(topK, a[0] + b[0], key=rankKey), a[1] + b[1])
+        top, total = counts.rdd.map(lambda r: (r["value"], r["count"])).aggregate(([], 0), addValue, mergeTop)
+        top = heapq.nsmallest(topK, top, key=rankKey)
+        values, ns = [v for v, n in top], [n for v, n in top]
+        other = total - __builtin__.sum(ns)
+        if otherLabel is not None and other > 0:
+            values.append(otherLabel)
+            ns.append(other)
+        return pandas.Series(ns, index=values, name="counts")
+
+    def iterPandasBatches(self, df, batchRows=10000, partitionRows=None):
+        if partitionRows:
+            # toLocalIterator holds a whole partition on the driver - split the result into partitions of about
+            # partitionRows rows first (counts df, unless it was materialized)
+            df = df.repartition(__builtin__.max(1, int(math.ceil(float(self._rowCount(df)) / partitionRows))))
+        columns = df.columns
+        batch = []
+        for row in df.toLocalIterator():
+            batch.append(tuple(row))
+            if len(batch) >= batchRows:
+                yield pandas.DataFrame.from_records(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pandas.DataFrame.from_records(batch, columns=columns)
+
+    @instrumented
+    def toPandasBounded(self, df, maxBytes=256*1024*1024, batchRows=10000):
+        # estimate the rows that fit in maxBytes from the json size of a sample (measured on the executors, plus
+        # python object overhead per value), and fetch at most one row more - the limit is a single partition of
+        # bounded size, so the driver never holds a larger partition before the ceiling is checked
+        sample = df.limit(100).toJSON().map(lambda j: len(j)).collect()
+        rowBytes = (float(__builtin__.sum(sample)) / len(sample) if sample else 1.0) + _PANDAS_VALUE_BYTES * len(df.columns)
+        maxRows = __builtin__.max(batchRows, int(maxBytes / rowBytes))
+        batches = []
+        size = 0
+        for batch in self.iterPandasBatches(df.limit(maxRows + 1), batchRows):
+            size += int(batch.memory_usage(index=True, deep=True).sum())
+            if size > maxBytes or __builtin__.sum(len(b) for b in batches) + len(batch) > maxRows:
+                raise ValueError("Result exceeds {0} MB of driver memory after {1} rows - aggregate or limit it before "
+                                 "returning it to the driver".format(maxBytes // (1024*1024), __builtin__.sum(len(b) for b in batches) + len(batch)))
+            batches.append(batch)
+        metrics.add(rows=__builtin__.sum(len(b) for b in batches), bytes=size)
+        if not batches:
+            return pandas.DataFrame(columns=df.columns)
+        return pandas.concat(batches, ignore_index=True)
+
+    @instrumented
+    def buildDataDict(self, df, approxDistinct=True, rsd=0.05, enumMaxValues=0):
+        # Compute the summary stats for every column in a single aggregation pass over df,
+        # then pivot the resulting one-row frame into one dict_* row per field with stack().
+        aggList=["COUNT(1) AS dict_rowcount"]
+        stackList=[]
+        enums={}
+        if enumMaxValues:
+            # low cardinality string variables without metadata get an enum type listing their values
+            candidates = [c for c, t in df.dtypes if t == "string" and c not in self.addl_variables and c not in self.harmonized_variables]
+            if candidates:
+                profiles = self.profileColumns(df, candidates, topK=enumMaxValues + 1, maxResults=enumMaxValues + 1)
+                for c in candidates:
+                    values = [v for v, n in profiles[c]["topK"] if v != '' and "," not in v]
+                    if 0 < profiles[c]["distinct"] <= enumMaxValues and len(values) == len(profiles[c]["topK"]):
+                        enums[c] = "enum," + ",".join(sorted(values))
+        for i, (col, col_type) in enumerate(df.dtypes):
             # assemble existing metadata for field
             metadata=None
             if col in self.addl_variables:
@@ -345,52 +1088,70 @@ class harmonizeCrimeIncidents(object):
                 metadata = self.harmonized_variables[col]
             mapping=None
             if col in self.varmapreverse:
-                mapping = "Source %s. " % self.varmapreverse[col].replace("'", r"\'")
+                mapping = "Source %s. " % self.varmapreverse[col]
             else:
                 mapping = ""
             if col in self.transformDescr:
                 mapping += "%s" % self.transformDescr[col]
             else:
                 mapping += "Variable value unchanged from source dataset."
-            # build a sql query to get dict record for each field
-            fieldexpr = "'%s' AS dict_field" % col
-            countexpr = "COUNT(`%s`) AS dict_count" % col
-            countdistinctexpr = "COUNT(DISTINCT `%s`) AS dict_countdistinct" % col
-            nacountexpr = "SUM(CASE WHEN `%s` IS NULL THEN 1 ELSE 0 END) AS dict_countmissing" % col
-            mappingexpr = "'%s' AS dict_varmapping" % mapping
-            minexpr = "MIN(`%s`) AS dict_min" % col
-            maxexpr = "MAX(`%s`) AS dict_max" % col               
-            if not 'string' in col_type and not 'timestamp' in col_type:
-                meanexpr= "AVG(`%s`) AS dict_mean" % col
-                stdexpr = "STDDEV_POP(`%s`) AS dict_stddev" % col
+            # aggregate expressions for this field, aliased by column position
+            field = _sqlIdent(col)
+            if approxDistinct:
+                aggList += ["approx_count_distinct(%s, %s) AS c%d_countdistinct" % (field, rsd, i)]
+                countdistinctexpr = "c%d_countdistinct" % i
+            else:
+                # COUNT(DISTINCT) over several columns expands every row once per column - count each one separately
+                countdistinctexpr = "CAST(%d AS BIGINT)" % df.select(col).where(df[col].isNotNull()).distinct().count()
+            aggList += ["COUNT(%s) AS c%d_count" % (field, i)]
+            if col_type in _NUMERIC_TYPES or col_type.startswith("decimal"):
+                # numeric bounds keep numeric order - stack() needs one type per column, so all are doubles
+                aggList += [
+                    "CAST(MIN(%s) AS DOUBLE) AS c%d_min" % (field, i),
+                    "CAST(MAX(%s) AS DOUBLE) AS c%d_max" % (field, i),
+                    "CAST(AVG(%s) AS DOUBLE) AS c%d_mean" % (field, i),
+                    "CAST(STDDEV_POP(%s) AS DOUBLE) AS c%d_stddev" % (field, i)
+                ]
+                minexpr, maxexpr = "c%d_min" % i, "c%d_max" % i
+                meanexpr, stdexpr = "c%d_mean" % i, "c%d_stddev" % i
             else:
-                meanexpr= "NULL AS dict_mean"
-                stdexpr = "NULL AS dict_stddev"
+                minexpr = maxexpr = meanexpr = stdexpr = "CAST(NULL AS DOUBLE)"
             if metadata:
-                groupexpr = "'%s' AS dict_vargroup" % metadata["group"]
-                typeexpr = "'%s' AS dict_vartype" % metadata["type"]
-                descriptionexpr = "'%s' AS dict_vardescr" % metadata["descr"]
-                uifilterexpr = "'%s' AS dict_uifilter" % metadata["uifilter"]
+                group, vartype, descr, uifilter = metadata["group"], metadata["type"], metadata["descr"], metadata["uifilter"]
             else:
-                groupexpr = "'%s' AS dict_vargroup" % self.defaultVargroup
-                typeexpr = "'%s' AS dict_vartype" % "unknown"
-                descriptionexpr = "'%s' AS dict_vardescr" % "unknown"
-                uifilterexpr = "'%s' AS dict_uifilter" % "True"
-            sql = '''
-                SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s FROM tmptable
-            ''' % (fieldexpr, countexpr, countdistinctexpr, nacountexpr, meanexpr, stdexpr, minexpr, maxexpr, groupexpr, typeexpr, descriptionexpr, uifilterexpr, mappingexpr)
-            unionList.append(sql)
-
-        # build union all query to include all fields
-        unionSql = " UNION ALL ".join(unionList)
-        df.registerTempTable('tmptable')
-        df_dict = self.hc.sql(unionSql)
+                group, vartype, descr, uifilter = self.defaultVargroup, "unknown", "unknown", "True"
+            if col in enums:
+                vartype = "inferred:" + enums[col]
+            # stack row for this field - same column order as the dict_* layout
+            stackList += [
+                _sqlString(col),
+                "c%d_count" % i,
+                countdistinctexpr,
+                "dict_rowcount - c%d_count" % i,
+                meanexpr,
+                stdexpr,
+                minexpr,
+                maxexpr,
+                _sqlString(group),
+                _sqlString(vartype),
+                _sqlString(descr),
+                _sqlString(uifilter),
+                _sqlString(mapping)
+            ]
+
+        df_stats = df.selectExpr(*aggList)
+        stackExpr = """
+            stack({0}, {1}) AS (dict_field, dict_count, dict_countdistinct, dict_countmissing, dict_mean, dict_stddev,
+                                dict_min, dict_max, dict_vargroup, dict_vartype_orig, dict_vardescr, dict_uifilter, dict_varmapping)
+        """.format(len(df.columns), ", ".join(stackList))
+        df_dict = df_stats.selectExpr(stackExpr)
 
         # update fields with 'unknown' mappings to set best guess 'type' from data distribution
         # this allows fields to be used in the search UI with sensible input widgets
-        df_dict = df_dict.withColumnRenamed("dict_vartype", "dict_vartype_orig")
         selectExpr = """
             CASE
+                WHEN (dict_vartype_orig LIKE 'inferred:enum,%')
+                   THEN substr(dict_vartype_orig, 10)
                 WHEN (dict_vartype_orig = 'unknown' AND dict_mean IS NULL)
                    THEN 'text'
                 WHEN (dict_vartype_orig = 'unknown' AND dict_countdistinct=2 AND dict_min=0 AND dict_max=1)
@@ -402,50 +1163,619 @@ class harmonizeCrimeIncidents(object):
                 ELSE dict_vartype_orig
             END AS dict_vartype
         """
-        df_dict=df_dict.selectExpr("*",selectExpr).drop("dict_vartype_orig").coalesce(1)
+        df_dict=df_dict.selectExpr("*",selectExpr).drop("dict_vartype_orig")
         return df_dict
 
-    def saveAsParquetTable(self,df,schema,table,s3path):
+    @instrumented
+    def mergeDataDicts(self, dicts):
+        fields = {}
+        cities = sorted(dicts)
+        for city in cities:
+            rows = dicts[city]
+            if hasattr(rows, "collect"):
+                rows = [r.asDict() for r in rows.collect()]
+            for r in rows:
+                fields.setdefault(r["dict_field"], {})[city] = r
+        merged = [self._mergeDataDictField(name, fields[name]) for name in sorted(fields)]
+        groups = sorted(set(f["dict_vargroup"] for f in merged if f["dict_vargroup"]), key=_vargroupOrder)
+        content = {
+            "cities": cities,
+            "vargroups": [{"name": g, "displayName": re.sub(r'^\d+\.', '', g)} for g in groups],
+            "fields": merged
+        }
+        # content hash - unchanged dictionaries give the same etag, and the same published bytes
+        content["etag"] = hashlib.md5(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        print("Merged dictionaries for {0} cities: {1} fields, etag {2}".format(len(cities), len(merged), content["etag"]))
+        return content
+
+    def _mergeDataDictField(self, name, byCity):
+        rows = [byCity[c] for c in sorted(byCity)]
+        count = __builtin__.sum(r["dict_count"] or 0 for r in rows)
+        numeric = [r for r in rows if r["dict_mean"] is not None and r["dict_count"]]
+        mean, stddev = None, None
+        if numeric:
+            n = float(__builtin__.sum(r["dict_count"] for r in numeric))
+            mean = __builtin__.sum(r["dict_mean"] * r["dict_count"] for r in numeric) / n
+            # pooled population variance: E[x^2] - E[x]^2, from each city's mean and variance
+            sumsq = __builtin__.sum(r["dict_count"] * ((r["dict_stddev"] or 0.0) ** 2 + r["dict_mean"] ** 2) for r in numeric)
+            stddev = math.sqrt(__builtin__.max(sumsq / n - mean ** 2, 0.0))
+        groups = [r["dict_vargroup"] for r in rows if r["dict_vargroup"]]
+        descrs = [r["dict_vardescr"] for r in rows if r["dict_vardescr"] and r["dict_vardescr"] != "unknown"]
+        return {
+            "dict_field": name,
+            "dict_vargroup": __builtin__.max(groups, key=groups.count) if groups else None,
+            "dict_vartype": _mergeVarTypes([r["dict_vartype"] for r in rows]),
+            "dict_vardescr": descrs[0] if descrs else "unknown",
+            "dict_uifilter": "True" if __builtin__.any("%s" % r["dict_uifilter"] == "True" for r in rows) else "False",
+            "dict_count": count,
+            "dict_countmissing": __builtin__.sum(r["dict_countmissing"] or 0 for r in rows),
+            "dict_countdistinct": __builtin__.max(r["dict_countdistinct"] or 0 for r in rows),
+            "dict_mean": mean,
+            "dict_stddev": stddev,
+            "dict_min": _mergeBound([r["dict_min"] for r in rows], __builtin__.min),
+            "dict_max": _mergeBound([r["dict_max"] for r in rows], __builtin__.max),
+            "dict_cities": dict((c, {
+                "count": byCity[c]["dict_count"],
+                "countdistinct": byCity[c]["dict_countdistinct"],
+                "countmissing": byCity[c]["dict_countmissing"],
+                "mean": byCity[c]["dict_mean"],
+                "stddev": byCity[c]["dict_stddev"],
+                "min": byCity[c]["dict_min"],
+                "max": byCity[c]["dict_max"],
+                "vartype": byCity[c]["dict_vartype"],
+                "varmapping": byCity[c].get("dict_varmapping")
+            }) for c in byCity)
+        }
+
+    @instrumented
+    def saveMergedDataDict(self, merged, s3path, endpointUrl=None, grantRead=None):
+        # canonical json, so an unchanged dictionary is skipped by the content hash check
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "dictionary.json")
+            with open(path, "wb") as f:
+                f.write(json.dumps(merged, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8"))
+            s3Publisher.get(endpointUrl, grantRead=grantRead).publish([(path, s3path)])
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return merged["etag"]
+
+    @instrumented
+    def buildRollups(self, df, timeDimensions=None, geoDimensions=None, geohashPrecision=7):
+        timeDimensions = [c for c in (timeDimensions or ["city", "description", "year", "month", "day", "hour", "dayofweek"]) if c in df.columns]
+        geoDimensions = [c for c in (geoDimensions or ["city", "description", "year"]) if c in df.columns]
+        rollups = {}
+
+        timeCols = [df[c] for c in timeDimensions]
+        if "datetime" in df.columns:
+            timeCols.append(date_format(df["datetime"], "yyyy-MM-dd HH:00:00").alias("datetime"))
+        df_time = df.groupBy(*timeCols).agg(count(lit(1)).alias("incidents"))
+        rollups["time"] = self._rollupId(df_time, [c for c in df_time.columns if c != "incidents"])
+
+        if "geolocation" in df.columns:
+            if dict(df.dtypes)["geolocation"].startswith("struct"):
+                lat, lon = df["geolocation"]["lat"], df["geolocation"]["lon"]
+            else:
+                parts = split(df["geolocation"], ",")
+                lat, lon = trim(parts.getItem(0)).cast("double"), trim(parts.getItem(1)).cast("double")
+            valid = lat.isNotNull() & lon.isNotNull() & (abs(lat) <= 90) & (abs(lon) <= 180) & ~((lat == 0) & (lon == 0))
+            # aggregate natively on a fine lat/lon grid first, so geohashes are only computed once per grid cell
+            df_grid = df.where(valid).groupBy(*([df[c] for c in geoDimensions] + [round(lat, 4).alias("hz_lat"), round(lon, 4).alias("hz_lon")])) \
+                        .agg(count(lit(1)).alias("incidents"), sum(lat).alias("hz_sumlat"), sum(lon).alias("hz_sumlon"))
+            # defined here so the udf is shipped to executors by value - standard geohash, alternating longitude
+            # and latitude bisection bits, 5 bits per base32 character
+            def geohash(la, lo):
+                latRange, lonRange = [-90.0, 90.0], [-180.0, 180.0]
+                chars = []
+                bits, nbits, even = 0, 0, True
+                while len(chars) < geohashPrecision:
+                    bounds, value = (lonRange, lo) if even else (latRange, la)
+                    mid = (bounds[0] + bounds[1]) / 2
+                    if value >= mid:
+                        bits, bounds[0] = bits * 2 + 1, mid
+                    else:
+                        bits, bounds[1] = bits * 2, mid
+                    even = not even
+                    nbits += 1
+                    if nbits == 5:
+                        chars.append(_GEOHASH_BASE32[bits])
+                        bits, nbits = 0, 0
+                return "".join(chars)
+            geohashUdf = udf(geohash, StringType())
+            df_geo = df_grid.withColumn("geohash", geohashUdf(df_grid["hz_lat"], df_grid["hz_lon"])) \
+                            .groupBy(*(geoDimensions + ["geohash"])) \
+                            .agg(sum("incidents").alias("incidents"), sum("hz_sumlat").alias("hz_sumlat"), sum("hz_sumlon").alias("hz_sumlon"))
+            df_geo = df_geo.select(*(geoDimensions + ["geohash",
+                                     struct((df_geo["hz_sumlat"] / df_geo["incidents"]).alias("lat"),
+                                            (df_geo["hz_sumlon"] / df_geo["incidents"]).alias("lon")).alias("geolocation"),
+                                     "incidents"]))
+            rollups["geo"] = self._rollupId(df_geo, geoDimensions + ["geohash"])
+        return rollups
+
+    def _rollupId(self, df, keyCols):
+        # stable key of a rollup row, used as the elasticsearch document id
+        keyExpr = concat_ws("\x01", *[coalesce(df[c].cast("string"), lit("\x00")) for c in keyCols])
+        return df.withColumn("rollup_id", sha2(keyExpr, 256))
+
+    @instrumented
+    def saveAsParquetTable(self,df,schema,table,s3path,incremental=False,partitionBy=None,sortBy=None,targetFileSizeMB=None):
         print("Creating Spark SQL table: {0}.{1}".format(schema, table))
         tablepath="{0}/table={1}".format(s3path, table)
-        df.write.saveAsTable("{0}.{1}".format(schema, table),
-                         path=tablepath,
-                         format='parquet',
-                         mode='overwrite'
-                        )
+        partitionCols = (["hz_batch"] if incremental else []) + list(partitionBy or [])
+        self.tableLayouts[(schema, table)] = (tablepath, partitionCols)
+        if incremental:
+            self._saveIncrementalParquet(df, schema, table, tablepath, partitionBy, sortBy, targetFileSizeMB)
+        else:
+            df, options = self._parquetLayout(df, partitionBy, sortBy, targetFileSizeMB)
+            df.write.options(**options).saveAsTable("{0}.{1}".format(schema, table),
+                             path=tablepath,
+                             format='parquet',
+                             mode='overwrite',
+                             partitionBy=partitionCols or None
+                            )
+        fs, p = self._hadoopPath(tablepath)
+        metrics.add(bytesWritten=fs.getContentSummary(p).getLength())
+        return self._athenaDDL(schema, table, tablepath, partitionCols)
+
+    def _rowCount(self, df):
+        # count of a materialized dataframe is known, others are counted
+        for m, path, rows in self.materialized:
+            if m is df:
+                return rows
+        return df.count()
+
+    def _parquetLayout(self, df, partitionBy=None, sortBy=None, targetFileSizeMB=None):
+        # returns (dataframe, writer options) laid out for the requested partitioning, sort order and file size
+        options = {}
+        numFiles = None
+        if targetFileSizeMB:
+            # estimate parquet bytes per row from the json size of a sample of rows
+            sample = df.limit(1000).toJSON().map(lambda j: len(j)).collect()
+            rowBytes = _PARQUET_JSON_SIZE_RATIO * (float(__builtin__.sum(sample)) / len(sample) if sample else 1.0)
+            rowsPerFile = __builtin__.max(1, int(targetFileSizeMB * 1024 * 1024 / rowBytes))
+            options["maxRecordsPerFile"] = str(rowsPerFile)
+            if not partitionBy:
+                numFiles = __builtin__.max(1, int(math.ceil(float(self._rowCount(df)) / rowsPerFile)))
+        if partitionBy:
+            # cluster each output partition into as few tasks as possible, so each partition gets few, large files
+            df = df.repartition(*[df[c] for c in partitionBy])
+        elif numFiles:
+            df = df.repartition(numFiles)
+        if sortBy:
+            # sorted row groups give Athena/parquet tight min/max statistics for filter pushdown - sorting on the
+            # partition columns first keeps each task writing one output partition at a time
+            df = df.sortWithinPartitions(*(list(partitionBy or []) + list(sortBy)))
+        return df, options
+
+    def _athenaDDL(self, schema, table, tablepath, partitionCols=None):
         # Generate table DDL in Athena compatable format 
         ddl=self.hc.sql("SHOW CREATE TABLE %s.%s" % (schema, table)).collect()[0]["createtab_stmt"]
         ddl = re.sub('CREATE TABLE', 'CREATE EXTERNAL TABLE', ddl)
         ddl = re.sub('USING', 'STORED AS', ddl)
         ddl = re.sub('OPTIONS (.*)', '', ddl, flags=re.DOTALL)  # remove OPTIONS clause to end of string
+        if partitionCols:
+            # Athena declares partition columns in PARTITIONED BY, not in the column list
+            partitionDefs = []
+            for c in partitionCols:
+                m = re.search(r'(,\s*)?`%s` ([A-Z]+(\([0-9, ]+\))?)(\s*,)?' % re.escape(c), ddl)
+                if m is None:
+                    raise ValueError("Partition column {0} not found in the DDL of table {1}.{2}".format(c, schema, table))
+                sep = ', ' if m.group(1) and m.group(4) else ''
+                ddl = ddl[:m.start()] + sep + ddl[m.end():]
+                partitionDefs.append("`%s` %s" % (c, m.group(2)))
+            ddl = ddl.replace('STORED AS', 'PARTITIONED BY (%s)\nSTORED AS' % ", ".join(partitionDefs), 1)
         ddl = ddl + "LOCATION '{0}/';".format(tablepath)
         return ddl
 
-    def executeAthenaDDL(self, athena_s3_staging_dir, ddlList):
-        if type(ddlList) is not list:
-            ddlList = [ddlList]
-        athena_url="jdbc:awsathena://athena.{0}.amazonaws.com:443".format(os.environ['AWS_DEFAULT_REGION'])
-        conn = jaydebeapi.connect('com.amazonaws.athena.jdbc.AthenaDriver',
-                                   athena_url,
-                                   {
-                                       "aws_credentials_provider_class":"com.amazonaws.auth.InstanceProfileCredentialsProvider",
-                                       "s3_staging_dir":athena_s3_staging_dir,
-                                       "log_path":"/tmp/athenajdbc.log",
-                                       "log_level":"TRACE"
-                                   },
-                                   '/usr/lib/athena/AthenaJDBC41-1.1.0.jar')
-        for ddl in ddlList:
-            print("Exectuting Athena DDL: {0}".format(ddl))
-            stmt = conn.jconn.createStatement()
-            stmt.executeQuery(ddl)
+    @instrumented
+    def athenaPartitionDDL(self, schema, table, batchSize=100):
+        # explicit ALTER TABLE ADD PARTITION statements for tables saved by this object, MSCK REPAIR otherwise
+        if (schema, table) not in self.tableLayouts or not self.tableLayouts[(schema, table)][1]:
+            return ["MSCK REPAIR TABLE `{0}`.`{1}`;".format(schema, table)]
+        tablepath, partitionCols = self.tableLayouts[(schema, table)]
+        # batches rewritten by an incremental save no longer exist - Athena would otherwise keep listing them
+        dropped = self.droppedPartitions.get((schema, table), [])
+        ddl = ["ALTER TABLE `{0}`.`{1}` DROP IF EXISTS {2};".format(schema, table,
+               ", ".join("PARTITION (`hz_batch`={0})".format(int(b)) for b in dropped[i:i+batchSize]))
+               for i in range(0, len(dropped), batchSize)]
+        fs, root = self._hadoopPath(tablepath)
+        pattern = "/".join(["{0}=*".format(c) for c in partitionCols])
+        partitions = []
+        base = fs.makeQualified(root).toString().rstrip("/")
+        for status in fs.globStatus(self._hadoopPath("{0}/{1}".format(tablepath, pattern))[1]) or []:
+            relpath = status.getPath().toString()[len(base) + 1:]
+            spec = ", ".join("`{0}`={1}".format(kv.split("=", 1)[0], _sqlString(unquote(kv.split("=", 1)[1])))
+                             for kv in relpath.split("/"))
+            partitions.append("PARTITION ({0}) LOCATION '{1}/{2}/'".format(spec, tablepath, relpath))
+        return ddl + ["ALTER TABLE `{0}`.`{1}` ADD IF NOT EXISTS {2};".format(schema, table, " ".join(partitions[i:i+batchSize]))
+                      for i in range(0, len(partitions), batchSize)]
 
-    
-    def publishNotebookToS3(self, outputdocpath, notebook_urlbase, notebookName):
-        time.sleep(5) # give time for prior javascript save action to complete for both ipynb and html.
+    @instrumented
+    def fingerprintRows(self, df, keyCols=None):
+        # hash of all source columns - nulls are encoded so that null and '' hash differently
+        def rowHash(cols):
+            return sha2(concat_ws("\x01", *[coalesce(df[c].cast("string"), lit("\x00")) for c in cols]), 256)
+        srcCols = [c for c in df.columns if c not in ("hz_fingerprint", "hz_docid")]
+        df = df.withColumn("hz_fingerprint", rowHash(srcCols))
+        if keyCols:
+            df = df.withColumn("hz_docid", rowHash(keyCols))
+            self.addTransformDescr("hz_docid", "SHA-256 hash of source variables {0}".format(", ".join(keyCols)))
+        else:
+            df = df.withColumn("hz_docid", df["hz_fingerprint"])
+            self.addTransformDescr("hz_docid", "SHA-256 hash of all source variables")
+        self.addTransformDescr("hz_fingerprint", "SHA-256 hash of all source variables")
+        return df
+
+    @instrumented
+    def diffFingerprints(self, df, fingerprintPath):
+        previousBatch = self._latestFingerprintBatch(fingerprintPath)
+        if previousBatch:
+            previous = self.hc.read.parquet("{0}/batch={1}".format(fingerprintPath, previousBatch))
+        else:
+            previous = self.hc.createDataFrame(self.hc._sc.emptyRDD(), StructType([
+                StructField("hz_docid", StringType()),
+                StructField("hz_fingerprint", StringType()),
+                StructField("hz_batch", IntegerType())]))
+        # new or changed rows - (docid, fingerprint) pair not seen in the previous run
+        df_changes = df.join(previous.select("hz_docid", "hz_fingerprint"), ["hz_docid", "hz_fingerprint"], "leftanti")
+        # deleted rows - docid no longer present in the source
+        df_deletes = previous.join(df.select("hz_docid"), ["hz_docid"], "leftanti").select("hz_docid", "hz_batch")
+        # previous versions of changed rows, and deleted rows, must be removed from the harmonized output
+        superseded = previous.join(df_changes.select("hz_docid"), ["hz_docid"], "leftsemi").select("hz_docid", "hz_batch").union(df_deletes)
+        self.incremental = {
+            "path": fingerprintPath,
+            "batch": (previousBatch or 0) + 1,
+            "previous": previous,
+            "changes": df_changes.select("hz_docid", "hz_fingerprint"),
+            "superseded": superseded,
+            "rewrittenBatches": []
+        }
+        print("Fingerprints compared to batch {0}, changes will be saved as batch {1}".format(previousBatch, self.incremental["batch"]))
+        return df_changes, df_deletes
+
+    def _saveIncrementalParquet(self, df, schema, table, tablepath, partitionBy=None, sortBy=None, targetFileSizeMB=None):
+        if not self.incremental:
+            raise ValueError("Call diffFingerprints() before saving incrementally")
+        batch = self.incremental["batch"]
+        superseded = self.incremental["superseded"]
+        fs, root = self._hadoopPath(tablepath)
+        tablename = "{0}.{1}".format(_sqlIdent(schema), _sqlIdent(table))
+        tableSchema = self.hc.table(tablename).schema if fs.exists(root) else None
+
+        def readBatch(path, basePath):
+            # typed by the table schema - partition discovery would otherwise re-infer column types (eg "007" as 7)
+            reader = self.hc.read.option("basePath", basePath)
+            if tableSchema is not None:
+                reader = reader.schema(tableSchema)
+            return reader.parquet(path).select(*df.columns)
+
+        # a previous attempt at this batch that failed before commitFingerprints() left hz_batch=<batch> behind - it
+        # is set aside (underscore directories are ignored by spark and athena) rather than appended to again. It
+        # also holds the surviving rows of partitions that attempt already rewrote and deleted, which are kept.
+        batchPath = self._hadoopPath("{0}/hz_batch={1}".format(tablepath, batch))[1]
+        retryPath = self._hadoopPath("{0}/_hz_retry_batch={1}".format(tablepath, batch))[1]
+        if fs.exists(batchPath):
+            fs.delete(retryPath, True)
+            fs.rename(batchPath, retryPath)
+            self.hc.sql("ALTER TABLE {0} DROP IF EXISTS PARTITION (hz_batch={1})".format(tablename, int(batch)))
+            print("Batch {0} was partly saved by a failed run - it is rewritten".format(batch))
+        df_out = df.withColumn("hz_batch", lit(batch))
+        # partitions holding superseded rows are rewritten into the new batch without those rows
+        supersededBatches = [r[0] for r in superseded.select("hz_batch").distinct().collect() if r[0] != batch]
+        affected = [b for b in supersededBatches if fs.exists(self._hadoopPath("{0}/hz_batch={1}".format(tablepath, b))[1])]
+        for b in affected:
+            survivors = readBatch("{0}/hz_batch={1}".format(tablepath, b), tablepath)
+            survivors = survivors.join(superseded.select("hz_docid"), ["hz_docid"], "leftanti")
+            df_out = df_out.union(survivors.withColumn("hz_batch", lit(batch)))
+        if fs.exists(retryPath):
+            # rows of the failed attempt, less this run's changes (saved again above), superseded rows, and rows still
+            # in partitions that are rewritten now
+            retried = readBatch(retryPath.toString(), retryPath.toString())
+            for rows in [superseded.select("hz_docid"), df.select("hz_docid")] + \
+                        [readBatch("{0}/hz_batch={1}".format(tablepath, b), tablepath).select("hz_docid") for b in affected]:
+                retried = retried.join(rows, ["hz_docid"], "leftanti")
+            df_out = df_out.union(retried.withColumn("hz_batch", lit(batch)))
+            # partitions the failed attempt already rewrote are also part of this batch now
+            affected += [b for b in supersededBatches if b not in affected]
+        df_out, options = self._parquetLayout(df_out, partitionBy, sortBy, targetFileSizeMB)
+        df_out.write.options(**options).saveAsTable("{0}.{1}".format(schema, table),
+                         path=tablepath,
+                         format='parquet',
+                         mode='append',
+                         partitionBy=["hz_batch"] + list(partitionBy or [])
+                        )
+        fs.delete(retryPath, True)
+        for b in affected:
+            # IF EXISTS - partitions rewritten by a failed attempt are already gone
+            fs.delete(self._hadoopPath("{0}/hz_batch={1}".format(tablepath, b))[1], True)
+            self.hc.sql("ALTER TABLE {0} DROP IF EXISTS PARTITION (hz_batch={1})".format(tablename, int(b)))
+        self.droppedPartitions[(schema, table)] = affected
+        self.hc.refreshTable("{0}.{1}".format(schema, table))
+        self.incremental["rewrittenBatches"] = affected
+        print("Saved batch {0}, rewrote {1} existing partitions".format(batch, len(affected)))
+
+    @instrumented
+    def commitFingerprints(self, keepBatches=2):
+        if not self.incremental:
+            raise ValueError("Call diffFingerprints() before committing fingerprints")
+        state = self.incremental
+        batch = state["batch"]
+        rewritten = state["rewrittenBatches"]
+        snapshot = state["previous"].join(state["superseded"].select("hz_docid"), ["hz_docid"], "leftanti")
+        if rewritten:
+            snapshot = snapshot.withColumn("hz_batch", when(snapshot["hz_batch"].isin(rewritten), lit(batch)).otherwise(snapshot["hz_batch"]))
+        snapshot = snapshot.union(state["changes"].withColumn("hz_batch", lit(batch)))
+        snapshot.write.parquet("{0}/batch={1}".format(state["path"], batch))
+        # remove old snapshots, keeping the most recent keepBatches
+        fs, root = self._hadoopPath(state["path"])
+        for b in self._fingerprintBatches(state["path"])[:-keepBatches]:
+            fs.delete(self._hadoopPath("{0}/batch={1}".format(state["path"], b))[1], True)
+        self.incremental = None
+        print("Fingerprints for batch {0} saved to {1}".format(batch, state["path"]))
+
+    def _fingerprintBatches(self, fingerprintPath):
+        # completed snapshots (with a _SUCCESS marker), in ascending order
+        fs, root = self._hadoopPath(fingerprintPath)
+        if not fs.exists(root):
+            return []
+        batches = []
+        for status in fs.listStatus(root):
+            m = re.match(r'^batch=(\d+)$', status.getPath().getName())
+            if m and fs.exists(self._hadoopPath("{0}/_SUCCESS".format(status.getPath().toString()))[1]):
+                batches.append(int(m.group(1)))
+        return sorted(batches)
+
+    def _latestFingerprintBatch(self, fingerprintPath):
+        batches = self._fingerprintBatches(fingerprintPath)
+        return batches[-1] if batches else None
+
+    def _hadoopPath(self, path):
+        sc = self.hc._sc
+        p = sc._jvm.org.apache.hadoop.fs.Path(path)
+        return p.getFileSystem(sc._jsc.hadoopConfiguration()), p
+
+    @instrumented
+    def dedupIncidents(self, df, keyCols=None, keyIndexPath=None, exact=True):
+        if keyCols:
+            missing = [c for c in keyCols if c not in df.columns]
+            if missing:
+                raise ValueError("Dedup key variables not found: {0}".format(", ".join(missing)))
+        else:
+            keyCols = [c for c in _DEDUP_KEY_COLS if c in df.columns]
+            if not keyCols:
+                raise ValueError("None of the default dedup key variables ({0}) found".format(", ".join(_DEDUP_KEY_COLS)))
+        # first 60 bits of the sha-256 of the normalized key values - fits a long, collisions negligible
+        values = [coalesce(lower(trim(df[c].cast("string"))), lit("\x00")) for c in keyCols]
+        key = conv(substring(sha2(concat_ws("\x01", *values), 256), 1, 15), 16, 10).cast("long")
+        df = df.withColumn("hz_dedupkey", key).dropDuplicates(["hz_dedupkey"])
+        self.addTransformDescr("hz_dedupkey", "Hash of {0} - one incident kept per value".format(", ".join(keyCols)))
+        if not keyIndexPath:
+            return df
+        previousBatch = self._latestFingerprintBatch(keyIndexPath)
+        previous = None
+        if previousBatch:
+            previous = self.hc.read.parquet("{0}/batch={1}".format(keyIndexPath, previousBatch))
+            bloom = self._loadBloom(keyIndexPath, previousBatch)
+            if bloom is None:
+                df = df.join(previous, ["hz_dedupkey"], "leftanti")
+            else:
+                seen = bloom(df["hz_dedupkey"])
+                unseen = df.where(~seen)
+                candidates = df.where(seen)
+                if exact:
+                    # only keys the filter reports as possibly seen are joined to the key index
+                    candidates = candidates.join(previous, ["hz_dedupkey"], "leftanti")
+                    df = unseen.union(candidates.select(*unseen.columns))
+                else:
+                    df = unseen
+        self.dedup = {
+            "path": keyIndexPath,
+            "batch": (previousBatch or 0) + 1,
+            "previous": previous,
+            "keys": df.select("hz_dedupkey")
+        }
+        print("Dedup keys compared to batch {0}, kept keys will be saved as batch {1}".format(previousBatch, self.dedup["batch"]))
+        return df
+
+    def _loadBloom(self, keyIndexPath, batch):
+        # udf testing keys against a saved Bloom filter, or None if the batch has no filter
+        fs, p = self._hadoopPath("{0}/bloom={1}".format(keyIndexPath, batch))
+        if not fs.exists(p):
+            return None
+        r = self.hc.read.parquet("{0}/bloom={1}".format(keyIndexPath, batch)).first()
+        bits, numBits, numHashes = self.hc._sc.broadcast(bytearray(r["bits"])), r["numBits"], r["numHashes"]
+
+        def mightContain(key):
+            if key is None:
+                return False
+            b = bits.value
+            h1, h2 = key & 0xffffffff, (key >> 32) | 1
+            for i in range(numHashes):
+                pos = (h1 + i * h2) % numBits
+                if not (b[pos >> 3] >> (pos & 7)) & 1:
+                    return False
+            return True
+        return udf(mightContain, BooleanType())
+
+    @instrumented
+    def commitDedupKeys(self, df=None, keepBatches=2, fpp=0.01):
+        if not self.dedup:
+            raise ValueError("Call dedupIncidents() with a keyIndexPath before committing dedup keys")
+        state = self.dedup
+        path, batch = state["path"], state["batch"]
+        keys = df.select("hz_dedupkey") if df is not None else state["keys"]
+        if state["previous"] is not None:
+            keys = state["previous"].union(keys)
+        # range partitioned and sorted, so parquet min/max statistics prune lookups by key
+        keysPath = "{0}/batch={1}".format(path, batch)
+        keys.orderBy("hz_dedupkey").write.parquet(keysPath)
+        keys = self.hc.read.parquet(keysPath)
+        n = keys.count()
+        if n:
+            numBits, numHashes = _bloomSize(n, fpp)
+
+            def buildBloom(rows):
+                # one bit array per partition, with the bits of all its keys set
+                bloom = numpy.zeros(numBits // 8, dtype=numpy.uint8)
+                chunk = []
+                for r in rows:
+                    chunk.append(r[0])
+                    if len(chunk) == 100000:
+                        setBits(bloom, chunk)
+                        chunk = []
+                setBits(bloom, chunk)
+                yield bloom
+
+            def setBits(bloom, chunk):
+                if not chunk:
+                    return
+                k = numpy.array(chunk, dtype=numpy.int64)
+                h1, h2 = k & 0xffffffff, (k >> 32) | 1
+                for i in range(numHashes):
+                    pos = (h1 + i * h2) % numBits
+                    numpy.bitwise_or.at(bloom, pos >> 3, numpy.left_shift(1, pos & 7).astype(numpy.uint8))
+
+            bits = keys.rdd.mapPartitions(buildBloom).treeReduce(numpy.bitwise_or)
+            bloom = self.hc.createDataFrame([(bytearray(bits.tobytes()), numBits, numHashes, n)], StructType([
+                StructField("bits", BinaryType()),
+                StructField("numBits", LongType()),
+                StructField("numHashes", IntegerType()),
+                StructField("keys", LongType())]))
+            bloom.coalesce(1).write.parquet("{0}/bloom={1}".format(path, batch))
+            print("Bloom filter for {0} keys: {1} bits, {2} hashes".format(n, numBits, numHashes))
+        # remove old snapshots, keeping the most recent keepBatches
+        fs, root = self._hadoopPath(path)
+        for b in self._fingerprintBatches(path)[:-keepBatches]:
+            for name in ("batch", "bloom"):
+                fs.delete(self._hadoopPath("{0}/{1}={2}".format(path, name, b))[1], True)
+        self.dedup = None
+        metrics.add(rows=n)
+        print("Dedup keys for batch {0} saved to {1}".format(batch, path))
+
+    @instrumented
+    def executeAthenaDDL(self, athena_s3_staging_dir, ddlList, maxConcurrent=4):
+        executor = athenaExecutor.get(athena_s3_staging_dir, maxConcurrent=maxConcurrent)
+        results = executor.execute(ddlList)
+        metrics.add(statements=len(results))
+        return results
+
+    @instrumented
+    def publishNotebookToS3(self, outputdocpath, notebook_urlbase, notebookName, endpointUrl=None, waitSeconds=60, force=False, savedAfter=None):
+        # the javascript save action is asynchronous - wait for the saved ipynb before converting it to html, so both
+        # published files come from the new save
+        savedAfter = time.time() if savedAfter is None else savedAfter
+        publisher = s3Publisher.get(endpointUrl)
+        publisher.waitForFile(notebookName + ".ipynb", waitSeconds, newerThan=savedAfter)
+        subprocess.check_call(["jupyter", "nbconvert", "--to", "html", notebookName + ".ipynb"])
+        files = [(notebookName + "." + ext, outputdocpath + "/" + notebookName + "." + ext) for ext in ["ipynb", "html"]]
+        results = publisher.publish(files, force=force, waitSeconds=waitSeconds, newerThan=savedAfter)
         for ext in ["ipynb", "html"]:
-            src = notebookName + "." + ext
-            dest = outputdocpath + "/" + src
-            url = notebook_urlbase + "." + ext
-            print("Copy %s to %s" % (src, dest))
-            os.system("aws s3 cp %s %s --sse --grants read=uri=http://acs.amazonaws.com/groups/global/AllUsers" % (src, dest))
-            print("URL: %s" % (url))
+            print("URL: %s" % (notebook_urlbase + "." + ext))
+        return results
+
+
+# Deferred transformation builder - records the same renames, value mappings, casts and derived variables as the
+# harmonizeCrimeIncidents methods, and applies them all to the source dataframe as a single select() on finalize().
+# Variable mappings and transform descriptions are recorded in the harmonizeCrimeIncidents object as usual.
+class transformBuilder(object):
+
+    def __init__(self, hz, df):
+        self.hz = hz
+        self.df = df
+        self.names = list(df.columns)
+        self.exprs = dict((c, df[c]) for c in df.columns)
+        self.lookups = []
+
+    def _find(self, name):
+        # column names are resolved case insensitively, as in spark
+        if name in self.exprs:
+            return name
+        for c in self.names:
+            if c.lower() == name.lower():
+                return c
+        return None
+
+    def col(self, name):
+        # current expression for a variable - use to build derived variables from transformed variables
+        c = self._find(name)
+        if c is None:
+            raise ValueError("No variable <{0}> in transformation plan".format(name))
+        return self.exprs[c]
+
+    def withColumn(self, name, column):
+        c = self._find(name)
+        if c is None:
+            self.names.append(name)
+        else:
+            self.names[self.names.index(c)] = name
+            del self.exprs[c]
+        self.exprs[name] = column
+        return self
+
+    def drop(self, name):
+        c = self._find(name)
+        if c is not None:
+            self.names.remove(c)
+            del self.exprs[c]
+        return self
+
+    def cast(self, name, dataType):
+        return self.withColumn(name, self.col(name).cast(dataType))
+
+    def mapVar(self, oldvar, newvar, keepOrig=False):
+        if (newvar == oldvar):
+            if not keepOrig:
+                print("original variable {0} already matched target variable name - making no changes".format(oldvar))
+                return self
+            else:
+                oldvar2 = oldvar + "_orig"
+                c = self._find(oldvar)
+                self.names[self.names.index(c)] = oldvar2
+                self.exprs[oldvar2] = self.exprs.pop(c)
+                print("rename original variable {0} to {1}".format(oldvar,oldvar2)) 
+                oldvar = oldvar2
+        self.hz.varmap[oldvar]=newvar
+        self.hz.varmapreverse[newvar]=oldvar
+        self.withColumn(newvar, self.col(oldvar))
+        print("New variable <{0}> created from <{1}>".format(newvar, oldvar))
+        if not keepOrig and not oldvar.lower() == newvar.lower():
+            self.drop(oldvar)
+            print("Dropped variable <{}>".format(oldvar))
+        return self
+
+    def mapValues(self, col, valueMappings, matchType="exact", broadcastThreshold=100):
+        mapped, lookup = self.hz._valueMappingPlan(self.col(col), valueMappings, matchType, broadcastThreshold)
+        if lookup:
+            self.lookups.append(lookup)
+        # mapped variable moves to the first position, as with harmonizeCrimeIncidents.mapValues
+        self.drop(col)
+        self.names.insert(0, col)
+        self.exprs[col] = mapped
+        self.hz.addTransformDescr(col, _valueMappingDescr(valueMappings, matchType))
+        print("Values for {0} converted per supplied mapping".format(col))
+        return self
+
+    def makeValidVariableNames(self):
+        for col in list(self.names):
+            newcol = _validVariableName(col)
+            if newcol != col:
+                self.mapVar(col, newcol)
+        return self
+
+    def setColDataTypes(self, df_dict=None, geoPoint=True, reportFailures=False):
+        # resolving the projection's types only analyzes the plan, it does not run a job
+        df = self.finalize()
+        casts = self.hz._colDataTypeCasts(df.dtypes, self.hz._dictVarTypes(df_dict), geoPoint)
+        if casts and reportFailures:
+            self.hz._reportCastFailures(df, dict((col, _castExpr(df[col], col_type)) for col, col_type in casts), dict(casts))
+        for col,col_type in casts:
+            self.withColumn(col, _castExpr(self.col(col), col_type))
+        return self
+
+    @instrumented
+    def finalize(self):
+        # broadcast lookup tables for large value mappings are joined first, in the order they were recorded
+        df = self.df
+        for lookup, cond in self.lookups:
+            df = df.join(broadcast(lookup), cond, "left_outer")
+        return df.select(*[self.exprs[c].alias(c) for c in self.names])
@@ -0,0 +1,271 @@
+'''
+Stream raw city datasets from the publishing website directly to S3, without staging them on the driver's disk.
+
+The HTTP response is read in chunks and written to S3 with a multipart upload, optionally gzip compressed (or
+converted to parquet, when pyarrow is installed) on the fly. The source ETag and Last-Modified headers are saved as
+S3 object metadata, and sent as If-None-Match / If-Modified-Since on the next run, so unchanged feeds are skipped.
+Interrupted downloads are resumed with HTTP range requests. When the server gives the length of the resource
+(Content-Length, or Content-Range of a resumed download), a response that ends early is treated as interrupted, so a
+truncated dataset is never saved as complete.
+
+Methods:
+
+- constructor (__init__)
+    Parameters:
+    - endpointUrl (str) - Optional S3 endpoint URL, eg for a local S3 compatible server
+    - chunkSize (int) - Size in bytes of the chunks read from the HTTP response
+    - partSize (int) - Size in bytes of multipart upload parts (minimum 5MB)
+    - maxResumes (int) - Maximum number of times an interrupted download is resumed with a range request
+    - sse (str) - S3 server side encryption, or None
+
+- copyUrlToS3(self, url, s3path, compress=None, force=False):
+    Copies the resource at url to s3path. Returns True if the dataset was copied, False if it was skipped
+    because the source is unchanged since the last copy.
+    Parameters:
+    - url (str) - HTTP(S) URL of the source dataset
+    - s3path (str) - Target S3 path, eg s3://bucket/crimedata/raw/Baltimore.csv.gz
+    - compress (str) - None | gzip | parquet (CSV source only, requires pyarrow)
+    - force (bool) - Copy even if the source is unchanged
+'''
+
+from __future__ import print_function
+import csv
+import io
+import re
+import time
+import zlib
+import boto3
+import botocore.exceptions
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+try:
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+try:
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# File-like writer that uploads everything written to it as an S3 multipart upload
+class s3multipartwriter(object):
+
+    def __init__(self, s3, bucket, key, partSize, metadata, sse=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.partSize = partSize
+        args = {"Bucket": bucket, "Key": key, "Metadata": metadata}
+        if sse:
+            args["ServerSideEncryption"] = sse
+        self.uploadId = s3.create_multipart_upload(**args)["UploadId"]
+        self.parts = []
+        self.buf = []
+        self.bufBytes = 0
+        self.written = 0
+        self.closed = False
+
+    def write(self, data):
+        if not data:
+            return
+        self.buf.append(bytes(data))
+        self.bufBytes += len(data)
+        self.written += len(data)
+        if self.bufBytes >= self.partSize:
+            self._uploadPart()
+
+    def tell(self):
+        return self.written
+
+    def flush(self):
+        pass
+
+    def _uploadPart(self):
+        body = b"".join(self.buf)
+        self.buf = []
+        self.bufBytes = 0
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId, PartNumber=number, Body=body)
+        self.parts.append({"PartNumber": number, "ETag": response["ETag"]})
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buf or not self.parts:
+            self._uploadPart()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                                          MultipartUpload={"Parts": self.parts})
+        self.closed = True
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId)
+        self.closed = True
+
+
+def _resourceLength(response, offset=0):
+    # total length of the resource from a response starting at offset - None if the server doesn't say (eg chunked)
+    info = response.info()
+    m = re.match(r'^bytes (\d+)-\d+/(\d+|\*)$', info.get("Content-Range") or "")
+    if m and int(m.group(1)) != offset:
+        raise IOError("Resumed download starts at byte {0}, expected {1}".format(m.group(1), offset))
+    if m and m.group(2) != "*":
+        return int(m.group(2))
+    if info.get("Content-Length"):
+        return offset + int(info.get("Content-Length"))
+    return None
+
+
+# File-like reader over an HTTP response, that resumes with a range request if the connection drops, or if the
+# response ends before the length announced by the server
+class _resumingreader(object):
+
+    def __init__(self, ingest, url, response, etag):
+        self.ingest = ingest
+        self.url = url
+        self.response = response
+        self.etag = etag
+        self.offset = 0
+        self.length = _resourceLength(response)
+        self.resumes = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        size = self.ingest.chunkSize if size is None or size < 0 else size
+        while True:
+            try:
+                data = self.response.read(size)
+                if not data and self.length is not None and self.offset < self.length:
+                    raise IOError("response ended at {0} of {1} bytes".format(self.offset, self.length))
+                self.offset += len(data)
+                return data
+            except (IOError, httplib.HTTPException) as e:
+                if self.resumes >= self.ingest.maxResumes:
+                    raise
+                self.resumes += 1
+                print("Download interrupted at {0} bytes ({1}) - resuming".format(self.offset, e))
+                time.sleep(2 ** self.resumes)
+                headers = {"Range": "bytes={0}-".format(self.offset)}
+                if self.etag:
+                    headers["If-Range"] = self.etag
+                self.response = urlopen(Request(self.url, headers=headers))
+                if self.response.getcode() != 206:
+                    raise IOError("Source does not support resuming downloads (HTTP {0})".format(self.response.getcode()))
+                self.length = _resourceLength(self.response, self.offset) or self.length
+
+    def close(self):
+        self.response.close()
+        self.closed = True
+
+
+# File-like reader returning some already read bytes before the rest of another reader
+class _prependreader(object):
+
+    def __init__(self, head, reader):
+        self.head = head
+        self.reader = reader
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, b""
+            return data
+        return self.reader.read(size)
+
+    def close(self):
+        self.closed = True
+
+
+class ingestSource(object):
+
+    def __init__(self, endpointUrl=None, chunkSize=1024*1024, partSize=16*1024*1024, maxResumes=5, sse="AES256"):
+        self.s3 = boto3.client("s3", endpoint_url=endpointUrl)
+        self.chunkSize = chunkSize
+        self.partSize = max(partSize, 5*1024*1024)
+        self.maxResumes = maxResumes
+        self.sse = sse
+
+    def copyUrlToS3(self, url, s3path, compress=None, force=False):
+        bucket, key = s3path.replace("s3://", "", 1).split("/", 1)
+        headers = {}
+        if not force:
+            # conditional request using the validators saved with the previous copy
+            try:
+                previous = self.s3.head_object(Bucket=bucket, Key=key).get("Metadata", {})
+            except botocore.exceptions.ClientError:
+                previous = {}
+            if previous.get("source-etag"):
+                headers["If-None-Match"] = previous["source-etag"]
+            if previous.get("source-last-modified"):
+                headers["If-Modified-Since"] = previous["source-last-modified"]
+        print("Downloading {0}".format(url))
+        start = time.time()
+        try:
+            response = urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            if e.code == 304:
+                print("Source unchanged since last copy - skipping {0}".format(s3path))
+                return False
+            raise
+        etag = response.info().get("ETag")
+        metadata = {"source-url": url}
+        if etag:
+            metadata["source-etag"] = etag
+        if response.info().get("Last-Modified"):
+            metadata["source-last-modified"] = response.info().get("Last-Modified")
+
+        reader = _resumingreader(self, url, response, etag)
+        writer = s3multipartwriter(self.s3, bucket, key, self.partSize, metadata, self.sse)
+        try:
+            if compress == "parquet":
+                self._copyAsParquet(reader, writer)
+            elif compress == "gzip":
+                self._copyGzip(reader, writer)
+            else:
+                self._copy(reader, writer)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+        finally:
+            reader.close()
+        elapsed = max(time.time() - start, 0.001)
+        print("Copied {0} bytes ({1} bytes written) to {2} in {3:.0f}s ({4:.1f} MB/s)".format(
+            reader.offset, writer.written, s3path, elapsed, reader.offset / elapsed / (1024*1024)))
+        return True
+
+    def _copy(self, reader, writer):
+        while True:
+            chunk = reader.read(self.chunkSize)
+            if not chunk:
+                break
+            writer.write(chunk)
+
+    def _copyGzip(self, reader, writer):
+        # wbits 16+MAX_WBITS produces a gzip container, readable by spark/hadoop as a .gz file
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        while True:
+            chunk = reader.read(self.chunkSize)
+            if not chunk:
+                break
+            writer.write(compressor.compress(chunk))
+        writer.write(compressor.flush())
+
+    def _copyAsParquet(self, reader, writer):
+        if pyarrow is None:
+            raise ValueError("Conversion to parquet requires pyarrow")
+        # all columns read as strings, as with inferSchema='false' in the notebooks - column names from the header row
+        head = reader.read(self.chunkSize)
+        names = next(csv.reader(io.StringIO(head.split(b"\n", 1)[0].decode("utf-8"))))
+        batches = pyarrow.csv.open_csv(_prependreader(head, reader),
+                                       read_options=pyarrow.csv.ReadOptions(block_size=self.chunkSize),
+                                       convert_options=pyarrow.csv.ConvertOptions(
+                                           column_types=dict((n, pyarrow.string()) for n in names)))
+        pqwriter = pyarrow.parquet.ParquetWriter(writer, batches.schema)
+        for batch in batches:
+            pqwriter.write_table(pyarrow.Table.from_batches([batch]))
+        pqwriter.close()
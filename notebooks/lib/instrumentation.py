@@ -0,0 +1,282 @@
+'''
+Stage level timing and metrics for the harmonization and indexing libraries.
+
+Public methods of harmonizeCrimeIncidents, esindex and harmonizeCities are decorated with @instrumented, which records
+one metrics record per call in the shared metrics object: wall time, status, the Spark job and stage ids run by the
+call (each call runs in its own Spark job group - see pinnedThreads()), and stats reported by the method itself - row counts where they are
+known without an extra scan (eg materialize, saveToEs), bytes written, cast failures and elasticsearch bulk stats.
+Nested calls (eg mapVar called by makeValidVariableNames) are recorded with their parent stage.
+Not instrumented: the metadata setters addVarGroup, addVarMetadata and addTransformDescr, which run no Spark jobs, and
+the iterPandasBatches generator - a decorator would only time creating it, its jobs run as batches are consumed and are
+recorded by the caller's stage (eg toPandasBounded).
+
+Records are kept in memory for the run summary, and passed to any number of sinks as they complete.
+
+Usage (eg in a notebook):
+    from lib.instrumentation import metrics, jsonFileSink, statsdSink
+    metrics.addSink(jsonFileSink("/tmp/harmonize-metrics.jsonl"))
+    ... harmonize, save and index ...
+    metrics.report()
+
+Methods:
+
+- runMetrics constructor (__init__) - the shared instance is lib.instrumentation.metrics
+    Parameters:
+    - countRows (bool) - Also count the rows of dataframes passed to and returned by instrumented methods. Each count
+        is an extra Spark job, so this is off by default.
+
+- addSink(self, sink):
+    Adds a sink - any object with an emit(record) method. Sink errors are printed, and never fail the pipeline.
+
+- stage(self, name, **tags):
+    Context manager recording a metrics record for the enclosed code, eg with metrics.stage("loadSource", city=city)
+
+- add(self, **stats):
+    Adds stats to the record of the current stage in this thread - numbers are summed, other values replaced.
+
+- summary(self):
+    Returns a list of per stage totals (calls, seconds, rows, bytesWritten, failures, Spark jobs) for the run, slowest first.
+
+- report(self):
+    Prints the run summary, and passes it to the sinks as a record with type "summary". Returns the summary.
+
+- reset(self):
+    Clears recorded metrics and starts a new run id.
+
+- pinnedThreads(sc=None):
+    Returns True if py4j runs in pinned thread mode (PYSPARK_PIN_THREAD, the default from Spark 3.2), where each
+    python thread has its own JVM thread. Thread local Spark properties - job groups, scheduler pools - set from a
+    python thread only apply to the jobs it submits in this mode. Otherwise stages only track job groups on the
+    main thread.
+
+Sinks:
+
+- logSink(logger="harmonize.metrics", level=logging.INFO) - one json formatted log message per record
+- jsonFileSink(path) - appends one json line per record to a local file
+- statsdSink(host="127.0.0.1", port=8125, prefix="harmonize") - sends StatsD timers and counters over UDP
+'''
+
+from __future__ import print_function
+import contextlib
+import functools
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+from pyspark import SparkContext
+
+
+# stats that are emitted as statsd counters, when present in a record
+_COUNTERS = ("rows", "inputRows", "outputRows", "bytesWritten", "docs", "failed", "retries", "rejected", "castFailures")
+
+
+def _sparkContext():
+    return SparkContext._active_spark_context
+
+
+def pinnedThreads(sc=None):
+    sc = sc or _sparkContext()
+    try:
+        from py4j.clientserver import ClientServer
+    except ImportError:
+        return False
+    return sc is not None and isinstance(sc._gateway, ClientServer)
+
+
+def _isDataFrame(value):
+    # duck typed, to avoid importing pyspark.sql here
+    return hasattr(value, "rdd") and hasattr(value, "columns") and hasattr(value, "count")
+
+
+class logSink(object):
+
+    def __init__(self, logger="harmonize.metrics", level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def emit(self, record):
+        self.logger.log(self.level, json.dumps(record, sort_keys=True, default=str))
+
+
+class jsonFileSink(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, sort_keys=True, default=str) + "\n"
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class statsdSink(object):
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="harmonize"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, record):
+        if record.get("type") != "stage":
+            return
+        name = "{0}.{1}.{2}".format(self.prefix, record["component"], record["stage"])
+        lines = ["{0}.seconds:{1}|ms".format(name, int(record["seconds"] * 1000)),
+                 "{0}.{1}:1|c".format(name, record["status"])]
+        for key in _COUNTERS:
+            if isinstance(record.get(key), (int, float)):
+                lines.append("{0}.{1}:{2}|c".format(name, key, record[key]))
+        self.sock.sendto("\n".join(lines).encode("utf-8"), self.address)
+
+
+class runMetrics(object):
+
+    def __init__(self, countRows=False):
+        self.countRows = countRows
+        self.sinks = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.runId = uuid.uuid4().hex[:12]
+            self.records = []
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def add(self, **stats):
+        stack = self._stack()
+        if not stack:
+            return
+        record = stack[-1]
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(record.get(key), (int, float)):
+                record[key] += value
+            else:
+                record[key] = value
+
+    @contextlib.contextmanager
+    def stage(self, name, component="pipeline", **tags):
+        stack = self._stack()
+        record = dict(tags)
+        record.update({
+            "type": "stage",
+            "run": self.runId,
+            "stage": name,
+            "component": component,
+            "parent": stack[-1]["stage"] if stack else None,
+            "thread": threading.current_thread().name,
+            "start": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "jobIds": []
+        })
+        # each stage runs its Spark jobs in its own job group, so they can be listed when it completes - job groups
+        # are JVM thread local, so other python threads are only tracked in pinned thread mode
+        sc = _sparkContext()
+        if sc is not None and threading.current_thread().name != "MainThread" and not pinnedThreads(sc):
+            sc = None
+        group = "{0}-{1}".format(name, uuid.uuid4().hex[:8])
+        if sc is not None:
+            previous = (sc.getLocalProperty("spark.jobGroup.id"), sc.getLocalProperty("spark.job.description"))
+            record["pool"] = sc.getLocalProperty("spark.scheduler.pool")
+            sc.setJobGroup(group, "{0}.{1}".format(component, name))
+        stack.append(record)
+        start = time.time()
+        try:
+            yield record
+            record["status"] = "ok"
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = "{0}: {1}".format(type(e).__name__, e)
+            raise
+        finally:
+            record["seconds"] = round(time.time() - start, 3)
+            stack.pop()
+            if sc is not None:
+                sc.setLocalProperty("spark.jobGroup.id", previous[0])
+                sc.setLocalProperty("spark.job.description", previous[1])
+                self._sparkJobs(sc, group, record)
+            if stack:
+                # jobs run by nested stages also belong to the enclosing stage
+                stack[-1]["jobIds"] = stack[-1]["jobIds"] + record["jobIds"]
+            self._complete(record)
+
+    def _sparkJobs(self, sc, group, record):
+        tracker = sc.statusTracker()
+        jobIds = sorted(set(record["jobIds"]) | set(tracker.getJobIdsForGroup(group)))
+        stageIds = set()
+        for jobId in jobIds:
+            info = tracker.getJobInfo(jobId)
+            if info:
+                stageIds.update(info.stageIds)
+        record["jobIds"] = jobIds
+        record["stageIds"] = sorted(stageIds)
+
+    def _complete(self, record):
+        with self.lock:
+            self.records.append(record)
+        self._emit(record)
+
+    def _emit(self, record):
+        for sink in self.sinks:
+            try:
+                sink.emit(record)
+            except Exception as e:
+                print("WARNING: metrics sink {0} failed: {1}".format(type(sink).__name__, e))
+
+    def summary(self):
+        totals = {}
+        with self.lock:
+            records = list(self.records)
+        for r in records:
+            key = (r["component"], r["stage"])
+            t = totals.setdefault(key, {"component": key[0], "stage": key[1], "calls": 0, "seconds": 0.0,
+                                        "rows": 0, "bytesWritten": 0, "failures": 0, "sparkJobs": 0})
+            t["calls"] += 1
+            t["failures"] += 1 if r.get("status") == "failed" else 0
+            t["sparkJobs"] += len(r.get("jobIds", []))
+            t["rows"] += r.get("rows") or r.get("outputRows") or 0
+            t["bytesWritten"] += r.get("bytesWritten") or 0
+            # nested stages are also included in the time of their parent stage
+            t["seconds"] += r["seconds"]
+        return sorted(totals.values(), key=lambda t: -t["seconds"])
+
+    def report(self):
+        summary = self.summary()
+        print("{0:<44} {1:>6} {2:>10} {3:>12} {4:>14} {5:>6}".format("stage", "calls", "seconds", "rows", "bytes written", "jobs"))
+        for t in summary:
+            print("{0:<44} {1:>6} {2:>10.1f} {3:>12} {4:>14} {5:>6}{6}".format(
+                "{0}.{1}".format(t["component"], t["stage"]), t["calls"], t["seconds"], t["rows"], t["bytesWritten"],
+                t["sparkJobs"], "  ({0} failed)".format(t["failures"]) if t["failures"] else ""))
+        self._emit({"type": "summary", "run": self.runId, "stages": summary})
+        return summary
+
+
+# shared by all instrumented objects in the process
+metrics = runMetrics()
+
+
+def instrumented(method):
+    # records a metrics stage for each call of a method, named after the method and the object's class
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with metrics.stage(method.__name__, component=type(self).__name__) as record:
+            if metrics.countRows:
+                inputs = [a for a in args if _isDataFrame(a)]
+                if inputs:
+                    record["inputRows"] = inputs[0].count()
+            result = method(self, *args, **kwargs)
+            if metrics.countRows and _isDataFrame(result):
+                record["outputRows"] = result.count()
+            return result
+    return wrapper
@@ -0,0 +1,27 @@
+'''
+Process wide instances shared by all threads, eg connection pools and clients reused across calls and tasks.
+
+Methods:
+
+- pooled(cls, key, *args, **kwargs):
+    Returns the instance of cls for key, creating it with cls(*args, **kwargs) on first use.
+    Parameters:
+    - cls (class) - Class of the pooled instance
+    - key (tuple) - Identifies the instance, or None to use the constructor arguments
+    - args, kwargs - Constructor arguments
+'''
+
+import threading
+
+
+_instances = {}
+_lock = threading.RLock()
+
+
+def pooled(cls, key, *args, **kwargs):
+    if key is None:
+        key = args + tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+    with _lock:
+        if (cls, key) not in _instances:
+            _instances[(cls, key)] = cls(*args, **kwargs)
+        return _instances[(cls, key)]
@@ -0,0 +1,165 @@
+'''
+Publish local artifacts (notebooks, html exports, dictionaries) to S3, concurrently, with one boto3 client.
+
+Files whose MD5 matches the object already in S3 (saved as object metadata) are skipped, so a failed publish can
+simply be run again.
+
+Methods:
+
+- get(cls, endpointUrl=None, **kwargs):
+    Returns the process wide publisher for the constructor arguments.
+
+- constructor (__init__)
+    Parameters:
+    - endpointUrl (str) - Optional S3 endpoint URL, eg for a local S3 compatible server
+    - maxConcurrent (int) - Maximum number of files uploaded at the same time
+    - sse (str) - S3 server side encryption, or None (eg for servers that don't support it)
+    - grantRead (str) - Grantee given read access to published objects - default all users (public web access), or None
+    - multipartThresholdMB (int) - Files larger than this are uploaded in parallel parts
+
+- publish(self, files, force=False, waitSeconds=60, newerThan=None):
+    Uploads files, and returns a dict of S3 path to "uploaded" or "skipped".
+    Raises ValueError listing the files that failed - other files are still published.
+    Parameters:
+    - files (list) - List of (local path, S3 path) pairs
+    - force (bool) - Upload even if the object in S3 has the same content
+    - waitSeconds (int) - Maximum time to wait for each file to exist and stop changing
+    - newerThan (float) - Optional time (seconds since the epoch) - wait for files modified after it, eg for files
+        saved asynchronously after a save was requested
+
+- waitForFile(self, path, waitSeconds=60, pollSeconds=0.5, newerThan=None):
+    Polls until the local file exists, was modified after newerThan (if set), and its size and modification time are
+    unchanged between two polls. Raises ValueError if the file isn't ready after waitSeconds.
+    newerThan is compared in whole seconds, for filesystems with 1 second modification times - a file modified in the
+    same second counts as newer.
+'''
+
+from __future__ import print_function
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import boto3
+import botocore.config
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+from .instrumentation import metrics
+from .pooling import pooled
+
+
+_ALL_USERS = 'uri="http://acs.amazonaws.com/groups/global/AllUsers"'
+
+# per file upload threads, for multipart uploads
+_PART_CONCURRENCY = 4
+
+
+def _md5(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class s3Publisher(object):
+
+    @classmethod
+    def get(cls, endpointUrl=None, **kwargs):
+        return pooled(cls, None, endpointUrl, **kwargs)
+
+    def __init__(self, endpointUrl=None, maxConcurrent=8, sse="AES256", grantRead=_ALL_USERS, multipartThresholdMB=64):
+        # boto3 clients are thread safe - one client, with enough pooled connections for all upload threads
+        config = botocore.config.Config(max_pool_connections=maxConcurrent * _PART_CONCURRENCY)
+        self.s3 = boto3.client("s3", endpoint_url=endpointUrl, config=config)
+        self.transfer = TransferConfig(multipart_threshold=multipartThresholdMB*1024*1024, max_concurrency=_PART_CONCURRENCY)
+        self.maxConcurrent = maxConcurrent
+        self.sse = sse
+        self.grantRead = grantRead
+
+    def waitForFile(self, path, waitSeconds=60, pollSeconds=0.5, newerThan=None):
+        deadline = time.time() + waitSeconds
+        last = None
+        while True:
+            try:
+                st = os.stat(path)
+                state = (st.st_size, st.st_mtime)
+            except OSError:
+                state = None
+            # an existing file may still be the previous version, until a save in progress replaces it
+            # modification times may be truncated to the second, so a save just after newerThan can look older
+            if state is not None and newerThan is not None and st.st_mtime < int(newerThan):
+                state = None
+            if state is not None and state == last:
+                return
+            if time.time() > deadline:
+                raise ValueError("{0} was not written within {1}s".format(path, waitSeconds))
+            last = state
+            time.sleep(pollSeconds)
+
+    def _remoteHash(self, bucket, key):
+        # md5 saved with the object, or the ETag (the md5 of objects uploaded in a single part)
+        try:
+            head = self.s3.head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError:
+            return None
+        return head.get("Metadata", {}).get("content-md5") or head.get("ETag", "").strip('"')
+
+    def _upload(self, path, s3path, force, waitSeconds, newerThan):
+        self.waitForFile(path, waitSeconds, newerThan=newerThan)
+        bucket, key = s3path.replace("s3://", "", 1).split("/", 1)
+        md5 = _md5(path)
+        if not force and self._remoteHash(bucket, key) == md5:
+            return "skipped", 0
+        extra = {"Metadata": {"content-md5": md5}}
+        contentType = mimetypes.guess_type(path)[0]
+        if contentType:
+            extra["ContentType"] = contentType
+        if self.sse:
+            extra["ServerSideEncryption"] = self.sse
+        if self.grantRead:
+            extra["GrantRead"] = self.grantRead
+        self.s3.upload_file(path, bucket, key, ExtraArgs=extra, Config=self.transfer)
+        return "uploaded", os.path.getsize(path)
+
+    def publish(self, files, force=False, waitSeconds=60, newerThan=None):
+        pending = queue.Queue()
+        for item in files:
+            pending.put(item)
+        results, failures, sizes = {}, [], []
+
+        def worker():
+            while True:
+                try:
+                    path, s3path = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    status, size = self._upload(path, s3path, force, waitSeconds, newerThan)
+                    results[s3path] = status
+                    sizes.append(size)
+                    if status == "uploaded":
+                        print("Copied {0} to {1}".format(path, s3path))
+                    else:
+                        print("Skipped {0} - unchanged since last published to {1}".format(path, s3path))
+                except Exception as e:
+                    failures.append((path, str(e)))
+                    print("Publish failed: {0}\n{1}".format(path, e))
+
+        start = time.time()
+        threads = [threading.Thread(target=worker) for i in range(min(self.maxConcurrent, len(files)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        uploaded = len([s for s in results.values() if s == "uploaded"])
+        metrics.add(bytesWritten=sum(sizes), uploaded=uploaded, skipped=len(results) - uploaded)
+        print("Published {0} files ({1} unchanged) in {2:.1f}s".format(uploaded, len(results) - uploaded, time.time() - start))
+        if failures:
+            raise ValueError("{0} files failed to publish: {1}".format(
+                len(failures), "; ".join("{0} ({1})".format(path, error) for path, error in failures)))
+        return results
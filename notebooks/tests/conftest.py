@@ -0,0 +1,72 @@
+'''
+Shared fixtures for the notebooks/lib tests.
+
+The tests run against local stand-ins (a JDBC driver, an HTTP server, an elasticsearch _bulk endpoint, an S3 client),
+so they don't need AWS, Athena or elasticsearch. Modules that import pyspark, boto3 or jaydebeapi are skipped when
+those packages aren't installed.
+'''
+
+import os
+import sys
+import threading
+
+import pytest
+
+# the notebooks import the library as lib.<module>
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# In memory stand-in for the boto3 S3 client calls used by the library - objects are kept as
+# (bucket, key) -> {"Body": bytes, "Metadata": dict, "ExtraArgs": dict}
+class fakeS3(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _record(self, name, **kwargs):
+        with self.lock:
+            self.calls.append((name, kwargs))
+
+    def head_object(self, Bucket, Key):
+        import botocore.exceptions
+        self._record("head_object", Bucket=Bucket, Key=Key)
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"Metadata": dict(obj["Metadata"]), "ContentLength": len(obj["Body"])}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        self._record("upload_file", Filename=Filename, Bucket=Bucket, Key=Key)
+        with open(Filename, "rb") as f:
+            body = f.read()
+        extra = dict(ExtraArgs or {})
+        self.objects[(Bucket, Key)] = {"Body": body, "Metadata": extra.get("Metadata", {}), "ExtraArgs": extra}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        self._record("create_multipart_upload", Bucket=Bucket, Key=Key)
+        uploadId = "upload-%d" % len(self.uploads)
+        self.uploads[uploadId] = {"Bucket": Bucket, "Key": Key, "Metadata": Metadata or {}, "Parts": {}}
+        return {"UploadId": uploadId}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._record("upload_part", Bucket=Bucket, Key=Key, PartNumber=PartNumber)
+        self.uploads[UploadId]["Parts"][PartNumber] = Body
+        return {"ETag": '"part-%d"' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._record("complete_multipart_upload", Bucket=Bucket, Key=Key)
+        upload = self.uploads.pop(UploadId)
+        body = b"".join(upload["Parts"][p["PartNumber"]] for p in MultipartUpload["Parts"])
+        self.objects[(Bucket, Key)] = {"Body": body, "Metadata": upload["Metadata"], "ExtraArgs": {}}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._record("abort_multipart_upload", Bucket=Bucket, Key=Key)
+        self.uploads.pop(UploadId, None)
+
+
+@pytest.fixture
+def s3():
+    return fakeS3()
@@ -0,0 +1,170 @@
+import threading
+
+import pytest
+
+pytest.importorskip("pyspark")
+pytest.importorskip("jaydebeapi")
+
+from lib import athenaExecutor as athenaModule
+from lib.athenaExecutor import athenaExecutor, _statementTable
+
+
+# Stand-in JDBC driver - each statement runs for a short time, and start/end events are recorded in order
+class fakeDriver(object):
+
+    def __init__(self, seconds=0.05, fail=(), throttle=()):
+        self.seconds = seconds
+        self.fail = set(fail)
+        self.throttle = set(throttle)
+        self.events = []
+        self.connects = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def connect(self, driver, url, properties, jar):
+        with self.lock:
+            self.connects.append((driver, url, dict(properties), jar))
+        return fakeConnection(self)
+
+    def execute(self, ddl):
+        with self.lock:
+            if ddl in self.throttle:
+                self.throttle.discard(ddl)
+                raise Exception("ThrottlingException: Rate exceeded")
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.events.append(("start", ddl))
+        threading.Event().wait(self.seconds)
+        with self.lock:
+            self.active -= 1
+            self.events.append(("end", ddl))
+        if ddl in self.fail:
+            raise Exception("FAILED: line 1:8 mismatched input")
+
+
+class fakeStatement(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def setQueryTimeout(self, seconds):
+        pass
+
+    def execute(self, ddl):
+        self.driver.execute(ddl)
+
+    def close(self):
+        pass
+
+
+class fakeJConnection(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.closed = False
+
+    def createStatement(self):
+        return fakeStatement(self.driver)
+
+    def isClosed(self):
+        return self.closed
+
+
+class fakeConnection(object):
+
+    def __init__(self, driver):
+        self.jconn = fakeJConnection(driver)
+
+    def close(self):
+        self.jconn.closed = True
+
+
+@pytest.fixture
+def driver(monkeypatch):
+    d = fakeDriver()
+    monkeypatch.setattr(athenaModule, "jaydebeapi", d)
+    return d
+
+
+def _executor(**kwargs):
+    return athenaExecutor("s3://staging/athena/", url="jdbc:h2:mem:test", driver="org.h2.Driver", jar="/tmp/h2.jar", **kwargs)
+
+
+def _index(events, kind, ddl):
+    return events.index((kind, ddl))
+
+
+def test_statement_table():
+    assert _statementTable("CREATE EXTERNAL TABLE IF NOT EXISTS `incidents`.`baltimore` (x int)") == "incidents.baltimore"
+    assert _statementTable("DROP TABLE IF EXISTS incidents.Detroit") == "incidents.detroit"
+    assert _statementTable("MSCK REPAIR TABLE incidents.baltimore") == "incidents.baltimore"
+    assert _statementTable("CREATE DATABASE IF NOT EXISTS `incidents`;") is None
+
+
+def test_driver_settings_are_passed_to_connect(driver):
+    _executor(properties={"log_level": "DEBUG"}).execute("DROP TABLE IF EXISTS incidents.baltimore")
+    name, url, properties, jar = driver.connects[0]
+    assert (name, url, jar) == ("org.h2.Driver", "jdbc:h2:mem:test", "/tmp/h2.jar")
+    assert properties["s3_staging_dir"] == "s3://staging/athena/"
+    assert properties["log_level"] == "DEBUG"
+
+
+def test_table_statements_run_in_order_and_tables_concurrently(driver):
+    baltimore = ["DROP TABLE IF EXISTS incidents.baltimore",
+                 "CREATE EXTERNAL TABLE incidents.baltimore (x int)",
+                 "MSCK REPAIR TABLE incidents.baltimore"]
+    detroit = ["DROP TABLE IF EXISTS incidents.detroit",
+               "CREATE EXTERNAL TABLE incidents.detroit (x int)",
+               "MSCK REPAIR TABLE incidents.detroit"]
+    # interleaved, as collected from concurrent city threads
+    ddlList = [s for pair in zip(baltimore, detroit) for s in pair]
+    results = _executor(maxConcurrent=2).execute(ddlList)
+    assert sorted(ddl for ddl, seconds in results) == sorted(ddlList)
+    for group in (baltimore, detroit):
+        for before, after in zip(group, group[1:]):
+            assert _index(driver.events, "end", before) < _index(driver.events, "start", after)
+    assert driver.peak == 2
+    # connections are reused - no more than maxConcurrent are opened
+    assert len(driver.connects) == 2
+
+
+def test_statements_without_a_table_are_barriers(driver):
+    ddlList = ["CREATE DATABASE IF NOT EXISTS `incidents`;",
+               "CREATE EXTERNAL TABLE incidents.baltimore (x int)",
+               "CREATE EXTERNAL TABLE incidents.detroit (x int)",
+               "CREATE DATABASE IF NOT EXISTS `rollups`;",
+               "CREATE EXTERNAL TABLE rollups.baltimore (x int)"]
+    _executor(maxConcurrent=4).execute([ddlList])
+    events = driver.events
+    assert _index(events, "end", ddlList[0]) < _index(events, "start", ddlList[1])
+    assert _index(events, "end", ddlList[0]) < _index(events, "start", ddlList[2])
+    assert _index(events, "end", ddlList[1]) < _index(events, "start", ddlList[3])
+    assert _index(events, "end", ddlList[2]) < _index(events, "start", ddlList[3])
+    assert _index(events, "end", ddlList[3]) < _index(events, "start", ddlList[4])
+
+
+def test_failure_stops_the_table_and_later_segments(driver):
+    driver.fail.add("CREATE EXTERNAL TABLE incidents.baltimore (x int)")
+    ddlList = ["CREATE EXTERNAL TABLE incidents.baltimore (x int)",
+               "MSCK REPAIR TABLE incidents.baltimore",
+               "CREATE EXTERNAL TABLE incidents.detroit (x int)",
+               "MSCK REPAIR TABLE incidents.detroit",
+               "CREATE DATABASE IF NOT EXISTS `rollups`;"]
+    with pytest.raises(ValueError) as e:
+        _executor(maxConcurrent=2).execute(ddlList)
+    assert "1 Athena DDL statements failed" in str(e.value)
+    started = [ddl for kind, ddl in driver.events if kind == "start"]
+    # the other table still completes, statements after the failure (and after the barrier) don't run
+    assert "MSCK REPAIR TABLE incidents.detroit" in started
+    assert "MSCK REPAIR TABLE incidents.baltimore" not in started
+    assert "CREATE DATABASE IF NOT EXISTS `rollups`;" not in started
+
+
+def test_throttled_statements_are_retried(driver, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(athenaModule.time, "sleep", sleeps.append)
+    driver.throttle.add("MSCK REPAIR TABLE incidents.baltimore")
+    results = _executor().execute(["MSCK REPAIR TABLE incidents.baltimore"])
+    assert [ddl for ddl, seconds in results] == ["MSCK REPAIR TABLE incidents.baltimore"]
+    assert sleeps == [2]
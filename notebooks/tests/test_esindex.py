@@ -0,0 +1,175 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pyspark")
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from lib.esindex import esconnection, writecontroller, bulkwriter
+
+
+# Stand-in elasticsearch _bulk endpoint - server.status(doc number, request number) gives the item status of each
+# document, server.delay the seconds taken by each request. In flight requests and indexed documents are counted.
+class bulkHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with server.lock:
+            server.requests += 1
+            number = server.requests
+            server.inFlight += 1
+            server.peak = max(server.peak, server.inFlight)
+        time.sleep(server.delay)
+        if self.path == "/_bulk":
+            lines = [l for l in body.split(b"\n") if l]
+            docs = [json.loads(l.decode("utf-8")) for l in lines[1::2]]
+            items = []
+            for doc in docs:
+                status = server.status(doc["n"], number)
+                items.append({"index": {"status": status, "error": {"type": "rejected"}} if status >= 300 else {"status": status}})
+                if status < 300:
+                    with server.lock:
+                        server.indexed.append(doc["n"])
+            out = {"errors": any(i["index"]["status"] >= 300 for i in items), "items": items}
+        else:
+            out = {"acknowledged": True}
+        with server.lock:
+            server.inFlight -= 1
+        data = json.dumps(out).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        # /close drops the connection after responding, without announcing it - the client keeps it as idle
+        self.close_connection = self.path == "/close"
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class bulkServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def es():
+    server = bulkServer(("127.0.0.1", 0), bulkHandler)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.inFlight = 0
+    server.peak = 0
+    server.delay = 0.0
+    server.indexed = []
+    server.status = lambda n, request: 201
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    server.port = server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_controller_grows_additively_and_halves_on_pushback():
+    c = writecontroller(bulkDocs=1000, minBulkDocs=100, maxBulkDocs=1200, maxInFlight=4, targetLatency=1.0)
+    c.concurrency = 1
+    c.record(0.1, 0)
+    assert (c.bulkDocs, c.concurrency) == (1100, 2)
+    c.record(0.1, 0)
+    c.record(0.1, 0)
+    c.record(0.1, 0)
+    assert (c.bulkDocs, c.concurrency) == (1200, 4)
+    c.record(0.1, 3)
+    assert (c.bulkDocs, c.concurrency) == (600, 2)
+    c.record(5.0, 0)
+    assert (c.bulkDocs, c.concurrency) == (300, 1)
+    c.record(5.0, 0)
+    c.record(5.0, 0)
+    assert (c.bulkDocs, c.concurrency) == (100, 1)
+
+
+def test_rejected_documents_are_retried_and_shrink_batches(es):
+    # every document of the first two requests is rejected with 429 (queue full)
+    es.status = lambda n, request: 429 if request <= 2 else 201
+    controller = writecontroller(bulkDocs=50, minBulkDocs=10, maxBulkDocs=100, maxInFlight=2)
+    history = []
+    record = controller.record
+
+    def recording(latency, rejected):
+        record(latency, rejected)
+        history.append(controller.bulkDocs)
+
+    controller.record = recording
+    writer = bulkwriter("127.0.0.1", es.port, "incidents", "incidents", controller=controller, retryWait=0.001)
+    for n in range(200):
+        writer.add({"n": n})
+    assert writer.close() == []
+    assert sorted(es.indexed) == list(range(200))
+    assert writer.stats["docs"] == 200
+    assert writer.stats["rejected"] > 0
+    assert writer.stats["retries"] == writer.stats["rejected"]
+    assert min(history) < 50
+
+
+def test_bulk_requests_in_flight_are_bounded(es):
+    es.delay = 0.05
+    controller = writecontroller(bulkDocs=20, minBulkDocs=10, maxBulkDocs=20, maxInFlight=2)
+    writers = [bulkwriter("127.0.0.1", es.port, "incidents", "incidents", controller=controller) for i in range(4)]
+
+    def load(writer, offset):
+        for n in range(offset, offset + 200):
+            writer.add({"n": n})
+        writer.close()
+
+    threads = [threading.Thread(target=load, args=(w, i * 200)) for i, w in enumerate(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(es.indexed) == list(range(800))
+    assert es.peak == 2
+
+
+def test_non_retryable_failures_are_dead_lettered(es):
+    es.status = lambda n, request: 400 if n == 7 else 201
+    writer = bulkwriter("127.0.0.1", es.port, "incidents", "incidents",
+                        controller=writecontroller(bulkDocs=5, minBulkDocs=5, maxBulkDocs=5), retryWait=0.001)
+    for n in range(20):
+        writer.add({"n": n}, docid=str(n))
+    dead = [json.loads(d) for d in writer.close()]
+    assert [(d["doc"]["n"], d["status"], d["action"]["index"]["_id"]) for d in dead] == [(7, 400, "7")]
+    assert writer.stats["failed"] == 1
+    assert writer.stats["retries"] == 0
+
+
+def test_stale_pooled_connection_is_resent(es):
+    conn = esconnection("127.0.0.1", es.port)
+    # the server closes the kept-alive connection after responding - the pooled connection is stale, and the
+    # request fails before reaching the server
+    assert conn.request("POST", "/close", "{}")[0] == 200
+    time.sleep(0.1)
+    assert conn.request("POST", "/index", "{}")[0] == 200
+    assert es.requests == 2
+
+
+def test_timeout_is_not_resent(es):
+    conn = esconnection("127.0.0.1", es.port, timeout=0.2)
+    assert conn.request("POST", "/index", "{}")[0] == 200
+    es.delay = 1.0
+    with pytest.raises(socket.timeout):
+        conn.request("POST", "/index", "{}")
+    time.sleep(1.0)
+    assert es.requests == 2
@@ -0,0 +1,109 @@
+import threading
+
+import pytest
+
+pytest.importorskip("boto3")
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from lib import ingestSource as ingestModule
+from lib.ingestSource import ingestSource
+
+
+DATA = bytes(bytearray(range(256))) * 400
+ETAG = '"v1"'
+
+
+# Stand-in dataset server - the first (unranged) response is cut short after truncateAt bytes, range requests
+# are answered from the requested offset (or with a full 200 response if ignoreRange is set)
+class datasetHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict((k, self.headers.get(k)) for k in ("Range", "If-Range", "If-None-Match")))
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        rng = self.headers.get("Range")
+        if rng and not server.ignoreRange and self.headers.get("If-Range") == ETAG:
+            start = int(rng.split("=")[1].rstrip("-")) + server.rangeSkew
+            self.send_response(206)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(DATA) - 1, len(DATA)))
+            self.send_header("Content-Length", str(len(DATA) - start))
+            self.end_headers()
+            self.wfile.write(DATA[start:])
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(DATA)))
+        self.end_headers()
+        self.wfile.write(DATA[:server.truncateAt])
+
+
+@pytest.fixture
+def dataset():
+    server = HTTPServer(("127.0.0.1", 0), datasetHandler)
+    server.requests = []
+    server.truncateAt = len(DATA)
+    server.ignoreRange = False
+    server.rangeSkew = 0
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    server.url = "http://127.0.0.1:%d/rows.csv" % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def ingest(s3, monkeypatch):
+    monkeypatch.setattr(ingestModule.time, "sleep", lambda seconds: None)
+    i = ingestSource(endpointUrl="http://127.0.0.1:9", chunkSize=4096, sse=None, maxResumes=2)
+    i.s3 = s3
+    return i
+
+
+def test_copy_saves_source_validators(ingest, dataset, s3):
+    assert ingest.copyUrlToS3(dataset.url, "s3://bucket/raw/City.csv") is True
+    obj = s3.objects[("bucket", "raw/City.csv")]
+    assert obj["Body"] == DATA
+    assert obj["Metadata"]["source-etag"] == ETAG
+    # unchanged source - the conditional request is answered with 304, and nothing is uploaded
+    assert ingest.copyUrlToS3(dataset.url, "s3://bucket/raw/City.csv") is False
+    assert dataset.requests[-1]["If-None-Match"] == ETAG
+    assert len([c for c in s3.calls if c[0] == "create_multipart_upload"]) == 1
+
+
+def test_truncated_response_is_resumed_with_a_range_request(ingest, dataset, s3):
+    dataset.truncateAt = 30000
+    assert ingest.copyUrlToS3(dataset.url, "s3://bucket/raw/City.csv") is True
+    assert s3.objects[("bucket", "raw/City.csv")]["Body"] == DATA
+    assert len(dataset.requests) == 2
+    assert dataset.requests[1]["Range"] == "bytes=30000-"
+    assert dataset.requests[1]["If-Range"] == ETAG
+
+
+def test_source_without_range_support_is_not_saved(ingest, dataset, s3):
+    dataset.truncateAt = 30000
+    dataset.ignoreRange = True
+    with pytest.raises(IOError):
+        ingest.copyUrlToS3(dataset.url, "s3://bucket/raw/City.csv")
+    assert ("bucket", "raw/City.csv") not in s3.objects
+    assert [c[0] for c in s3.calls][-1] == "abort_multipart_upload"
+
+
+def test_resumed_response_at_the_wrong_offset_is_not_saved(ingest, dataset, s3):
+    dataset.truncateAt = 30000
+    dataset.rangeSkew = 100
+    with pytest.raises(IOError):
+        ingest.copyUrlToS3(dataset.url, "s3://bucket/raw/City.csv")
+    assert ("bucket", "raw/City.csv") not in s3.objects
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pyspark")
+pytest.importorskip("boto3")
+
+from lib.s3Publisher import s3Publisher
+
+
+@pytest.fixture
+def publisher(s3):
+    p = s3Publisher(endpointUrl="http://127.0.0.1:9", maxConcurrent=2, sse=None, grantRead=None)
+    p.s3 = s3
+    return p
+
+
+def _write(path, data):
+    with open(str(path), "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_unchanged_files_are_skipped_on_republish(publisher, s3, tmpdir):
+    a = _write(tmpdir.join("a.html"), b"<html>a</html>")
+    b = _write(tmpdir.join("b.json"), b"{}")
+    files = [(a, "s3://bucket/docs/a.html"), (b, "s3://bucket/docs/b.json")]
+    assert publisher.publish(files, waitSeconds=5) == {"s3://bucket/docs/a.html": "uploaded", "s3://bucket/docs/b.json": "uploaded"}
+    _write(tmpdir.join("b.json"), b'{"changed": true}')
+    assert publisher.publish(files, waitSeconds=5) == {"s3://bucket/docs/a.html": "skipped", "s3://bucket/docs/b.json": "uploaded"}
+    assert s3.objects[("bucket", "docs/b.json")]["Body"] == b'{"changed": true}'
+    assert publisher.publish(files, force=True, waitSeconds=5) == {"s3://bucket/docs/a.html": "uploaded", "s3://bucket/docs/b.json": "uploaded"}
+    assert len([c for c in s3.calls if c[0] == "upload_file"]) == 5
+
+
+def test_content_type_encryption_and_grant(s3, tmpdir):
+    p = s3Publisher(endpointUrl="http://127.0.0.1:9", sse="AES256", grantRead='uri="http://acs.amazonaws.com/groups/global/AllUsers"')
+    p.s3 = s3
+    p.publish([(_write(tmpdir.join("a.html"), b"<html></html>"), "s3://bucket/a.html")], waitSeconds=5)
+    extra = s3.objects[("bucket", "a.html")]["ExtraArgs"]
+    assert extra["ContentType"] == "text/html"
+    assert extra["ServerSideEncryption"] == "AES256"
+    assert extra["GrantRead"] == 'uri="http://acs.amazonaws.com/groups/global/AllUsers"'
+    assert len(extra["Metadata"]["content-md5"]) == 32
+
+
+def test_failures_are_reported_after_other_files(publisher, s3, tmpdir):
+    a = _write(tmpdir.join("a.html"), b"<html>a</html>")
+    with pytest.raises(ValueError) as e:
+        publisher.publish([(str(tmpdir.join("missing.html")), "s3://bucket/missing.html"), (a, "s3://bucket/a.html")], waitSeconds=0.2)
+    assert "1 files failed to publish" in str(e.value)
+    assert ("bucket", "a.html") in s3.objects
+
+
+def test_wait_for_file_saved_after_request(publisher, tmpdir):
+    path = _write(tmpdir.join("notebook.ipynb"), b"old")
+    old = time.time() - 60
+    os.utime(path, (old, old))
+    requested = time.time()
+
+    def save():
+        time.sleep(0.3)
+        _write(path, b"new")
+
+    t = threading.Thread(target=save)
+    t.start()
+    publisher.waitForFile(path, waitSeconds=5, pollSeconds=0.1, newerThan=requested)
+    t.join()
+    with open(path, "rb") as f:
+        assert f.read() == b"new"
+
+
+def test_wait_for_file_compares_whole_seconds(publisher, tmpdir):
+    # a filesystem with 1 second modification times stores a save made just after the request as older than it
+    path = _write(tmpdir.join("notebook.ipynb"), b"saved")
+    requested = int(time.time()) + 0.9
+    os.utime(path, (int(requested), int(requested)))
+    publisher.waitForFile(path, waitSeconds=2, pollSeconds=0.1, newerThan=requested)
+    with pytest.raises(ValueError):
+        publisher.waitForFile(path, waitSeconds=0.3, pollSeconds=0.1, newerThan=requested + 1)